@@ -0,0 +1,205 @@
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import numpy as np
+
+from cache import get_cache_dir, params_key, safe_key
+from liveatc import parse_archive_filename
+from timeline import ARCHIVE_LENGTH
+from transmission_index import load_index
+
+
+ACTIVITY_VERSION = 1
+
+MINUTES_PER_DAY = 24 * 60
+ARCHIVE_MINUTES = int(ARCHIVE_LENGTH.total_seconds() // 60)
+
+
+def activity_from_index(index):
+  """Per-minute activity of one archive from its TransmissionIndex
+
+  Returns a dict with transmissions starting in each minute, occupied seconds in each
+  minute, and what's needed to find silent gaps across archives: the first start, last
+  end and longest gap inside the archive, in ms (-1 when there are no transmissions).
+  """
+  bounds = np.arange(ARCHIVE_MINUTES + 1, dtype=np.int64) * 60000
+  starts = index.start_ms.astype(np.int64)
+  ends = index.end_ms.astype(np.int64)
+
+  counts = np.histogram(starts, bins=bounds)[0].astype(np.int32)
+  # Occupied ms before every minute boundary, then per minute
+  occupied = np.clip(bounds[:, None] - starts[None, :], 0, (ends - starts)[None, :]).sum(axis=1)
+  seconds = (np.diff(occupied) / 1000).astype(np.float32)
+
+  if len(index):
+    first_start, last_end = int(starts.min()), int(ends.max())
+    max_gap = int(np.max(starts[1:] - ends[:-1], initial=0))
+  else:
+    first_start = last_end = max_gap = -1
+
+  return {
+    'counts': counts,
+    'seconds': seconds,
+    'first_start': first_start,
+    'last_end': last_end,
+    'max_gap': max_gap,
+    'duration_ms': index.duration_ms,
+  }
+
+
+def activity_path(path, **params):
+  # Keyed by name, size and mtime rather than content hash, so checking a month of archives
+  # for new ones doesn't read every file
+  stat = os.stat(path)
+  key = f'{safe_key(os.path.basename(path))}-{stat.st_size}-{stat.st_mtime_ns}-{params_key(**params)}'
+  return os.path.join(get_cache_dir('activity'), f'{key}.npz')
+
+
+def load_activity(path, rebuild=False, **params):
+  """Per-minute activity of an archive, computed once and then read from the cache"""
+  cached_path = activity_path(path, **params)
+  if not rebuild and os.path.exists(cached_path):
+    with np.load(cached_path) as data:
+      if data['version'].item() == ACTIVITY_VERSION:
+        return {key: data[key] if data[key].ndim else data[key].item() for key in data.files if key != 'version'}
+
+  activity = activity_from_index(load_index(path, **params))
+  np.savez(cached_path, version=ACTIVITY_VERSION, **activity)
+  return activity
+
+
+def _activity_job(job):
+  path, params = job
+  try:
+    return path, load_activity(path, **params), None
+  except Exception as e:
+    return path, None, str(e)
+
+
+class ActivityReport:
+  """Activity of one or more stations as station x day x minute-of-day matrices"""
+
+  def __init__(self, stations, days, counts, seconds, coverage, longest_gap):
+    self.stations = stations          # archive identifiers
+    self.days = days                  # dates
+    self.counts = counts              # transmissions starting in each minute
+    self.seconds = seconds            # occupied seconds in each minute
+    self.coverage = coverage          # minutes covered by a downloaded archive
+    self.longest_gap = longest_gap    # longest silence per station and day, in seconds
+
+  @property
+  def occupancy(self):
+    """Fraction of each minute the channel was in use (NaN where there is no archive)"""
+    return np.where(self.coverage, self.seconds / 60, np.nan)
+
+  def summary(self):
+    """Per-station totals: transmissions, mean occupancy, busiest hour and longest gap"""
+    results = []
+    for i, station in enumerate(self.stations):
+      covered = self.coverage[i]
+      hourly = np.nansum(self.counts[i].reshape(len(self.days), 24, 60), axis=(0, 2))
+      hours_covered = covered.reshape(len(self.days), 24, 60).sum(axis=(0, 2))
+      per_hour = np.where(hours_covered > 0, hourly / np.maximum(hours_covered, 1) * 60, 0)
+      results.append({
+        'station': station,
+        'transmissions': int(self.counts[i].sum()),
+        'occupancy': float(self.seconds[i][covered].sum() / max(covered.sum() * 60, 1)),
+        'busiest_hour': int(np.argmax(per_hour)),
+        'busiest_hour_rate': float(per_hour.max()),
+        'longest_gap': float(np.nanmax(self.longest_gap[i], initial=0)),
+        'hours_covered': float(covered.sum() / 60),
+      })
+    return results
+
+  def save_npz(self, path):
+    np.savez_compressed(path, stations=np.array(self.stations), days=np.array([d.isoformat() for d in self.days]),
+                        counts=self.counts, seconds=self.seconds, coverage=self.coverage,
+                        longest_gap=self.longest_gap)
+
+  def save_csv(self, path):
+    """One row per station, day and covered minute"""
+    with open(path, 'w', newline='') as f:
+      writer = csv.writer(f)
+      writer.writerow(['station', 'date', 'minute', 'transmissions', 'occupancy'])
+      for i, day, minute in zip(*np.nonzero(self.coverage)):
+        writer.writerow([self.stations[i], self.days[day].isoformat(), f'{minute // 60:02d}:{minute % 60:02d}',
+                         int(self.counts[i, day, minute]), round(float(self.seconds[i, day, minute]) / 60, 4)])
+
+
+def build_report(archives):
+  """Aggregate (path, activity) pairs into an ActivityReport"""
+  entries = []
+  for path, activity in archives:
+    identifier, start = parse_archive_filename(path)
+    entries.append((identifier, start, activity))
+  entries.sort(key=lambda entry: (entry[0], entry[1]))
+
+  stations = sorted({identifier for identifier, _, _ in entries})
+  days = sorted({start.date() for _, start, _ in entries})
+  station_index = {station: i for i, station in enumerate(stations)}
+  day_index = {day: i for i, day in enumerate(days)}
+
+  shape = (len(stations), len(days), MINUTES_PER_DAY)
+  counts = np.zeros(shape, dtype=np.int32)
+  seconds = np.zeros(shape, dtype=np.float32)
+  coverage = np.zeros(shape, dtype=bool)
+  longest_gap = np.full(shape[:2], np.nan, dtype=np.float32)
+
+  def record_gap(i, day, gap):
+    longest_gap[i, day] = np.fmax(longest_gap[i, day], gap.total_seconds())
+
+  # Silences run across archive boundaries as long as the archives are consecutive
+  silent_since = previous = None
+  for identifier, start, activity in entries:
+    i, day = station_index[identifier], day_index[start.date()]
+    minute = start.hour * 60 + start.minute
+    span = slice(minute, minute + ARCHIVE_MINUTES)
+    counts[i, day, span] = activity['counts']
+    seconds[i, day, span] = activity['seconds']
+    coverage[i, day, span] = True
+
+    if previous is None or previous[:2] != (identifier, start):
+      if previous is not None:
+        record_gap(previous[2], previous[3], previous[1] - silent_since)
+      silent_since = start
+
+    if activity['first_start'] >= 0:
+      record_gap(i, day, start + timedelta(milliseconds=activity['first_start']) - silent_since)
+      record_gap(i, day, timedelta(milliseconds=activity['max_gap']))
+      silent_since = start + timedelta(milliseconds=activity['last_end'])
+    previous = (identifier, start + ARCHIVE_LENGTH, i, day)
+
+  if previous is not None:
+    record_gap(previous[2], previous[3], previous[1] - silent_since)
+
+  return ActivityReport(stations, days, counts, seconds, coverage, longest_gap)
+
+
+def analyze_archives(paths, workers=None, **params):
+  """ActivityReport for a set of archives, processing only those not analyzed before
+
+  Returns (report, failed) where failed lists (path, error) for archives that couldn't be read.
+  """
+  paths = [path for path in paths if parse_archive_filename(path)]
+  results = []
+  failed = []
+  pending = []
+  for path in paths:
+    cached_path = activity_path(path, **params)
+    if os.path.exists(cached_path):
+      results.append((path, load_activity(path, **params)))
+    else:
+      pending.append(path)
+
+  if pending:
+    print(f"Analyzing {len(pending)} new archive(s), {len(results)} cached")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      for path, activity, error in executor.map(_activity_job, [(path, params) for path in pending]):
+        if error:
+          failed.append((path, error))
+        else:
+          results.append((path, activity))
+
+  return build_report(results), failed
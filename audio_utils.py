@@ -1,6 +1,28 @@
+import os
+import time
+
+import numpy as np
 from pydub import AudioSegment
-from pydub.silence import split_on_silence
-import noisereduce as nr
+from pydub.utils import db_to_float
+
+from cache import get_cache_dir, safe_key
+from chunk_sink import BackgroundWriter, WavFilesSink
+from pcm_cache import PCMAudio, load_pcm, load_range
+from profiling import timed
+
+
+# Spectral gating parameters (same defaults as noisereduce's stationary mode)
+NOISE_N_FFT = 1024
+NOISE_HOP = NOISE_N_FFT // 4
+NOISE_N_STD_THRESH = 1.5
+NOISE_FREQ_SMOOTH_HZ = 500
+NOISE_TIME_SMOOTH_MS = 50
+
+# Never estimate a noise profile from more than this much silence
+NOISE_PROFILE_MAX_SECONDS = 60
+
+# Audio per batched noise reduction pass (bounds memory on long timelines)
+NOISE_BATCH_SECONDS = 600
 
 
 def normalize_amplitude(chunk, target_dBFS):
@@ -8,47 +30,464 @@ def normalize_amplitude(chunk, target_dBFS):
   return chunk.apply_gain(delta_dBFS)
 
 
-def load_audio(filename):
-  return AudioSegment.from_mp3(filename)
+def load_audio(filename, start_ms=None, end_ms=None):
+  """AudioSegment of a file (or of the part between two times in ms), read through the PCM cache"""
+  audio = open_audio(filename, start_ms, end_ms)
+  return audio.segment(audio.samples)
 
 
-def chunk_audio(audio, min_silence_len=200, keep_silence=500, silence_thresh=-48, seek_step=2):
-  chunks = split_on_silence(
-    audio,
-    min_silence_len=min_silence_len,
-    keep_silence=keep_silence,
-    silence_thresh=silence_thresh,
-    seek_step=seek_step,
-  )
+@timed('load_audio')
+def open_audio(filename, start_ms=None, end_ms=None):
+  """Memory-mapped PCMAudio of a file, for reading long archives without holding them in memory"""
+  # Decoded once into the PCM cache, then memory-mapped (see pcm_cache.py)
+  if start_ms is None and end_ms is None:
+    return load_pcm(filename)
+  # Part of a file: MP3s seek straight to it instead of decoding from the start
+  return load_range(filename, start_ms, end_ms)
 
-  print(len(chunks))
 
-  i = 0
+def get_samples(audio):
+  """Interleaved samples of an AudioSegment or PCMAudio as a NumPy array"""
+  if isinstance(audio, PCMAudio):
+    return audio.interleaved()
+  return np.array(audio.get_array_of_samples())
+
+
+def _ms_boundaries(n_ms, frame_rate, channels):
+  # Sample index (interleaved) at which every millisecond starts
+  return (np.arange(n_ms + 1, dtype=np.int64) * frame_rate // 1000) * channels
+
+
+def ms_energy(samples, frame_rate, channels=1, block_ms=60000):
+  """Sum of squares and sample counts for every millisecond of audio"""
+  n_ms = len(samples) // channels * 1000 // frame_rate
+  bounds = _ms_boundaries(n_ms, frame_rate, channels)
+
+  sums = np.empty(n_ms, dtype=np.float64)
+  # Work in blocks so we never hold a float copy of the whole file
+  for first in range(0, n_ms, block_ms):
+    last = min(first + block_ms, n_ms)
+    block = np.asarray(samples[bounds[first]:bounds[last]], dtype=np.float64)
+    sums[first:last] = np.add.reduceat(block * block, bounds[first:last] - bounds[first])
+
+  return sums, np.diff(bounds).astype(np.int32)
+
+
+def as_pcm(audio):
+  """PCMAudio/ArchiveTimeline pass through, AudioSegments get wrapped"""
+  if isinstance(audio, AudioSegment):
+    return PCMAudio.from_segment(audio)
+  return audio
+
+
+def audio_energy(audio):
+  """Per-millisecond energy of an AudioSegment, PCMAudio or ArchiveTimeline"""
+  audio = as_pcm(audio)
+  if not hasattr(audio, 'iter_blocks'):
+    return ms_energy(audio.interleaved(), audio.frame_rate, audio.channels)
+
+  # Timelines are streamed block by block, never materialized as a whole
+  sums = []
+  counts = []
+  for _, block in audio.iter_blocks():
+    block_sums, block_counts = ms_energy(block.reshape(-1), audio.frame_rate, audio.channels)
+    sums.append(block_sums.astype(np.float32))
+    counts.append(block_counts)
+  if not sums:
+    return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int32)
+  return np.concatenate(sums), np.concatenate(counts)
+
+
+def detect_nonsilent_ranges(samples, frame_rate, channels=1, sample_width=2,
+                            min_silence_len=200, silence_thresh=-48, seek_step=2):
+  """Vectorized equivalent of pydub.silence.detect_nonsilent working on raw samples"""
+  sums, counts = ms_energy(samples, frame_rate, channels)
+  return nonsilent_from_energy(sums, counts, sample_width, min_silence_len, silence_thresh, seek_step)
+
+
+def nonsilent_from_energy(sums, counts, sample_width=2, min_silence_len=200, silence_thresh=-48, seek_step=2):
+  """Nonsilent [start, end] ms ranges from per-millisecond energy (see ms_energy)"""
+  seg_len = len(sums)
+
+  if seg_len < min_silence_len:
+    return [[0, seg_len]] if seg_len else []
+
+  max_amplitude = float(2 ** (8 * sample_width - 1))
+  thresh = db_to_float(silence_thresh) * max_amplitude
+
+  last_slice_start = seg_len - min_silence_len
+  slice_starts = np.arange(0, last_slice_start + 1, seek_step)
+  if last_slice_start % seek_step:
+    slice_starts = np.append(slice_starts, last_slice_start)
+
+  cum_sums = np.concatenate(([0.0], np.cumsum(sums, dtype=np.float64)))
+  cum_counts = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+  window_sum = cum_sums[slice_starts + min_silence_len] - cum_sums[slice_starts]
+  window_count = cum_counts[slice_starts + min_silence_len] - cum_counts[slice_starts]
+  rms = np.sqrt(window_sum / np.maximum(window_count, 1))
+
+  silence_starts = slice_starts[rms <= thresh]
+  if not len(silence_starts):
+    return [[0, seg_len]]
+
+  # Combine the silent slices into ranges the same way pydub does
+  steps = np.diff(silence_starts)
+  breaks = np.nonzero((steps != seek_step) & (steps > min_silence_len))[0]
+  range_starts = np.concatenate(([silence_starts[0]], silence_starts[breaks + 1]))
+  range_ends = np.concatenate((silence_starts[breaks], [silence_starts[-1]])) + min_silence_len
+
+  if range_starts[0] == 0 and range_ends[0] == seg_len:
+    return []
+
+  nonsilent_ranges = [[int(start), int(end)] for start, end in
+                      zip(np.concatenate(([0], range_ends[:-1])), range_starts)]
+  if range_ends[-1] != seg_len:
+    nonsilent_ranges.append([int(range_ends[-1]), seg_len])
+
+  if nonsilent_ranges[0] == [0, 0]:
+    nonsilent_ranges.pop(0)
+
+  return nonsilent_ranges
+
+
+def silent_ranges(nonsilent_ranges, length):
+  """Complement of a sorted list of [start, end] ranges within [0, length]"""
+  ranges = []
+  last_end = 0
+  for start, end in nonsilent_ranges:
+    if start > last_end:
+      ranges.append([last_end, start])
+    last_end = max(last_end, end)
+  if last_end < length:
+    ranges.append([last_end, length])
+  return ranges
+
+
+def merge_ranges(ranges):
+  """Sort [start, end] ranges and merge the ones that overlap or touch"""
+  merged = []
+  for start, end in sorted(ranges):
+    if merged and start <= merged[-1][1]:
+      merged[-1][1] = max(merged[-1][1], end)
+    elif end > start:
+      merged.append([start, end])
+  return merged
+
+
+def gather_frames(audio, ranges):
+  """Concatenate the (frames, channels) samples of many ms ranges with a single copy"""
+  pieces = [audio.frames(start, end) for start, end in ranges]
+  out = np.empty((sum(len(piece) for piece in pieces), audio.channels), dtype=audio.dtype)
+  position = 0
+  for piece in pieces:
+    out[position:position + len(piece)] = piece
+    position += len(piece)
+  return out
+
+
+def pad_ranges(nonsilent_ranges, length, keep_silence):
+  """Pad ranges by keep_silence ms, splitting overlapping padding evenly (like split_on_silence)"""
+  output_ranges = [[start - keep_silence, end + keep_silence] for start, end in nonsilent_ranges]
+
+  for range_i, range_ii in zip(output_ranges, output_ranges[1:]):
+    last_end = range_i[1]
+    next_start = range_ii[0]
+    if next_start < last_end:
+      range_i[1] = (last_end + next_start) // 2
+      range_ii[0] = range_i[1]
+
+  return [[max(start, 0), min(end, length)] for start, end in output_ranges]
+
+
+def stft(x, n_fft=NOISE_N_FFT, hop=NOISE_HOP):
+  """Short-time Fourier transform of a 1-D signal (Hann window, centered frames)"""
+  pad = n_fft // 2
+  x = np.pad(np.asarray(x, dtype=np.float64), (pad, pad + (-len(x)) % hop))
+  frames = np.lib.stride_tricks.sliding_window_view(x, n_fft)[::hop]
+  return np.fft.rfft(frames * np.hanning(n_fft), axis=-1)
+
+
+def istft(spec, length, n_fft=NOISE_N_FFT, hop=NOISE_HOP):
+  """Inverse of stft() by weighted overlap-add"""
+  window = np.hanning(n_fft)
+  frames = np.fft.irfft(spec, n=n_fft, axis=-1) * window
+
+  n_frames = len(frames)
+  overlap = n_fft // hop
+  out = np.zeros((n_frames + overlap - 1, hop))
+  norm = np.zeros((n_frames + overlap - 1, hop))
+  for k in range(overlap):
+    out[k:k + n_frames] += frames[:, k * hop:(k + 1) * hop]
+    norm[k:k + n_frames] += window[k * hop:(k + 1) * hop] ** 2
+
+  out = out.ravel() / np.maximum(norm.ravel(), 1e-8)
+  pad = n_fft // 2
+  return out[pad:pad + length]
+
+
+def _to_db(spec):
+  return 20 * np.log10(np.abs(spec) + 1e-10)
+
+
+def _smooth(mask, size, axis):
+  # Moving average along one axis (cheap stand-in for a 2-D convolution)
+  if size <= 1:
+    return mask
+  padding = [(0, 0)] * mask.ndim
+  padding[axis] = (size // 2 + 1, size - 1 - size // 2)
+  cum = np.cumsum(np.pad(mask, padding), axis=axis)
+  n = mask.shape[axis]
+  return (np.take(cum, np.arange(size, size + n), axis=axis) - np.take(cum, np.arange(n), axis=axis)) / size
+
+
+def estimate_noise_profile(pieces, frame_rate, n_fft=NOISE_N_FFT, hop=NOISE_HOP, quietest=None):
+  """Per-frequency noise statistics (dB mean/std) from 1-D pieces of silence
+
+  Pieces are consumed lazily until NOISE_PROFILE_MAX_SECONDS of audio has been seen.
+  With quietest set, only that fraction of the quietest frames is used. Returns None
+  when no piece is long enough.
+  """
+  spectra = []
+  total = 0
+  max_samples = NOISE_PROFILE_MAX_SECONDS * frame_rate
+  for piece in pieces:
+    if len(piece) < n_fft:
+      continue
+    piece = piece[:max_samples - total]
+    spectra.append(_to_db(stft(piece, n_fft, hop)))
+    total += len(piece)
+    if total >= max_samples:
+      break
+
+  if not spectra:
+    return None
+
+  db = np.concatenate(spectra)
+  if quietest is not None:
+    loudness = db.mean(axis=1)
+    db = db[loudness <= np.percentile(loudness, quietest * 100)]
+
+  return {
+    'frame_rate': frame_rate,
+    'n_fft': n_fft,
+    'hop': hop,
+    'mean': db.mean(axis=0),
+    'std': db.std(axis=0),
+    'created': time.time(),
+  }
+
+
+def spectral_gate(samples, profile, prop_decrease=0.5, n_std_thresh=NOISE_N_STD_THRESH):
+  """Stationary spectral gating of a 1-D signal against a precomputed noise profile"""
+  n_fft = profile['n_fft']
+  hop = profile['hop']
+  spec = stft(samples, n_fft, hop)
+
+  thresh = profile['mean'] + n_std_thresh * profile['std']
+  mask = (_to_db(spec) > thresh).astype(np.float64)
+
+  freq_smooth = int(NOISE_FREQ_SMOOTH_HZ / (profile['frame_rate'] / n_fft))
+  time_smooth = int(NOISE_TIME_SMOOTH_MS / 1000 * profile['frame_rate'] / hop)
+  mask = _smooth(_smooth(mask, freq_smooth, 1), time_smooth, 0)
+
+  gain = mask * prop_decrease + (1.0 - prop_decrease)
+  return istft(spec * gain, len(samples), n_fft, hop)
+
+
+def reduce_noise_batch(chunks, profile, prop_decrease=0.5):
+  """Apply spectral gating to many 1-D chunks in a single STFT pass"""
+  if not chunks:
+    return []
+
+  # Separate the chunks with silence so frames never straddle two chunks, and start every
+  # chunk on a hop boundary so it is framed exactly as it would be on its own
+  hop = profile['hop']
+  pieces = []
+  offsets = []
+  position = 0
   for chunk in chunks:
-    normalized_chunk = normalize_amplitude(chunk, -24.0)
-    normalized_chunk.export(f'/tmp/chunks/chunk-{i}-orig.wav', format='wav')
+    offsets.append(position)
+    gap = np.zeros(profile['n_fft'] + (-len(chunk)) % hop)
+    pieces.extend((chunk, gap))
+    position += len(chunk) + len(gap)
+
+  reduced = spectral_gate(np.concatenate(pieces), profile, prop_decrease)
+  return [reduced[offset:offset + len(chunk)] for offset, chunk in zip(offsets, chunks)]
+
+
+class NoiseProfileCache:
+  """On-disk noise profiles, one per station/frequency, refreshed after max_age seconds"""
+
+  def __init__(self, cache_dir=None, max_age=24 * 3600):
+    self.cache_dir = cache_dir or get_cache_dir('noise_profiles')
+    self.max_age = max_age
+
+  def path(self, station):
+    return os.path.join(self.cache_dir, f'{safe_key(station)}.npz')
+
+  def get(self, station, frame_rate, n_fft=NOISE_N_FFT):
+    path = self.path(station)
+    if not os.path.exists(path):
+      return None
+
+    with np.load(path) as data:
+      profile = {key: data[key] for key in data.files}
+    for key in ('frame_rate', 'n_fft', 'hop', 'created'):
+      profile[key] = profile[key].item()
+
+    if profile['frame_rate'] != frame_rate or profile['n_fft'] != n_fft:
+      return None
+    if self.max_age is not None and time.time() - profile['created'] > self.max_age:
+      return None
+
+    return profile
+
+  def put(self, station, profile):
+    np.savez(self.path(station), **profile)
 
-    reduced_noise = nr.reduce_noise(
-      y=normalized_chunk.get_array_of_samples(),
-      sr=normalized_chunk.frame_rate,
-      prop_decrease=0.5,
+
+def _offset(dtype):
+  # Unsigned PCM (8-bit WAV) is centered on half its range instead of 0
+  dtype = np.dtype(dtype)
+  return 2 ** (8 * dtype.itemsize - 1) if dtype.kind == 'u' else 0
+
+
+def _to_float(samples):
+  """Integer PCM as float64 centered on 0"""
+  return np.asarray(samples, dtype=np.float64) - _offset(samples.dtype)
+
+
+def _from_float(samples, dtype):
+  info = np.iinfo(dtype)
+  return np.clip(np.round(samples + _offset(dtype)), info.min, info.max).astype(dtype)
+
+
+def _mono(frames):
+  frames = _to_float(frames)
+  return frames.mean(axis=1) if frames.shape[1] > 1 else frames[:, 0]
+
+
+def _batches(ranges, max_ms):
+  # Group consecutive ranges so each noise reduction pass covers at most max_ms of audio
+  batch = []
+  total = 0
+  for start, end in ranges:
+    if batch and total + (end - start) > max_ms:
+      yield batch
+      batch = []
+      total = 0
+    batch.append((start, end))
+    total += end - start
+  if batch:
+    yield batch
+
+
+@timed('chunk_audio')
+def chunk_audio(audio, min_silence_len=200, keep_silence=500, silence_thresh=-48, seek_step=2,
+                station=None, refresh_noise_profile=False, noise_cache=None, nonsilent=None, sink=None):
+  # Works on AudioSegments, memory-mapped PCMAudio and ArchiveTimelines alike
+  # Chunks go to a sink from chunk_sink.py (by default one WAV per chunk in /tmp/chunks),
+  # written on a background thread while the next batch is processed
+  audio = as_pcm(audio)
+  channels = audio.channels
+
+  # Transmission boundaries can come from a prebuilt index (see transmission_index.py)
+  if nonsilent is None:
+    sums, counts = audio_energy(audio)
+    nonsilent = nonsilent_from_energy(
+      sums,
+      counts,
+      sample_width=audio.sample_width,
+      min_silence_len=min_silence_len,
+      silence_thresh=silence_thresh,
+      seek_step=seek_step,
     )
+  ranges = pad_ranges(nonsilent, len(audio), keep_silence)
+
+  # Noise statistics come from the gaps between transmissions, computed once per
+  # station (cached on disk) instead of once per chunk
+  if station is not None:
+    noise_cache = noise_cache or NoiseProfileCache()
+
+  profile = None
+  if station is not None and not refresh_noise_profile:
+    profile = noise_cache.get(station, audio.frame_rate)
+
+  if profile is None:
+    silence = (_mono(audio.frames(start, end)) for start, end in silent_ranges(nonsilent, len(audio)))
+    profile = estimate_noise_profile(silence, audio.frame_rate)
+    if profile is None:
+      # No usable silence, fall back to the quietest parts of the first minute
+      first_minute = _mono(audio.frames(0, NOISE_PROFILE_MAX_SECONDS * 1000))
+      profile = estimate_noise_profile([first_minute], audio.frame_rate, quietest=0.2)
+    if station is not None:
+      noise_cache.put(station, profile)
+
+  writer = BackgroundWriter(sink if sink is not None else WavFilesSink('/tmp/chunks'))
+  writer.open(audio.frame_rate, channels, audio.dtype)
+
+  def write(i, kind, start, end, segment):
+    writer.write(i, kind, start, end, np.frombuffer(segment.raw_data, dtype=audio.dtype).reshape(-1, channels))
+
+  try:
+    _write_chunks(audio, ranges, profile, write)
+  except BaseException:
+    # Don't let a failed run look like a complete one
+    writer.abort()
+    raise
+  writer.close()
+
+
+def _write_chunks(audio, ranges, profile, write):
+  channels = audio.channels
+  i = 0
+  for batch in _batches(ranges, NOISE_BATCH_SECONDS * 1000):
+    chunks = [np.asarray(audio.frames(start, end)) for start, end in batch]
+
+    # One gating pass per channel over all chunks of the batch
+    reduced = [reduce_noise_batch([_to_float(chunk[:, c]) for chunk in chunks], profile) for c in range(channels)]
+
+    for j, ((start, end), frames) in enumerate(zip(batch, chunks)):
+      chunk = AudioSegment(
+        np.ascontiguousarray(frames).tobytes(),
+        frame_rate=audio.frame_rate,
+        sample_width=audio.sample_width,
+        channels=channels,
+      )
+      normalized_chunk = normalize_amplitude(chunk, -24.0)
+      write(i, 'orig', start, end, normalized_chunk)
+
+      reduced_noise = np.stack([channel[j] for channel in reduced], axis=1).ravel()
+      reduced_noise = _from_float(reduced_noise, frames.dtype)
+
+      new_sound = chunk._spawn(reduced_noise.tobytes())
+      new_sound = normalize_amplitude(new_sound, -24.0)
+      write(i, 'nr', start, end, new_sound)
 
-    new_sound = normalized_chunk._spawn(reduced_noise)
-    new_sound = normalize_amplitude(new_sound, -24.0)
-    new_sound.export(f'/tmp/chunks/chunk-{i}-nr.wav', format='wav')
+      i += 1
 
-    i += 1
 
-    # reduced_noise.export("chunk.mp3", format="mp3")
+if __name__ == '__main__':
+  import argparse
+  from chunk_sink import make_sink
+  from liveatc import parse_archive_filename
 
-    # yield normalized_chunk
+  parser = argparse.ArgumentParser(description='Split a recording into noise-reduced transmission chunks')
+  parser.add_argument('filename', nargs='?', default='/tmp/KPDX3-Twr-123775-Oct-01-2021-2000Z.mp3')
+  parser.add_argument('--sink', choices=['files', 'archive', 'store'], default='files',
+                      help='One WAV per chunk, one file per recording plus a segment index, or a chunk store container')
+  parser.add_argument('-o', '--output', default='/tmp/chunks', help='Output directory (default: /tmp/chunks)')
+  parser.add_argument('-f', '--format', default='wav', help='Audio format for --sink archive, e.g. wav or flac')
+  parser.add_argument('--no-index', action='store_true', help='Detect transmissions again instead of using the transmission index')
+  args = parser.parse_args()
 
-    # print('Exporting chunk{0}.mp3.'.format(i))
-    # normalized_chunk.export(
-    #     './chunks/chunk{0}.mp3'.format(i),
-    #     bitrate = '192k',
-    #     format = 'mp3'
-    # )
+  # Transmission boundaries from the cached index, so a repeat run skips the silence scan
+  nonsilent = None
+  if not args.no_index:
+    from transmission_index import load_index
+    nonsilent = load_index(args.filename).ranges()
 
-chunk_audio(load_audio('/tmp/KPDX3-Twr-123775-Oct-01-2021-2000Z.mp3'))
+  parsed = parse_archive_filename(args.filename)
+  name = os.path.splitext(os.path.basename(args.filename))[0]
+  chunk_audio(open_audio(args.filename), station=parsed[0] if parsed else None, nonsilent=nonsilent,
+              sink=make_sink(args.sink, args.output, name, args.format))
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""Throughput and peak memory of the audio stages on synthetic ATC recordings
+
+  python benchmark.py --durations 60 600 1800 --densities 0.1 0.3 -o results.json
+  python benchmark.py -o new.json --compare results.json
+"""
+
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import get_context
+
+import numpy as np
+
+from profiling import peak_rss_mb
+
+
+BENCHMARK_VERSION = 1
+
+# LiveATC archives are mono at 22.05 kHz
+FRAME_RATE = 22050
+
+# Radio voice band and levels (dBFS) of the synthetic recordings
+VOICE_BAND_HZ = (300, 3000)
+VOICE_DBFS = -20
+SQUELCH_DBFS = -26
+HISS_DBFS = -62
+SQUELCH_TAIL_MS = 150
+SYLLABLE_HZ = 4.0
+TRANSMISSION_SECONDS = (1.5, 6.0)
+
+DEFAULT_DURATIONS = [60, 600, 1800]
+DEFAULT_DENSITIES = [0.1, 0.3]
+
+
+def _level(dbfs):
+  return 32767 * 10 ** (dbfs / 20)
+
+
+def _band_noise(rng, n, frame_rate, band):
+  """White noise limited to a frequency band"""
+  spectrum = np.fft.rfft(rng.standard_normal(n))
+  freqs = np.fft.rfftfreq(n, 1 / frame_rate)
+  spectrum[(freqs < band[0]) | (freqs > band[1])] = 0
+  noise = np.fft.irfft(spectrum, n)
+  return noise / max(noise.std(), 1e-9)
+
+
+def transmission(rng, seconds, frame_rate=FRAME_RATE):
+  """One keyed transmission: band-limited "speech" in syllable bursts followed by a squelch tail"""
+  n = int(seconds * frame_rate)
+  t = np.arange(n) / frame_rate
+
+  # Syllables: a rectified sine at a few Hz, each syllable with its own loudness
+  syllables = np.abs(np.sin(np.pi * SYLLABLE_HZ * t + rng.uniform(0, np.pi)))
+  loudness = rng.uniform(0.4, 1.0, int(seconds * SYLLABLE_HZ) + 2)
+  envelope = syllables * loudness[(t * SYLLABLE_HZ).astype(int)]
+  voice = _band_noise(rng, n, frame_rate, VOICE_BAND_HZ) * envelope * _level(VOICE_DBFS)
+
+  # Open squelch between words, and the burst of noise when the transmitter unkeys
+  tail_n = int(SQUELCH_TAIL_MS / 1000 * frame_rate)
+  tail = rng.standard_normal(tail_n) * _level(SQUELCH_DBFS) * np.linspace(1, 0, tail_n) ** 2
+  carrier = rng.standard_normal(n) * _level(SQUELCH_DBFS) * 0.3
+  return np.concatenate([voice + carrier, tail])
+
+
+def synthesize(path, seconds, density, seed=0, frame_rate=FRAME_RATE):
+  """Write a synthetic ATC recording to a .npy file of (frames, 1) int16 samples
+
+  Transmissions cover about `density` of the time, separated by exponentially distributed
+  gaps of low hiss. Returns the [start, end] ms ranges of the transmissions.
+  """
+  rng = np.random.default_rng(seed)
+  n = int(seconds * frame_rate)
+  samples = np.lib.format.open_memmap(path, mode='w+', dtype='<i2', shape=(n, 1))
+
+  # Background hiss, written in blocks so long recordings never sit in memory as floats
+  block = 60 * frame_rate
+  for start in range(0, n, block):
+    end = min(start + block, n)
+    samples[start:end, 0] = (rng.standard_normal(end - start) * _level(HISS_DBFS)).astype('<i2')
+
+  mean_length = sum(TRANSMISSION_SECONDS) / 2 + SQUELCH_TAIL_MS / 1000
+  mean_gap = mean_length * (1 - density) / max(density, 1e-3)
+
+  ranges = []
+  position = rng.uniform(0, mean_gap)
+  while True:
+    audio = transmission(rng, rng.uniform(*TRANSMISSION_SECONDS), frame_rate)
+    start = int(position * frame_rate)
+    end = start + len(audio)
+    if end > n:
+      break
+    mixed = samples[start:end, 0] + audio
+    samples[start:end, 0] = np.clip(mixed, -32768, 32767).astype('<i2')
+    ranges.append([start * 1000 // frame_rate, end * 1000 // frame_rate])
+    position = end / frame_rate + rng.exponential(mean_gap)
+
+  samples.flush()
+  return ranges
+
+
+def write_wav(npy_path, wav_path, frame_rate=FRAME_RATE):
+  import wave
+  samples = np.load(npy_path, mmap_mode='r')
+  with wave.open(wav_path, 'wb') as f:
+    f.setnchannels(samples.shape[1])
+    f.setsampwidth(2)
+    f.setframerate(frame_rate)
+    for start in range(0, len(samples), 60 * frame_rate):
+      f.writeframes(np.ascontiguousarray(samples[start:start + 60 * frame_rate]).tobytes())
+
+
+# Stages: each takes (audio, transmission ranges, input paths, scratch dir). Requirements that
+# can be missing are checked first and reported as a skip.
+
+def stage_energy(audio, ranges, paths, scratch):
+  from audio_utils import audio_energy, nonsilent_from_energy
+  sums, counts = audio_energy(audio)
+  nonsilent_from_energy(sums, counts, audio.sample_width)
+
+
+def stage_transmission_index(audio, ranges, paths, scratch):
+  from transmission_index import index_from_samples
+  index_from_samples(audio.interleaved(), audio.frame_rate, audio.channels, audio.sample_width)
+
+
+def stage_vad(audio, ranges, paths, scratch):
+  from vad import pack_speech
+  pack_speech(audio)
+
+
+def stage_noise_reduction(audio, ranges, paths, scratch):
+  from audio_utils import estimate_noise_profile, pad_ranges, reduce_noise_batch, silent_ranges
+  silence = (audio.frames(start, end)[:, 0] for start, end in silent_ranges(ranges, len(audio)))
+  profile = estimate_noise_profile(silence, audio.frame_rate)
+  chunks = [np.asarray(audio.frames(start, end)[:, 0]) for start, end in pad_ranges(ranges, len(audio), 500)]
+  reduce_noise_batch(chunks, profile)
+
+
+def stage_chunk_audio(audio, ranges, paths, scratch):
+  from audio_utils import chunk_audio
+  from chunk_sink import make_sink
+  chunk_audio(audio, sink=make_sink('files', os.path.join(scratch, 'chunks')))
+
+
+def stage_chunk_audio_store(audio, ranges, paths, scratch):
+  from audio_utils import chunk_audio
+  from chunk_sink import make_sink
+  chunk_audio(audio, sink=make_sink('store', scratch, 'chunks'))
+
+
+def stage_extract(audio, ranges, paths, scratch):
+  """What SpeakerFilter extract does after diarization (re-encoding path), with WAV output"""
+  from audio_utils import gather_frames
+  audio.segment(gather_frames(audio, ranges)).export(os.path.join(scratch, 'extract.wav'), format='wav')
+
+
+def stage_remove(audio, ranges, paths, scratch):
+  """What SpeakerFilter remove does after diarization (re-encoding path), with WAV output"""
+  from audio_utils import gather_frames, silent_ranges
+  kept = silent_ranges(ranges, len(audio))
+  audio.segment(gather_frames(audio, kept)).export(os.path.join(scratch, 'remove.wav'), format='wav')
+
+
+def stage_load_audio(audio, ranges, paths, scratch):
+  from audio_utils import load_audio
+  load_audio(paths['wav'])
+
+
+def stage_diarize(audio, ranges, paths, scratch):
+  from speaker_filter import SpeakerFilter
+  SpeakerFilter(use_cache=False).analyze_speakers(paths['wav'])
+
+
+def _needs_ffmpeg():
+  from pydub.utils import which
+  return None if which('ffmpeg') or which('avconv') else 'ffmpeg not found'
+
+
+def _needs_diarization():
+  import importlib.util
+  for module in ('torch', 'pyannote.audio'):
+    try:
+      if importlib.util.find_spec(module) is None:
+        return f'{module} not installed'
+    except ModuleNotFoundError:
+      return f'{module} not installed'
+  if not os.getenv('HF_TOKEN'):
+    return 'HF_TOKEN not set'
+  return _needs_ffmpeg()
+
+
+STAGES = {
+  'energy': (stage_energy, None),
+  'transmission_index': (stage_transmission_index, None),
+  'vad': (stage_vad, None),
+  'noise_reduction': (stage_noise_reduction, None),
+  'chunk_audio': (stage_chunk_audio, None),
+  'chunk_audio_store': (stage_chunk_audio_store, None),
+  'extract': (stage_extract, None),
+  'remove': (stage_remove, None),
+  'load_audio': (stage_load_audio, _needs_ffmpeg),
+  'diarize': (stage_diarize, _needs_diarization),
+}
+
+
+def _run_stage(name, paths, ranges, scratch):
+  """Run one stage in this (fresh) process and measure it"""
+  from pcm_cache import PCMAudio
+
+  # Keep caches (PCM, noise profiles, ...) out of the user's cache and cold for every run
+  os.environ['LIVEATC_CACHE_DIR'] = os.path.join(scratch, 'cache')
+  audio = PCMAudio(np.load(paths['npy'], mmap_mode='r'), FRAME_RATE, source=paths['wav'])
+  baseline = peak_rss_mb()
+
+  wall, cpu = time.perf_counter(), time.process_time()
+  STAGES[name][0](audio, ranges, paths, scratch)
+  wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+  peak = peak_rss_mb()
+  return {'wall_seconds': wall, 'cpu_seconds': cpu, 'peak_rss_mb': peak,
+          'rss_delta_mb': None if peak is None else peak - baseline}
+
+
+def measure(name, paths, ranges, scratch):
+  """Measure a stage in a new process, so peak RSS belongs to that stage alone"""
+  with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+    return executor.submit(_run_stage, name, paths, ranges, scratch).result()
+
+
+def run(durations, densities, stages, repeat=1, seed=0, log=print):
+  """Benchmark every stage on every (duration, density) recording; returns the results list"""
+  results = []
+  for seconds in durations:
+    for density in densities:
+      scratch = tempfile.mkdtemp(prefix='liveatc-bench-')
+      try:
+        paths = {'npy': os.path.join(scratch, 'input.npy'), 'wav': os.path.join(scratch, 'input.wav')}
+        ranges = synthesize(paths['npy'], seconds, density, seed)
+        write_wav(paths['npy'], paths['wav'])
+        log(f"{seconds}s at {density:.0%} density: {len(ranges)} transmissions")
+
+        for name in stages:
+          result = {'stage': name, 'duration_seconds': seconds, 'density': density,
+                    'transmissions': len(ranges), 'status': 'ok', 'reason': ''}
+          check = STAGES[name][1]
+          reason = check() if check else None
+          if reason:
+            result.update(status='skipped', reason=reason)
+            log(f"  {name:<20} skipped ({reason})")
+            results.append(result)
+            continue
+
+          try:
+            runs = [measure(name, paths, ranges, scratch) for _ in range(repeat)]
+          except Exception as e:
+            result.update(status='error', reason=str(e))
+            log(f"  {name:<20} failed: {e}")
+            results.append(result)
+            continue
+
+          walls = [r['wall_seconds'] for r in runs]
+          best = runs[int(np.argmin(walls))]
+          peaks = [r['peak_rss_mb'] for r in runs if r['peak_rss_mb'] is not None]
+          result.update(
+            wall_seconds=best['wall_seconds'],
+            wall_seconds_all=walls,
+            cpu_seconds=best['cpu_seconds'],
+            realtime_factor=seconds / max(best['wall_seconds'], 1e-9),
+            peak_rss_mb=max(peaks) if peaks else None,
+            rss_delta_mb=best['rss_delta_mb'],
+          )
+          rss = f"{result['peak_rss_mb']:.0f} MiB peak" if peaks else 'peak RSS n/a'
+          log(f"  {name:<20} {result['wall_seconds']:8.3f}s  {result['realtime_factor']:8.0f}x realtime  {rss}")
+          results.append(result)
+      finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+  return results
+
+
+def environment():
+  return {
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'machine': platform.machine(),
+    'cpu_count': os.cpu_count(),
+    'numpy': np.__version__,
+  }
+
+
+def compare(results, baseline):
+  """Print wall-time ratios against a previous results file"""
+  previous = {(r['stage'], r['duration_seconds'], r['density']): r for r in baseline['results']}
+  print(f"\n{'stage':<20} {'duration':>8} {'density':>7} {'before s':>10} {'after s':>10} {'speedup':>8}")
+  for result in results:
+    before = previous.get((result['stage'], result['duration_seconds'], result['density']))
+    if result['status'] != 'ok' or not before or before['status'] != 'ok':
+      continue
+    print(f"{result['stage']:<20} {result['duration_seconds']:>8} {result['density']:>7.0%} "
+          f"{before['wall_seconds']:>10.3f} {result['wall_seconds']:>10.3f} "
+          f"{before['wall_seconds'] / max(result['wall_seconds'], 1e-9):>7.2f}x")
+
+
+def main():
+  import argparse
+
+  parser = argparse.ArgumentParser(description='Benchmark the audio stages on synthetic ATC recordings')
+  parser.add_argument('--durations', type=float, nargs='+', default=DEFAULT_DURATIONS,
+                      help=f'Recording lengths in seconds (default: {" ".join(map(str, DEFAULT_DURATIONS))})')
+  parser.add_argument('--densities', type=float, nargs='+', default=DEFAULT_DENSITIES,
+                      help=f'Fractions of time with a transmission (default: {" ".join(map(str, DEFAULT_DENSITIES))})')
+  parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES),
+                      help='Stages to run (default: all)')
+  parser.add_argument('--repeat', type=int, default=1, help='Runs per measurement, the fastest is reported (default: 1)')
+  parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic recordings (default: 0)')
+  parser.add_argument('-o', '--output', help='Write results as JSON to this file')
+  parser.add_argument('--compare', help='Previous JSON results to compare against')
+  args = parser.parse_args()
+
+  durations = [int(d) if float(d).is_integer() else d for d in args.durations]
+  results = run(durations, args.densities, args.stages, repeat=args.repeat, seed=args.seed)
+
+  report = {
+    'benchmark_version': BENCHMARK_VERSION,
+    'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+    'environment': environment(),
+    'config': {'durations': durations, 'densities': args.densities, 'stages': args.stages,
+               'repeat': args.repeat, 'seed': args.seed, 'frame_rate': FRAME_RATE},
+    'results': results,
+  }
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+  if args.compare:
+    with open(args.compare) as f:
+      compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+  main()
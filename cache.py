@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+
+
+# Root directory for everything we cache on disk (noise profiles, indexes, ...)
+# Override with LIVEATC_CACHE_DIR, e.g. to put caches on a scratch volume
+def get_cache_dir(*parts):
+  root = os.getenv('LIVEATC_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'liveatc-downloader')
+  path = os.path.join(root, *parts)
+  os.makedirs(path, exist_ok=True)
+  return path
+
+
+def safe_key(key):
+  """Turn an arbitrary key (station, frequency, ...) into a safe file name"""
+  return ''.join(c if c.isalnum() or c in '-_.' else '_' for c in str(key))
+
+
+_hash_memo = {}
+
+
+def _stat_memo_path(path):
+  name = hashlib.blake2b(os.path.abspath(path).encode(), digest_size=16).hexdigest()
+  return os.path.join(get_cache_dir('file_hashes'), f'{name}.json')
+
+
+def file_hash(path, chunk_size=1 << 20):
+  """Content hash of a file, memoized per (path, size, mtime)
+
+  The memo is kept on disk as well, so a cache lookup on an unchanged file costs a stat and
+  a small read instead of reading the whole file; it is only hashed again when its size or
+  mtime changes.
+  """
+  stat = os.stat(path)
+  memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+  if memo_key in _hash_memo:
+    return _hash_memo[memo_key]
+
+  memo_path = _stat_memo_path(path)
+  try:
+    with open(memo_path) as f:
+      memo = json.load(f)
+    if (memo['size'], memo['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+      _hash_memo[memo_key] = memo['hash']
+      return memo['hash']
+  except (OSError, ValueError, KeyError, TypeError):
+    pass
+
+  digest = hashlib.blake2b(digest_size=16)
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(chunk_size), b''):
+      digest.update(block)
+
+  _hash_memo[memo_key] = digest.hexdigest()
+  try:
+    part_path = f'{memo_path}.{os.getpid()}.part'
+    with open(part_path, 'w') as f:
+      json.dump({'path': memo_key[0], 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                 'hash': _hash_memo[memo_key]}, f)
+    os.replace(part_path, memo_path)
+  except OSError:
+    pass
+  return _hash_memo[memo_key]
+
+
+def params_key(**params):
+  """Short stable key for a set of parameters"""
+  text = ','.join(f'{name}={params[name]!r}' for name in sorted(params))
+  return hashlib.blake2b(text.encode(), digest_size=6).hexdigest()
@@ -0,0 +1,295 @@
+import json
+import os
+import queue
+import subprocess
+import threading
+import wave
+
+import numpy as np
+from pydub.utils import get_encoder_name
+
+from pcm_cache import PCMAudio
+
+
+# The two versions of every chunk chunk_audio writes
+KINDS = ('orig', 'nr')
+
+# Chunks waiting for the writer thread before chunk_audio blocks (bounds memory)
+MAX_PENDING_CHUNKS = 16
+
+
+class WavFilesSink:
+  """One WAV per chunk and kind: chunk-{i}-orig.wav, chunk-{i}-nr.wav (the original layout)
+
+  Every sink has open(), write() and close(), plus abort() for a run that failed partway:
+  sinks with a finished-output marker (index, container) must not leave one behind.
+  """
+
+  def __init__(self, directory='/tmp/chunks'):
+    self.directory = directory
+
+  def open(self, frame_rate, channels, dtype):
+    os.makedirs(self.directory, exist_ok=True)
+    self.frame_rate = frame_rate
+    self.dtype = np.dtype(dtype)
+
+  def write(self, index, kind, start_ms, end_ms, frames):
+    with wave.open(os.path.join(self.directory, f'chunk-{index}-{kind}.wav'), 'wb') as f:
+      f.setnchannels(frames.shape[1])
+      f.setsampwidth(self.dtype.itemsize)
+      f.setframerate(self.frame_rate)
+      f.writeframes(np.ascontiguousarray(frames).tobytes())
+
+  def close(self):
+    pass
+
+  def abort(self):
+    # Chunks already written are complete files on their own
+    pass
+
+
+class _WavStream:
+  def __init__(self, path, frame_rate, channels, sample_width):
+    self.path = path
+    self.file = wave.open(path, 'wb')
+    self.file.setnchannels(channels)
+    self.file.setsampwidth(sample_width)
+    self.file.setframerate(frame_rate)
+
+  def write(self, data):
+    self.file.writeframes(data)
+
+  def close(self):
+    self.file.close()
+
+  def abort(self):
+    self.file.close()
+    os.remove(self.path)
+
+
+class _FFmpegStream:
+  """Raw PCM piped into an ffmpeg encoder (FLAC, ...)"""
+
+  def __init__(self, path, frame_rate, channels, sample_width):
+    self.path = path
+    command = [get_encoder_name(), '-nostdin', '-v', 'error', '-y',
+               '-f', f's{8 * sample_width}le', '-ar', str(frame_rate), '-ac', str(channels), '-i', '-', path]
+    self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+  def write(self, data):
+    self.process.stdin.write(data)
+
+  def close(self):
+    self.process.stdin.close()
+    stderr = self.process.stderr.read()
+    if self.process.wait() != 0:
+      raise RuntimeError(f'ffmpeg failed to write {self.path}: {stderr.decode(errors="replace").strip()}')
+
+  def abort(self):
+    self.process.kill()
+    self.process.wait()
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+
+class ArchiveSink:
+  """All chunks of a recording in one audio file per kind, plus a segment index
+
+  Writes {name}-orig.{format} and {name}-nr.{format} with the chunks back to back, and
+  {name}.segments.json listing where every chunk came from in the source (ms) and where it
+  is in the output files (frames). WAV is written directly, other formats through ffmpeg.
+  """
+
+  def __init__(self, directory, name, format='wav'):
+    self.directory = directory
+    self.name = name
+    self.format = format
+    self.segments = []
+    self.position = 0
+    self.streams = {}
+
+  def path(self, kind):
+    return os.path.join(self.directory, f'{self.name}-{kind}.{self.format}')
+
+  @property
+  def index_path(self):
+    return os.path.join(self.directory, f'{self.name}.segments.json')
+
+  def open(self, frame_rate, channels, dtype):
+    os.makedirs(self.directory, exist_ok=True)
+    self.frame_rate = frame_rate
+    self.channels = channels
+    stream = _WavStream if self.format == 'wav' else _FFmpegStream
+    self.streams = {kind: stream(self.path(kind), frame_rate, channels, np.dtype(dtype).itemsize) for kind in KINDS}
+
+  def write(self, index, kind, start_ms, end_ms, frames):
+    self.streams[kind].write(np.ascontiguousarray(frames).tobytes())
+    if kind == KINDS[0]:
+      # Both kinds of a chunk have the same length, so one entry covers both files
+      self.segments.append([index, start_ms, end_ms, self.position, len(frames)])
+      self.position += len(frames)
+
+  def abort(self):
+    """Remove the partial output files and write no segment index"""
+    for stream in self.streams.values():
+      try:
+        stream.abort()
+      except OSError:
+        pass
+
+  def close(self):
+    for stream in self.streams.values():
+      stream.close()
+    with open(self.index_path, 'w') as f:
+      json.dump({
+        'frame_rate': self.frame_rate,
+        'channels': self.channels,
+        'files': {kind: os.path.basename(self.path(kind)) for kind in KINDS},
+        'columns': ['chunk', 'source_start_ms', 'source_end_ms', 'first_frame', 'frames'],
+        'segments': self.segments,
+      }, f)
+
+
+class ChunkStore:
+  """Every chunk in a single container file with an offset table
+
+  Layout: a JSON header line (format, frame rate, channels, dtype), the raw PCM of every
+  chunk, then the offset table as a .npy array and its byte offset in the last 8 bytes.
+  Table rows are (chunk, kind, source start ms, source end ms, byte offset, frames), with
+  kind an index into KINDS. Read chunks back with ChunkStore.open_store(path).chunk(i, kind).
+  """
+
+  MAGIC = 'liveatc-chunk-store'
+  VERSION = 1
+
+  def __init__(self, path):
+    self.path = path
+    self.rows = []
+    self.file = None
+    self.table = None
+
+  def open(self, frame_rate, channels, dtype):
+    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+    self.frame_rate = frame_rate
+    self.channels = channels
+    self.dtype = np.dtype(dtype)
+    self.file = open(self.path + '.part', 'wb')
+    header = {'format': self.MAGIC, 'version': self.VERSION, 'frame_rate': frame_rate, 'channels': channels,
+              'dtype': self.dtype.str}
+    self.file.write(json.dumps(header).encode() + b'\n')
+
+  def write(self, index, kind, start_ms, end_ms, frames):
+    data = np.ascontiguousarray(frames, dtype=self.dtype).tobytes()
+    self.rows.append((index, KINDS.index(kind), start_ms, end_ms, self.file.tell(), len(frames)))
+    self.file.write(data)
+
+  def close(self):
+    table_offset = self.file.tell()
+    np.save(self.file, np.array(self.rows, dtype=np.int64).reshape(-1, 6))
+    self.file.write(table_offset.to_bytes(8, 'little'))
+    self.file.close()
+    os.replace(self.path + '.part', self.path)
+
+  def abort(self):
+    """Drop the unfinished container instead of moving it into place"""
+    if self.file is not None:
+      self.file.close()
+      os.remove(self.path + '.part')
+
+  @classmethod
+  def open_store(cls, path):
+    """Open a finished container for reading"""
+    store = cls(path)
+    with open(path, 'rb') as f:
+      header = json.loads(f.readline())
+      if header.get('format') != cls.MAGIC:
+        raise ValueError(f'{path} is not a chunk store')
+      f.seek(-8, os.SEEK_END)
+      table_offset = int.from_bytes(f.read(8), 'little')
+      f.seek(table_offset)
+      store.table = np.load(f)
+    store.frame_rate = header['frame_rate']
+    store.channels = header['channels']
+    store.dtype = np.dtype(header['dtype'])
+    return store
+
+  def __len__(self):
+    return int(self.table[:, 0].max()) + 1 if len(self.table) else 0
+
+  def chunk(self, index, kind='orig'):
+    """One chunk as PCMAudio, memory-mapped from the container"""
+    row = self.table[(self.table[:, 0] == index) & (self.table[:, 1] == KINDS.index(kind))]
+    if not len(row):
+      raise KeyError(f'No chunk {index} ({kind}) in {self.path}')
+    _, _, _, _, offset, frames = (int(v) for v in row[0])
+    samples = np.memmap(self.path, dtype=self.dtype, mode='r', offset=offset, shape=(frames, self.channels))
+    return PCMAudio(samples, self.frame_rate, source=self.path)
+
+
+class BackgroundWriter:
+  """Runs a sink's writes on a separate thread so encoding and disk I/O overlap processing
+
+  write() only blocks when MAX_PENDING_CHUNKS chunks are waiting. An error in the writer
+  thread is raised from the next write() or from close(), after aborting the sink; call
+  abort() instead of close() when the producer fails.
+  """
+
+  def __init__(self, sink, max_pending=MAX_PENDING_CHUNKS):
+    self.sink = sink
+    self.queue = queue.Queue(maxsize=max_pending)
+    self.error = None
+    self.aborted = False
+    self.thread = None
+
+  def open(self, frame_rate, channels, dtype):
+    self.sink.open(frame_rate, channels, dtype)
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  def _run(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+      if self.error is None and not self.aborted:
+        try:
+          self.sink.write(*item)
+        except BaseException as e:
+          self.error = e
+
+  def _check(self):
+    if self.error is not None:
+      raise self.error
+
+  def write(self, index, kind, start_ms, end_ms, frames):
+    self._check()
+    self.queue.put((index, kind, start_ms, end_ms, frames))
+
+  def _stop(self):
+    self.queue.put(None)
+    self.thread.join()
+
+  def close(self):
+    self._stop()
+    if self.error is not None:
+      self.sink.abort()
+      raise self.error
+    self.sink.close()
+
+  def abort(self):
+    """Stop writing and discard the sink's unfinished output"""
+    # Whatever is still queued is skipped
+    self.aborted = True
+    self._stop()
+    self.sink.abort()
+
+
+def make_sink(kind, output, name=None, format='wav'):
+  """Sink by name: 'files' (one WAV per chunk), 'archive' (one file per kind + index) or 'store' (container)"""
+  if kind == 'files':
+    return WavFilesSink(output)
+  if kind == 'archive':
+    return ArchiveSink(output, name or 'chunks', format)
+  if kind == 'store':
+    return ChunkStore(os.path.join(output, f'{name or "chunks"}.chunks'))
+  raise ValueError(f'Unknown chunk sink {kind!r}, expected files, archive or store')
@@ -1,12 +1,24 @@
 import argparse
 import sys
 
+
+def non_negative_int(value):
+  number = int(value)
+  if number < 0:
+    raise argparse.ArgumentTypeError(f'must be 0 or more, got {number}')
+  return number
+
+
 parser = argparse.ArgumentParser()
+parser.add_argument('--profile', metavar='REPORT', help='Write a profile (stage timings, top functions) to this file')
+parser.add_argument('--profile-memory', action='store_true', help='With --profile, also trace memory allocations (slows the run down)')
 
 commands = parser.add_subparsers(title='command', dest='command')
 
 parser_stations = commands.add_parser('stations', help='List stations for a given airport')
-parser_stations.add_argument('icao', help='Airport ICAO code, e.g. KPDX')
+parser_stations.add_argument('icao', nargs='*', help='Airport ICAO code(s), e.g. KPDX; results are also saved to the local station directory')
+parser_stations.add_argument('-s', '--search', help='Search the local station directory instead, by ICAO, city, facility or frequency, e.g. "portland tower" or 118.7')
+parser_stations.add_argument('-d', '--delay', type=float, default=2.0, help='Delay in seconds between airports when looking up several (default: 2)')
 
 parser_download = commands.add_parser('download', help='Download MP3 archive for a given station')
 parser_download.add_argument('station', help='Station identifier, e.g. kpdx_app')
@@ -14,12 +26,55 @@ parser_download.add_argument('-d', '--date', help='Archive date, e.g. Oct-01-202
 parser_download.add_argument('-t', '--time', help='Archive Zulu time, e.g. 0000Z, defaults to current time')
 
 parser_download_range = commands.add_parser('download-range', help='Download MP3 archives for a date/time range')
-parser_download_range.add_argument('station', help='Station identifier, e.g. kpdx_app')
-parser_download_range.add_argument('start', help='Start date and time, e.g. Dec-10-2025-0000Z')
+parser_download_range.add_argument('station', nargs='?', help='Station identifier, e.g. kpdx_app (optional with --worker)')
+parser_download_range.add_argument('start', nargs='?', help='Start date and time, e.g. Dec-10-2025-0000Z (optional with --worker)')
 parser_download_range.add_argument('-e', '--end', help='End date and time, e.g. Dec-11-2025-1500Z (defaults to now)')
 parser_download_range.add_argument('-d', '--delay', type=float, default=10.0, help='Delay in seconds between downloads to avoid rate-limiting (default: 10)')
+parser_download_range.add_argument('--stdout', action='store_true', help='Write one continuous MP3 stream to stdout instead of saving files')
+parser_download_range.add_argument('--prefetch', type=non_negative_int, default=2, help='With --stdout, number of upcoming archives downloaded in the background (default: 2)')
+parser_download_range.add_argument('--queue', help='Shared job queue database, e.g. on storage all workers can reach (defaults to one in the cache directory)')
+parser_download_range.add_argument('--enqueue', action='store_true', help='Add the range to the job queue and exit, for --worker processes to download')
+parser_download_range.add_argument('--worker', action='store_true', help='Download tasks from the job queue until it is empty (after queueing the range, if one is given)')
+parser_download_range.add_argument('--status', action='store_true', help='Show the job queue, download rate and intervals at risk of expiring before they are downloaded')
+parser_download_range.add_argument('--worker-id', help='Name of this worker in the queue (defaults to host name and process ID)')
+parser_download_range.add_argument('-o', '--output-dir', help='With --worker, directory to move downloaded archives to (defaults to the temp directory)')
+parser_download_range.add_argument('--lease', type=float, default=300, help='With --worker, seconds without a heartbeat before a task is handed to another worker (default: 300)')
+
+parser_clip = commands.add_parser('clip', help='Download an arbitrary UTC time range as one file')
+parser_clip.add_argument('station', help='Station identifier, e.g. kjfk_twr')
+parser_clip.add_argument('start', help='Start date and time, e.g. Dec-10-2025-1407Z or Dec-10-2025-140730Z')
+parser_clip.add_argument('end', help='End date and time, e.g. Dec-10-2025-1412Z')
+parser_clip.add_argument('-o', '--output', help='Output file, or - for stdout (defaults to a file in the download directory)')
+parser_clip.add_argument('-f', '--format', default='mp3', help='Output format (default: mp3)')
+
+parser_analytics = commands.add_parser('analytics', help='Channel activity report (transmissions per minute, occupancy, gaps) for downloaded archives')
+parser_analytics.add_argument('directory', nargs='?', help='Directory of archives, searched recursively (defaults to the download directory)')
+parser_analytics.add_argument('-s', '--station', help='Only archives whose identifier starts with this, e.g. KPDX3-Twr')
+parser_analytics.add_argument('-w', '--workers', type=int, help='Number of parallel worker processes (defaults to CPU count)')
+parser_analytics.add_argument('--csv', help='Write per-minute activity to a CSV file')
+parser_analytics.add_argument('--npz', help='Write station x day x minute matrices to a NumPy .npz file')
+parser_analytics.add_argument('--silence-thresh', type=int, default=-48, help='Level in dBFS below which audio counts as silence (default: -48)')
+
+parser_waveform = commands.add_parser('waveform', help='Build min/max/RMS waveform overviews of downloaded archives and export one for a time span')
+parser_waveform.add_argument('directory', nargs='?', help='Directory of archives, searched recursively (defaults to the download directory)')
+parser_waveform.add_argument('-s', '--station', help='Only archives whose identifier starts with this, e.g. KPDX3-Twr')
+parser_waveform.add_argument('-w', '--workers', type=int, help='Number of parallel worker processes (defaults to CPU count)')
+parser_waveform.add_argument('--json', help='Write an overview of all matching archives (one value per pixel) to a JSON file')
+parser_waveform.add_argument('--pixels', type=int, default=1920, help='Width of the --json overview (default: 1920)')
+parser_waveform.add_argument('--start', help='Start of the --json overview, e.g. Dec-10-2025-0000Z (defaults to the first archive)')
+parser_waveform.add_argument('--end', help='End of the --json overview, e.g. Dec-11-2025-0000Z (defaults to the end of the last archive)')
+
+parser_verify = commands.add_parser('verify', help='Check downloaded archives for truncated or corrupt files')
+parser_verify.add_argument('directory', nargs='?', help='Directory to check recursively (defaults to the download directory)')
+parser_verify.add_argument('-w', '--workers', type=int, help='Number of parallel worker processes (defaults to CPU count)')
+parser_verify.add_argument('--remote', action='store_true', help='Also compare file sizes against the server (one HEAD request per archive)')
+parser_verify.add_argument('--repair', action='store_true', help='Download failed archives again')
+parser_verify.add_argument('-d', '--delay', type=float, default=10.0, help='Delay in seconds between repair downloads (default: 10)')
 
 
 
 def get_args():
-  return parser.parse_args(sys.argv[1:])
+  args = parser.parse_args(sys.argv[1:])
+  if args.command == 'stations' and not args.icao and not args.search:
+    parser_stations.error('give one or more ICAO codes, or --search')
+  return args
@@ -0,0 +1,143 @@
+import io
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from liveatc import archive_url, fetch_range, get_archive_identifier
+from mp3_frames import decode_samples, scan_frames, stream_info
+from pcm_cache import PCMAudio
+from timeline import ARCHIVE_LENGTH
+
+
+# Bytes fetched first to read the archive's ID3 tag and frame format
+PROBE_BYTES = 16384
+
+# Extra audio fetched on both sides of a clip: absorbs frame alignment, the Layer III bit
+# reservoir and small differences between the nominal and actual bitrate
+CLIP_MARGIN_SECONDS = 2.0
+
+
+def parse_clip_time(text):
+  """Parse Dec-10-2025-1407Z or Dec-10-2025-140730Z"""
+  for fmt in ('%b-%d-%Y-%H%M%SZ', '%b-%d-%Y-%H%MZ'):
+    try:
+      return datetime.strptime(text, fmt)
+    except ValueError:
+      pass
+  raise ValueError(f'Invalid time {text!r}, expected e.g. Dec-10-2025-1407Z or Dec-10-2025-140730Z')
+
+
+def archive_start(date):
+  """Start of the 30-minute archive holding a UTC time"""
+  return date - (date - datetime.min) % ARCHIVE_LENGTH
+
+
+def covering_archives(start, end):
+  """(archive start, seconds into it where the clip starts, seconds where it ends) for every archive a clip spans"""
+  spans = []
+  current = archive_start(start)
+  while current < end:
+    spans.append((current,
+                   max((start - current).total_seconds(), 0),
+                   min((end - current).total_seconds(), ARCHIVE_LENGTH.total_seconds())))
+    current += ARCHIVE_LENGTH
+  return spans
+
+
+def fetch_archive_span(url, start_seconds, end_seconds):
+  """(frames, channels) samples between two offsets into an archive, and its sample rate
+
+  Uses HTTP Range requests sized from the archive's bitrate to download only the bytes
+  around the span (LiveATC archives are CBR), falling back to the whole file when the
+  server doesn't support ranges.
+  """
+  head, partial = fetch_range(url, 0, PROBE_BYTES - 1)
+  info = stream_info(head)
+  if info is None:
+    raise ValueError(f'{url} is not an MP3 archive')
+
+  if not partial:
+    # The server sent the whole archive
+    data, first_byte = head, 0
+  else:
+    bytes_per_second = info['bitrate'] / 8
+    first_byte = info['data_start'] + int(max(start_seconds - CLIP_MARGIN_SECONDS, 0) * bytes_per_second)
+    last_byte = info['data_start'] + int((end_seconds + CLIP_MARGIN_SECONDS) * bytes_per_second)
+    data, partial = fetch_range(url, first_byte, last_byte)
+    if not partial:
+      first_byte = 0
+
+  fd, path = tempfile.mkstemp(suffix='.mp3')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      f.write(data)
+    frames = scan_frames(path)
+
+    rate = frames.sample_rate
+    if first_byte:
+      # Index of the first whole frame we got, counted from the start of the archive
+      frame_bytes = frames.samples_per_frame / 8 * info['bitrate'] / rate
+      first_frame = round((first_byte + int(frames.offsets[0]) - info['data_start']) / frame_bytes)
+      origin = first_frame * frames.samples_per_frame - info['skip_samples']
+    else:
+      origin = 0
+
+    samples = decode_samples(path, int(start_seconds * rate) - origin, int(end_seconds * rate) - origin, frames)
+    return samples, rate
+  finally:
+    os.remove(path)
+
+
+def clip(station, start, end, output=None, format='mp3'):
+  """Audio of a station between two arbitrary UTC times, fetching only what is needed
+
+  Archives that can't be fetched are filled with silence. Writes to output (a path or a
+  binary file object), by default a file in the temp directory, and returns it.
+  """
+  if end <= start:
+    raise ValueError('Clip end must be after its start')
+
+  identifier = get_archive_identifier(station)
+  pieces = []
+  rate = channels = None
+  failed = []
+
+  for archive, start_seconds, end_seconds in covering_archives(start, end):
+    url = archive_url(station, archive.strftime('%b-%d-%Y'), archive.strftime('%H%MZ'), identifier)
+    print(f"Fetching {end_seconds - start_seconds:.0f}s of {url}")
+    try:
+      samples, rate = fetch_archive_span(url, start_seconds, end_seconds)
+      channels = samples.shape[1]
+      pieces.append((end_seconds - start_seconds, samples))
+    except Exception as e:
+      print(f"  [FAIL] {e}")
+      failed.append(archive)
+      pieces.append((end_seconds - start_seconds, None))
+
+  if rate is None:
+    raise Exception(f"No archives could be fetched for {start} - {end}")
+
+  # Missing archives (and short reads) keep their place in the clip as silence
+  parts = []
+  for seconds, samples in pieces:
+    length = int(round(seconds * rate))
+    part = np.zeros((length, channels), dtype='<i2')
+    if samples is not None:
+      part[:min(length, len(samples))] = samples[:length]
+    parts.append(part)
+
+  audio = PCMAudio(np.concatenate(parts), rate)
+  if output is None:
+    name = f"{identifier}-{start:%b-%d-%Y-%H%M%S}Z-{int((end - start).total_seconds())}s.{format}"
+    output = os.path.join(tempfile.gettempdir(), name)
+
+  segment = audio.segment(audio.samples)
+  if isinstance(output, (str, os.PathLike)):
+    segment.export(output, format=format)
+  else:
+    buffer = io.BytesIO()
+    segment.export(buffer, format=format)
+    output.write(buffer.getvalue())
+  return output
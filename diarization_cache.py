@@ -0,0 +1,72 @@
+"""
+Content-addressed cache of speaker diarization results.
+
+A diarization is keyed by the audio content hash, the pipeline name/version and its
+parameters, so a recording is diarized once no matter which command (or path) uses it.
+"""
+
+import hashlib
+import json
+import os
+from typing import List, Optional, Tuple
+
+from cache import get_cache_dir, file_hash
+
+CACHE_VERSION = 1
+
+Track = Tuple[float, float, str]
+
+
+def source_key(source) -> Optional[str]:
+    """Content key for a file path or ArchiveTimeline (None if it can't be keyed)"""
+    if isinstance(source, (str, os.PathLike)):
+        return file_hash(str(source))
+
+    archives = getattr(source, 'archives', None)
+    if archives is not None:
+        # A timeline is identified by its archives' content and the window read from them
+        parts = [file_hash(path) for _, path in archives]
+        parts += [source.start.isoformat(), source.end.isoformat()]
+        return hashlib.blake2b(' '.join(parts).encode(), digest_size=16).hexdigest()
+
+    return None
+
+
+def cache_key(source, pipeline_name: str, pipeline_version: str, params: dict) -> Optional[str]:
+    content = source_key(source)
+    if content is None:
+        return None
+
+    text = json.dumps({
+        'cache_version': CACHE_VERSION,
+        'content': content,
+        'pipeline': pipeline_name,
+        'version': pipeline_version,
+        'params': params,
+    }, sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+class DiarizationCache:
+    """Stores diarization tracks as small JSON files in the cache directory"""
+
+    def __init__(self, cache_dir: Optional[str] = None):
+        self.cache_dir = cache_dir or get_cache_dir('diarization')
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def get(self, key: Optional[str]) -> Optional[List[Track]]:
+        if key is None or not os.path.exists(self.path(key)):
+            return None
+        with open(self.path(key)) as f:
+            return [tuple(track) for track in json.load(f)['tracks']]
+
+    def put(self, key: Optional[str], tracks: List[Track]):
+        if key is None:
+            return
+        # Write then rename so concurrent workers never read a partial file
+        part_path = self.path(key) + f'.{os.getpid()}.part'
+        with open(part_path, 'w') as f:
+            json.dump({'tracks': [list(track) for track in tracks]}, f, separators=(',', ':'))
+        os.replace(part_path, self.path(key))
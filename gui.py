@@ -7,6 +7,8 @@ import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from queue import Queue
 from liveatc import get_stations, download_archive
+from profiling import profile_session, thread_profile
+from station_directory import StationDirectory
 import os
 import time
 
@@ -235,6 +237,9 @@ class LiveATCDownloaderGUI:
         self.failed_intervals = []  # Failed downloads with error info
         self.download_params = None  # Store download parameters for resume
 
+        # Stations found in earlier searches, for instant typeahead
+        self.station_directory = StationDirectory()
+
         self.create_widgets()
         
     def create_widgets(self):
@@ -249,7 +254,7 @@ class LiveATCDownloaderGUI:
         
         # ===== AIRPORT SEARCH =====
         row = 0
-        ttk.Label(main_frame, text="Airport ICAO Code:", font=('Arial', 10, 'bold')).grid(
+        ttk.Label(main_frame, text="Airport ICAO Code (or type to search known stations):", font=('Arial', 10, 'bold')).grid(
             row=row, column=0, sticky=tk.W, pady=(0, 5))
         
         row += 1
@@ -260,6 +265,7 @@ class LiveATCDownloaderGUI:
         self.icao_entry = ttk.Entry(search_frame, font=('Arial', 10))
         self.icao_entry.grid(row=0, column=0, sticky=(tk.W, tk.E), padx=(0, 5))
         self.icao_entry.bind('<Return>', lambda e: self.search_stations())
+        self.icao_entry.bind('<KeyRelease>', self._typeahead)
         
         self.search_btn = ttk.Button(search_frame, text="Search Stations", command=self.search_stations)
         self.search_btn.grid(row=0, column=1)
@@ -491,28 +497,57 @@ class LiveATCDownloaderGUI:
     def _search_stations_thread(self, icao):
         """Background thread for station search"""
         try:
-            stations = list(get_stations(icao))
+            with thread_profile():
+                stations = list(get_stations(icao))
             self.stations_data = stations
             
             # Update UI in main thread
-            self.root.after(0, self._update_stations_list, stations)
+            self.root.after(0, self._update_stations_list, stations, icao)
         except Exception as e:
             self.root.after(0, self._search_error, str(e))
             
-    def _update_stations_list(self, stations):
-        """Update stations listbox with results"""
+    def _typeahead(self, event):
+        """Show matching stations from the local directory while typing"""
+        if event.keysym in ('Return', 'Up', 'Down', 'Left', 'Right', 'Tab'):
+            return
+        query = self.icao_entry.get().strip()
+        if len(query) < 2 or not len(self.station_directory):
+            return
+
+        stations = self.station_directory.search(query)
+        self.stations_data = stations
+        self._show_stations(stations)
+        if stations:
+            self.set_status(f"{len(stations)} known station(s) matching '{query}' - press Enter to search LiveATC")
+
+    def _show_stations(self, stations):
+        """Fill the stations listbox"""
         self.stations_listbox.delete(0, tk.END)
-        
+
         if not stations:
             self.stations_listbox.insert(tk.END, "No stations found")
-            self.set_status("No stations found")
         else:
             for station in stations:
                 status = "●" if station['up'] else "○"
                 display = f"{status} [{station['identifier']}] - {station['title']}"
                 self.stations_listbox.insert(tk.END, display)
+
+    def _update_stations_list(self, stations, icao):
+        """Update stations listbox with results"""
+        self._show_stations(stations)
+
+        if not stations:
+            self.set_status("No stations found")
+        else:
             self.set_status(f"Found {len(stations)} station(s)")
-            
+
+            # Remember them for typeahead
+            try:
+                self.station_directory.update(icao, stations)
+                self.station_directory.save()
+            except OSError as e:
+                self.log(f"Could not save station directory: {e}")
+
         self.search_btn.config(state='normal')
         
     def _search_error(self, error):
@@ -729,7 +764,8 @@ class LiveATCDownloaderGUI:
 
             try:
                 # Download to temp location first
-                filepath = download_archive(station['identifier'], date_str, time_str)
+                with thread_profile():
+                    filepath = download_archive(station['identifier'], date_str, time_str)
 
                 # Move to output folder
                 filename = os.path.basename(filepath)
@@ -954,9 +990,19 @@ class LiveATCDownloaderGUI:
 
 
 def main():
-    root = tk.Tk()
-    app = LiveATCDownloaderGUI(root)
-    root.mainloop()
+    import argparse
+
+    parser = argparse.ArgumentParser(description='LiveATC Downloader GUI')
+    parser.add_argument('--profile', metavar='REPORT',
+                        help='Write a profile (stage timings, top functions) to this file on exit')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='With --profile, also trace memory allocations (slows the run down)')
+    args = parser.parse_args()
+
+    with profile_session(args.profile, args.profile_memory):
+        root = tk.Tk()
+        app = LiveATCDownloaderGUI(root)
+        root.mainloop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,319 @@
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from cache import get_cache_dir
+from liveatc import download_archive
+
+
+# A worker that hasn't renewed its lease for this long is presumed dead and its task is handed out again
+DEFAULT_LEASE_SECONDS = 300
+
+# Give up on a task after this many failed attempts (404s fail immediately)
+MAX_ATTEMPTS = 3
+
+# LiveATC deletes archives after about 30 days
+RETENTION = timedelta(days=30)
+
+# Throughput used for the at-risk estimate is measured over this many recent seconds
+THROUGHPUT_WINDOW = 3600
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+  id INTEGER PRIMARY KEY,
+  station TEXT NOT NULL,
+  start TEXT NOT NULL,
+  status TEXT NOT NULL DEFAULT 'pending',
+  worker TEXT,
+  lease_expires REAL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  error TEXT,
+  path TEXT,
+  updated REAL,
+  UNIQUE (station, start)
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_expires);
+CREATE INDEX IF NOT EXISTS tasks_start ON tasks (start);
+'''
+
+
+def default_queue_path():
+  return os.path.join(get_cache_dir('queue'), 'jobs.sqlite')
+
+
+def utc_now():
+  return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def expires_at(start):
+  """When LiveATC is expected to delete the archive starting at a UTC time"""
+  return start + RETENTION
+
+
+def worker_name():
+  return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class JobQueue:
+  """Download tasks (station, 30-minute interval) shared by worker processes through SQLite
+
+  Workers lease one task at a time and must renew the lease while they work on it; a task
+  whose lease runs out (the worker crashed or lost its host) goes back to the queue. The
+  database can live on storage shared between hosts, as long as it supports file locks.
+
+  Tasks are handed out oldest archive first across all stations and ranges, since those
+  are the first LiveATC deletes; tasks past retention, or too close to it to be finished
+  at the measured rate, are marked 'expired' rather than spending a worker on them.
+  """
+
+  def __init__(self, path=None, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+    self.path = path or default_queue_path()
+    self.lease_seconds = lease_seconds
+    self.max_attempts = max_attempts
+    # Rollback journal rather than WAL: WAL needs shared memory, which doesn't work across hosts
+    self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+    self.db.row_factory = sqlite3.Row
+    self.lock = threading.Lock()
+    with self.lock:
+      self.db.executescript(SCHEMA)
+
+  def _transaction(self, sql, params=()):
+    # BEGIN IMMEDIATE takes the write lock up front so two workers can't claim the same task
+    with self.lock:
+      self.db.execute('BEGIN IMMEDIATE')
+      try:
+        result = self.db.execute(sql, params)
+        rows = result.fetchall()
+        self.db.execute('COMMIT')
+        return rows, result.rowcount
+      except BaseException:
+        self.db.execute('ROLLBACK')
+        raise
+
+  def add(self, station, start, end):
+    """Queue every 30-minute interval of a station from start to end; returns how many were new"""
+    rows = []
+    current = start
+    while current <= end:
+      rows.append((station, current.strftime(TIME_FORMAT), time.time()))
+      current += timedelta(minutes=30)
+
+    with self.lock:
+      before = self.db.total_changes
+      self.db.execute('BEGIN IMMEDIATE')
+      self.db.executemany('INSERT OR IGNORE INTO tasks (station, start, updated) VALUES (?, ?, ?)', rows)
+      self.db.execute('COMMIT')
+      return self.db.total_changes - before
+
+  def expire(self, margin=0):
+    """Mark tasks whose archives are past retention, or will be within margin seconds, as 'expired'; returns how many"""
+    cutoff = (utc_now() - RETENTION + timedelta(seconds=margin)).strftime(TIME_FORMAT)
+    now = time.time()
+    _, count = self._transaction('''
+      UPDATE tasks SET status = 'expired', lease_expires = NULL, updated = ?
+      WHERE (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) AND start < ?
+    ''', (now, now, cutoff))
+    return count
+
+  def abandon(self):
+    """Mark tasks failed whose lease ran out on their last attempt; returns how many
+
+    A worker that crashes or is killed never calls fail(), so without this a task that
+    kills its worker would be handed out forever.
+    """
+    now = time.time()
+    _, count = self._transaction('''
+      UPDATE tasks SET status = 'failed', error = 'Lease expired on the last attempt', lease_expires = NULL,
+        updated = ?
+      WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?
+    ''', (now, now, self.max_attempts))
+    return count
+
+  def lease(self, worker):
+    """Claim the most urgent available task for a worker, or None if there is nothing to do right now
+
+    The task whose archive expires first wins, so a worker that finishes a recent archive
+    moves on to an older one queued later by another range instead of continuing in order.
+    """
+    # Under overload, a task that expires before a worker could finish it is a wasted download
+    self.expire(self.task_seconds() or 0)
+    self.abandon()
+    now = time.time()
+    rows, _ = self._transaction('''
+      UPDATE tasks SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, updated = ?
+      WHERE id = (
+        SELECT id FROM tasks
+        WHERE (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) AND attempts < ?
+        ORDER BY start, id LIMIT 1
+      )
+      RETURNING id, station, start, attempts
+    ''', (worker, now + self.lease_seconds, now, now, self.max_attempts))
+    if not rows:
+      return None
+    row = rows[0]
+    return {'id': row['id'], 'station': row['station'], 'start': datetime.strptime(row['start'], TIME_FORMAT),
+            'attempts': row['attempts']}
+
+  def heartbeat(self, task_id, worker):
+    """Renew a lease; False if the task was given to another worker in the meantime"""
+    now = time.time()
+    _, count = self._transaction(
+      "UPDATE tasks SET lease_expires = ?, updated = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+      (now + self.lease_seconds, now, task_id, worker))
+    return count == 1
+
+  def complete(self, task_id, worker, path):
+    self._transaction(
+      "UPDATE tasks SET status = 'done', path = ?, error = NULL, lease_expires = NULL, updated = ? "
+      "WHERE id = ? AND worker = ?",
+      (path, time.time(), task_id, worker))
+
+  def fail(self, task_id, worker, error, retry=True):
+    """Put a failed task back in the queue, or mark it failed for good"""
+    self._transaction('''
+      UPDATE tasks SET
+        status = CASE WHEN ? AND attempts < ? THEN 'pending' ELSE 'failed' END,
+        error = ?, lease_expires = NULL, updated = ?
+      WHERE id = ? AND worker = ?
+    ''', (retry, self.max_attempts, error, time.time(), task_id, worker))
+
+  def counts(self):
+    """Number of tasks per status"""
+    with self.lock:
+      rows = self.db.execute('SELECT status, COUNT(*) AS n FROM tasks GROUP BY status').fetchall()
+    return {row['status']: row['n'] for row in rows}
+
+  def remaining(self):
+    counts = self.counts()
+    return counts.get('pending', 0) + counts.get('leased', 0)
+
+  def throughput(self, window=THROUGHPUT_WINDOW):
+    """Tasks finished per second by all workers over the last window seconds, or None if none were"""
+    since = time.time() - window
+    with self.lock:
+      row = self.db.execute(
+        "SELECT COUNT(*) AS n, MIN(updated) AS first FROM tasks WHERE status IN ('done', 'failed') AND updated >= ?",
+        (since,)).fetchone()
+    if not row['n']:
+      return None
+    # A queue that started less than a window ago is measured from its first finished task
+    elapsed = time.time() - min(max(row['first'], since), time.time() - 1)
+    return row['n'] / elapsed
+
+  def task_seconds(self, throughput=None):
+    """Seconds one worker is expected to take per task at the given (or measured) throughput, or None"""
+    throughput = throughput or self.throughput()
+    if not throughput:
+      return None
+    with self.lock:
+      row = self.db.execute(
+        "SELECT COUNT(DISTINCT worker) AS n FROM tasks WHERE status = 'leased' AND lease_expires >= ?",
+        (time.time(),)).fetchone()
+    # Throughput is shared by the busy workers (plus the one asking)
+    return (row['n'] + 1) / throughput
+
+  def at_risk(self, throughput=None):
+    """Remaining tasks expected to expire before a worker gets to them
+
+    Walks the remaining tasks in the order they will be leased and estimates when each is
+    reached at the given (or measured) throughput. Returns (throughput, tasks), each task a
+    dict with station, start, expires and eta; throughput is None if nothing has been
+    downloaded recently, in which case tasks expiring within THROUGHPUT_WINDOW are returned.
+    """
+    throughput = throughput or self.throughput()
+    now = utc_now()
+    with self.lock:
+      rows = self.db.execute(
+        "SELECT station, start FROM tasks WHERE status IN ('pending', 'leased') ORDER BY start, id").fetchall()
+
+    tasks = []
+    for position, row in enumerate(rows):
+      start = datetime.strptime(row['start'], TIME_FORMAT)
+      if throughput:
+        eta = now + timedelta(seconds=position / throughput)
+      else:
+        eta = now + timedelta(seconds=THROUGHPUT_WINDOW)
+      if eta > expires_at(start):
+        tasks.append({'station': row['station'], 'start': start, 'expires': expires_at(start), 'eta': eta})
+    return throughput, tasks
+
+  def close(self):
+    self.db.close()
+
+
+class Heartbeat:
+  """Renews a task's lease in the background while the worker is busy with it"""
+
+  def __init__(self, queue, task_id, worker):
+    self.queue = queue
+    self.task_id = task_id
+    self.worker = worker
+    self.stopped = threading.Event()
+    self.lost = False
+    self.thread = threading.Thread(target=self._run, daemon=True)
+
+  def _run(self):
+    while not self.stopped.wait(self.queue.lease_seconds / 3):
+      if not self.queue.heartbeat(self.task_id, self.worker):
+        self.lost = True
+        return
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.stopped.set()
+    self.thread.join()
+
+
+def work(queue, output_dir=None, worker=None, delay=10.0, poll_seconds=30.0, log=print):
+  """Download tasks from the queue until none are left; returns (downloaded, failed) counts
+
+  Archives are moved to output_dir if given, otherwise left in the temp directory.
+  """
+  worker = worker or worker_name()
+  if output_dir:
+    os.makedirs(output_dir, exist_ok=True)
+  downloaded = failed = 0
+
+  while True:
+    task = queue.lease(worker)
+    if task is None:
+      if not queue.remaining():
+        break
+      # Other workers hold the remaining tasks; wait in case one of them dies
+      time.sleep(poll_seconds)
+      continue
+
+    date_str = task['start'].strftime('%b-%d-%Y')
+    time_str = task['start'].strftime('%H%MZ')
+    try:
+      with Heartbeat(queue, task['id'], worker) as heartbeat:
+        filepath = download_archive(task['station'], date_str, time_str)
+      if output_dir:
+        filepath = shutil.move(filepath, os.path.join(output_dir, os.path.basename(filepath)))
+
+      if heartbeat.lost:
+        log(f"[WARN] Lease on {task['station']} {date_str} {time_str} expired, another worker may have it too")
+      queue.complete(task['id'], worker, filepath)
+      downloaded += 1
+      log(f"[OK] Downloaded {task['station']} {date_str} {time_str}")
+    except Exception as e:
+      error_msg = str(e)
+      # Missing archives won't appear by retrying
+      retry = '404' not in error_msg and '403' not in error_msg
+      queue.fail(task['id'], worker, error_msg, retry=retry)
+      failed += 1
+      log(f"[FAIL] Failed to download {task['station']} {date_str} {time_str}: {error_msg}")
+
+    if delay > 0:
+      time.sleep(delay)
+
+  return downloaded, failed
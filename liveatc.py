@@ -4,7 +4,38 @@ import os
 import requests
 from bs4 import BeautifulSoup
 
+from profiling import timed
 
+
+ARCHIVE_BASE_URL = 'https://archive.liveatc.net'
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36'
+
+# e.g. KPDX3-Twr-123775-Oct-01-2021-2000Z.mp3
+ARCHIVE_FILENAME_RE = re.compile(r'^(?P<identifier>.+)-(?P<date>[A-Z][a-z]{2}-\d{2}-\d{4})-(?P<time>\d{4}Z)\.mp3$')
+
+
+def parse_archive_filename(filename):
+  """Split an archive file name into its archive identifier and UTC start time"""
+  from datetime import datetime
+
+  match = ARCHIVE_FILENAME_RE.match(os.path.basename(filename))
+  if not match:
+    return None
+
+  start = datetime.strptime(f"{match['date']}-{match['time']}", '%b-%d-%Y-%H%MZ')
+  return match['identifier'], start
+
+
+def find_archives(root):
+  """Paths of every archive (by file name) under a directory tree"""
+  for dirpath, _, filenames in os.walk(root):
+    for name in sorted(filenames):
+      if parse_archive_filename(name):
+        yield os.path.join(dirpath, name)
+
+
+@timed('get_stations')
 def get_stations(icao):
   # Try with default SSL verification first, fallback to unverified if it fails
   try:
@@ -39,7 +70,8 @@ def get_stations(icao):
     yield {'identifier': identifier, 'title': title, 'frequencies': frequencies, 'up': up}
 
 
-def download_archive(station, date, time):
+def get_archive_identifier(station):
+  """Archive identifier of a station, e.g. kpdx_app -> KPDX-App-Dep"""
   # Try with default SSL verification first, fallback to unverified if it fails
   try:
     page = requests.get(f'https://www.liveatc.net/archive.php?m={station}', timeout=10)
@@ -48,67 +80,266 @@ def download_archive(station, date, time):
     import urllib3
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
     page = requests.get(f'https://www.liveatc.net/archive.php?m={station}', verify=False, timeout=10)
-  
+
   soup = BeautifulSoup(page.content, 'html.parser')
-  archive_identifer = soup.find('option', selected=True).attrs['value']
+  return soup.find('option', selected=True).attrs['value']
+
+
+def archive_url(station, date, time, archive_identifier=None):
+  """URL of the archive of a station starting at date (e.g. Oct-01-2021) and time (e.g. 0000Z)"""
+  archive_identifier = archive_identifier or get_archive_identifier(station)
 
-  # Extract airport code from station identifier (e.g., 'kcho3_zdc_121675' -> 'kcho')
-  # Remove trailing digits from the first part of the station identifier
-  station_prefix = station.split('_')[0]
-  airport_code = re.sub(r'\d+$', '', station_prefix)
-  
   # https://archive.liveatc.net/kpdx/KPDX-App-Dep-Oct-01-2021-0000Z.mp3
-  filename = f'{archive_identifer}-{date}-{time}.mp3'
+  filename = f'{archive_identifier}-{date}-{time}.mp3'
+  return f'{ARCHIVE_BASE_URL}/{airport_code(station)}/{filename}'
+
+
+@timed('download_archive')
+def download_archive(station, date, time):
+  url = archive_url(station, date, time)
 
   # Use system temp directory (cross-platform)
   import tempfile
   temp_dir = tempfile.gettempdir()
-  path = os.path.join(temp_dir, filename)
-  url = f'https://archive.liveatc.net/{airport_code}/{filename}'
-  
+  path = os.path.join(temp_dir, os.path.basename(url))
+
+  return fetch_archive(url, path)
+
+
+def airport_code(name):
+  """Airport code used in archive URLs, from a station ('kcho3_zdc_121675') or archive identifier ('KCHO3-ZDC')"""
+  # Remove trailing digits from the first part of the identifier, e.g. 'kcho3' -> 'kcho'
+  prefix = re.split(r'[_-]', name)[0].lower()
+  return re.sub(r'\d+$', '', prefix)
+
+
+def archive_file_url(filename):
+  """Download URL of an archive from its file name, e.g. KPDX3-Twr-123775-Oct-01-2021-2000Z.mp3"""
+  filename = os.path.basename(filename)
+  parsed = parse_archive_filename(filename)
+  if not parsed:
+    raise ValueError(f'Not an archive file name: {filename}')
+  return f'{ARCHIVE_BASE_URL}/{airport_code(parsed[0])}/{filename}'
+
+
+class IncompleteDownload(Exception):
+  pass
+
+
+def fetch_archive(url, path):
+  """Download an archive to path, retrying, and reject error pages and truncated transfers"""
   import time as time_module
   import urllib3
   urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
   # Use browser User-Agent to avoid being blocked
   headers = {
-    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36'
+    'User-Agent': USER_AGENT
   }
 
   # Retry logic with exponential backoff
   max_retries = 3
-  for attempt in range(max_retries):
-    try:
-      print(f"Downloading: {url}")
+  part_path = path + '.part'
+  try:
+    for attempt in range(max_retries):
+      try:
+        print(f"Downloading: {url}")
 
-      # Use requests library with SSL verification disabled
-      response = requests.get(url, timeout=30, stream=True, verify=False, headers=headers)
-      response.raise_for_status()
+        # Use requests library with SSL verification disabled
+        response = requests.get(url, timeout=30, stream=True, verify=False, headers=headers)
+        response.raise_for_status()
+
+        # Error pages are sometimes served with a 200 status
+        content_type = response.headers.get('Content-Type', '')
+        if content_type.startswith('text/'):
+          raise IncompleteDownload(f"Server returned {content_type} instead of audio")
+
+        # Write the file in chunks, to a temporary name until it is complete
+        size = 0
+        with open(part_path, 'wb') as f:
+          for chunk in response.iter_content(chunk_size=8192):
+            if chunk:
+              f.write(chunk)
+              size += len(chunk)
+
+        expected = response.headers.get('Content-Length')
+        if expected is not None and 'Content-Encoding' not in response.headers and size != int(expected):
+          raise IncompleteDownload(f"Transfer ended after {size} of {expected} bytes")
 
-      # Write the file in chunks
-      with open(path, 'wb') as f:
-        for chunk in response.iter_content(chunk_size=8192):
-          if chunk:
-            f.write(chunk)
-      return path
+        os.replace(part_path, path)
+        return path
 
+      except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        if attempt < max_retries - 1:
+          wait_time = 2 ** attempt  # 1, 2, 4 seconds
+          print(f"  Timeout/Connection error, retrying in {wait_time}s...")
+          time_module.sleep(wait_time)
+        else:
+          raise Exception(f"Failed after {max_retries} attempts: {e}")
+      except (requests.exceptions.HTTPError, Exception) as e:
+        # HTTP errors (like 403, 404) or other errors, don't retry
+        if "404" in str(e) or "403" in str(e):
+          raise
+        elif attempt < max_retries - 1:
+          wait_time = 2 ** attempt
+          print(f"  Error: {e}, retrying in {wait_time}s...")
+          time_module.sleep(wait_time)
+        else:
+          raise
+  finally:
+    # A transfer that failed partway (mid-stream error, last retry) leaves no .part behind
+    if os.path.exists(part_path):
+      os.remove(part_path)
+
+
+def fetch_range(url, start, end, max_retries=3):
+  """Bytes start..end (inclusive) of a URL with an HTTP Range request
+
+  Returns (data, partial): partial is False when the server ignored the range and sent
+  the whole file.
+  """
+  import time as time_module
+  import urllib3
+  urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+  headers = {'User-Agent': USER_AGENT, 'Range': f'bytes={int(start)}-{int(end)}'}
+  for attempt in range(max_retries):
+    try:
+      response = requests.get(url, timeout=30, verify=False, headers=headers)
+      response.raise_for_status()
+      if response.headers.get('Content-Type', '').startswith('text/'):
+        raise IncompleteDownload(f"Server returned {response.headers['Content-Type']} instead of audio")
+      return response.content, response.status_code == 206
     except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
       if attempt < max_retries - 1:
-        wait_time = 2 ** attempt  # 1, 2, 4 seconds
-        print(f"  Timeout/Connection error, retrying in {wait_time}s...")
-        time_module.sleep(wait_time)
+        time_module.sleep(2 ** attempt)
       else:
         raise Exception(f"Failed after {max_retries} attempts: {e}")
-    except (requests.exceptions.HTTPError, Exception) as e:
-      # HTTP errors (like 403, 404) or other errors, don't retry
-      if "404" in str(e) or "403" in str(e):
-        raise
-      elif attempt < max_retries - 1:
-        wait_time = 2 ** attempt
-        print(f"  Error: {e}, retrying in {wait_time}s...")
-        time_module.sleep(wait_time)
-      else:
-        raise
+
+
+class ArchiveStream:
+  """Bytes of one archive as they arrive from a background download"""
+
+  def __init__(self, url):
+    import queue
+    import threading
+    self.url = url
+    self.chunks = queue.Queue()
+    self.finished = False
+    self.cancelled = threading.Event()
+
+  def download(self, chunk_size=65536, max_retries=3):
+    """Run in a worker thread: put chunks on the queue, then None (or the exception that stopped it)"""
+    import time as time_module
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    if self.cancelled.is_set():
+      self.chunks.put(None)
+      return
+
+    try:
+      for attempt in range(max_retries):
+        try:
+          response = requests.get(self.url, timeout=30, stream=True, verify=False, headers={'User-Agent': USER_AGENT})
+          response.raise_for_status()
+          break
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+          # Only retried before the first byte; a stream can't restart once it's handed out
+          if attempt == max_retries - 1:
+            raise
+          time_module.sleep(2 ** attempt)
+
+      if response.headers.get('Content-Type', '').startswith('text/'):
+        raise IncompleteDownload(f"Server returned {response.headers['Content-Type']} instead of audio")
+
+      size = 0
+      for chunk in response.iter_content(chunk_size=chunk_size):
+        if self.cancelled.is_set():
+          break
+        if chunk:
+          self.chunks.put(chunk)
+          size += len(chunk)
+
+      # A connection closed early ends the iteration quietly, like a complete transfer
+      expected = response.headers.get('Content-Length')
+      if (not self.cancelled.is_set() and expected is not None and 'Content-Encoding' not in response.headers
+          and size != int(expected)):
+        raise IncompleteDownload(f"Transfer ended after {size} of {expected} bytes")
+      self.chunks.put(None)
+    except Exception as e:
+      self.chunks.put(e)
+
+  def __iter__(self):
+    while not self.finished:
+      chunk = self.chunks.get()
+      if chunk is None or isinstance(chunk, Exception):
+        self.finished = True
+        if chunk is not None:
+          raise chunk
+        return
+      yield chunk
+
+  def close(self):
+    """Stop the download and discard what the consumer didn't read"""
+    self.cancelled.set()
+    try:
+      for _ in self:
+        pass
+    except Exception:
+      pass
+
+
+def iter_archives(station, start, end, prefetch=2, delay=0.0):
+  """Yield (archive start, ArchiveStream) for every 30-minute archive of a station from start to end
+
+  Archives come out in time order. Each stream iterates over the archive's bytes as they
+  arrive and raises if that download fails. While one archive is being consumed, the next
+  `prefetch` archives are already downloading in the background. Nothing is written to disk.
+  """
+  if prefetch < 0:
+    raise ValueError(f'prefetch must be 0 or more, got {prefetch}')
+  import threading
+  import time as time_module
+  from concurrent.futures import ThreadPoolExecutor
+  from datetime import timedelta
+
+  archive_identifier = get_archive_identifier(station)
+  times = []
+  current = start
+  while current <= end:
+    times.append(current)
+    current += timedelta(minutes=30)
+
+  # Space out the start of downloads by `delay` seconds to avoid rate-limiting
+  lock = threading.Lock()
+  next_start = [0.0]
+
+  def download(stream):
+    with lock:
+      wait = next_start[0] - time_module.monotonic()
+      next_start[0] = max(next_start[0], time_module.monotonic()) + delay
+    if wait > 0:
+      time_module.sleep(wait)
+    stream.download()
+
+  streams = []
+  with ThreadPoolExecutor(max_workers=prefetch + 1) as executor:
+    try:
+      for i, archive_start in enumerate(times):
+        # Keep the current archive and the next `prefetch` ones downloading
+        while len(streams) < min(i + prefetch + 1, len(times)):
+          t = times[len(streams)]
+          stream = ArchiveStream(archive_url(station, t.strftime('%b-%d-%Y'), t.strftime('%H%MZ'), archive_identifier))
+          streams.append(stream)
+          executor.submit(download, stream)
+
+        yield archive_start, streams[i]
+        streams[i].close()
+    finally:
+      # Consumer stopped early: cancel downloads that are still running
+      for stream in streams:
+        stream.close()
 
 
 # download_archive('kpdx_zse', 'Oct-01-2021', '0000Z')
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
+import os
+import sys
+
 from cli import get_args
-from liveatc import get_stations, download_archive
+from liveatc import download_archive
+from profiling import profile_session
 from datetime import datetime, timedelta
 
 # Gets the last Zulu period of 30 minutes
@@ -10,15 +14,35 @@ def get_last_zulu_period(date, minutes=30):
   return date - timedelta(minutes=minutes) - (date - datetime.min) % timedelta(minutes=minutes)
 
 
+def print_station(station):
+  print(f"[{station['identifier']}] - {station['title']}")
+
+  for freq in station['frequencies']:
+    print(f"\t{freq['title']} - {freq['frequency']}")
+
+  print()
+
+
 def stations(args):
-  stations = get_stations(args.icao)
-  for station in stations:
-    print(f"[{station['identifier']}] - {station['title']}")
+  from station_directory import StationDirectory, refresh
 
-    for freq in station['frequencies']:
-      print(f"\t{freq['title']} - {freq['frequency']}")
+  directory = StationDirectory()
 
-    print()
+  if args.search:
+    if not len(directory):
+      print("The station directory is empty, look up some airports first (e.g. stations KPDX KSEA)")
+      return
+    results = directory.search(args.search)
+    for station in results:
+      print_station(station)
+    print(f"{len(results)} station(s) matching {args.search!r} (of {len(directory)} known)")
+    return
+
+  def print_stations(icao, stations):
+    for station in stations:
+      print_station(station)
+
+  refresh(args.icao, directory, delay=args.delay, on_result=print_stations)
 
 
 def download(args):
@@ -41,6 +65,12 @@ def download_range(args):
   """Download archives for a date/time range"""
   import time
 
+  if args.enqueue or args.worker or args.status:
+    return queue_range(args)
+  if not args.station or not args.start:
+    print("download-range needs a station and start time (or --worker)")
+    return []
+
   # Parse start and end times
   start_date = datetime.strptime(args.start, '%b-%d-%Y-%H%MZ')
 
@@ -50,6 +80,9 @@ def download_range(args):
     from datetime import timezone
     end_date = datetime.now(timezone.utc).replace(tzinfo=None)
 
+  if getattr(args, 'stdout', False):
+    return stream_range(args, start_date, end_date)
+
   current = start_date
   downloaded_files = []
   failed_files = []
@@ -92,13 +125,254 @@ def download_range(args):
   return downloaded_files
 
 
+def stream_range(args, start_date, end_date):
+  """Write archives for a date/time range to stdout as one continuous MP3 stream"""
+  from liveatc import iter_archives
+  from mp3_frames import iter_audio_bytes
+
+  out = sys.stdout.buffer
+  failed_files = []
+
+  # Progress goes to stderr, stdout carries the audio
+  print(f"Streaming archives from {start_date} to {end_date}", file=sys.stderr)
+  print(f"Station: {args.station}\n", file=sys.stderr)
+
+  for archive_start, stream in iter_archives(args.station, start_date, end_date,
+                                             prefetch=args.prefetch, delay=args.delay):
+    label = archive_start.strftime('%b-%d-%Y %H%MZ')
+    try:
+      for data in iter_audio_bytes(stream):
+        out.write(data)
+      out.flush()
+      print(f"[OK] Streamed {label}", file=sys.stderr)
+    except BrokenPipeError:
+      # The consumer went away
+      return failed_files
+    except Exception as e:
+      failed_files.append((label, str(e)))
+      print(f"[FAIL] Failed to stream {label}: {e}", file=sys.stderr)
+
+  print(f"\n=== Summary ===", file=sys.stderr)
+  print(f"Failed: {len(failed_files)} files", file=sys.stderr)
+  return failed_files
+
+
+def queue_range(args):
+  """Add a range to the shared job queue and/or work through the queue"""
+  from job_queue import JobQueue, work, worker_name
+
+  queue = JobQueue(args.queue, lease_seconds=args.lease)
+  try:
+    if args.station and args.start and (args.enqueue or args.worker):
+      start_date = datetime.strptime(args.start, '%b-%d-%Y-%H%MZ')
+      if args.end:
+        end_date = datetime.strptime(args.end, '%b-%d-%Y-%H%MZ')
+      else:
+        from datetime import timezone
+        end_date = datetime.now(timezone.utc).replace(tzinfo=None)
+      added = queue.add(args.station, start_date, end_date)
+      print(f"Queued {added} new archive(s) of {args.station} from {start_date} to {end_date}")
+    elif args.enqueue:
+      print("--enqueue needs a station and start time")
+      return
+
+    if args.status:
+      queue_status(queue)
+
+    if args.worker:
+      worker = args.worker_id or worker_name()
+      print(f"Worker {worker} using queue {queue.path}\n")
+      downloaded, failed = work(queue, args.output_dir, worker=worker, delay=args.delay)
+      print(f"\n=== Summary ===")
+      print(f"Successfully downloaded: {downloaded} files")
+      print(f"Failed: {failed} files")
+
+    counts = queue.counts()
+    statuses = ('pending', 'leased', 'done', 'failed', 'expired')
+    print("\nQueue: " + ', '.join(f"{counts.get(status, 0)} {status}" for status in statuses))
+  finally:
+    queue.close()
+
+
+def queue_status(queue):
+  """Print the download rate and the queued intervals expected to expire before they are downloaded"""
+  queue.expire()
+  throughput, at_risk = queue.at_risk()
+  if throughput:
+    print(f"Download rate: {throughput * 3600:.1f} archives/hour over the last hour")
+  else:
+    print("Download rate: unknown (nothing downloaded in the last hour)")
+
+  if not at_risk:
+    print("No queued intervals at risk of expiring")
+    return
+
+  print(f"\n{len(at_risk)} interval(s) at risk of expiring before they are downloaded:")
+  for task in at_risk[:20]:
+    print(f"  {task['station']} {task['start']:%b-%d-%Y %H%MZ}: expires {task['expires']:%b-%d %H%MZ}, "
+          f"reached around {task['eta']:%b-%d %H%MZ}")
+  if len(at_risk) > 20:
+    print(f"  ... and {len(at_risk) - 20} more")
+
+
+def clip(args):
+  """Download an arbitrary time range, fetching only the parts of archives it covers"""
+  from clip import clip as clip_range, parse_clip_time
+
+  start = parse_clip_time(args.start)
+  end = parse_clip_time(args.end)
+
+  if args.output == '-':
+    # Keep progress messages off stdout, which carries the audio
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+      clip_range(args.station, start, end, stdout.buffer, format=args.format)
+    finally:
+      sys.stdout = stdout
+    return
+
+  path = clip_range(args.station, start, end, args.output, format=args.format)
+  print(f"[OK] Saved clip to {path}")
+
+
+def analytics(args):
+  """Activity report over a directory of archives"""
+  import tempfile
+  from analytics import analyze_archives
+  from liveatc import find_archives
+
+  directory = args.directory or tempfile.gettempdir()
+  paths = [
+    path for path in find_archives(directory)
+    if not args.station or os.path.basename(path).lower().startswith(args.station.lower())
+  ]
+  if not paths:
+    print(f"No archives found in {directory}")
+    return
+
+  report, failed = analyze_archives(paths, workers=args.workers, silence_thresh=args.silence_thresh)
+  for path, error in failed:
+    print(f"[FAIL] {os.path.basename(path)}: {error}")
+  if not report.days:
+    print("No archives could be analyzed")
+    return
+
+  print(f"\n=== Activity ({len(report.days)} days, {report.days[0]} - {report.days[-1]}) ===")
+  for summary in report.summary():
+    print(f"[{summary['station']}] - {summary['hours_covered']:.1f} hours of archives")
+    print(f"\tTransmissions: {summary['transmissions']}")
+    print(f"\tChannel occupancy: {summary['occupancy']:.1%}")
+    print(f"\tBusiest hour: {summary['busiest_hour']:02d}00Z ({summary['busiest_hour_rate']:.0f} transmissions/hour)")
+    print(f"\tLongest gap: {timedelta(seconds=round(summary['longest_gap']))}")
+    print()
+
+  if args.csv:
+    report.save_csv(args.csv)
+    print(f"Saved per-minute activity to {args.csv}")
+  if args.npz:
+    report.save_npz(args.npz)
+    print(f"Saved activity matrices to {args.npz}")
+
+
+def waveform(args):
+  """Build waveform overviews for a directory of archives and optionally export one span"""
+  import json
+  import tempfile
+  import numpy as np
+  from liveatc import find_archives, parse_archive_filename
+  from timeline import ARCHIVE_LENGTH
+  from waveform import load_waveforms, span_across
+
+  directory = args.directory or tempfile.gettempdir()
+  paths = [
+    path for path in find_archives(directory)
+    if not args.station or os.path.basename(path).lower().startswith(args.station.lower())
+  ]
+  if not paths:
+    print(f"No archives found in {directory}")
+    return
+
+  waveforms, failed = load_waveforms(paths, workers=args.workers)
+  for path, error in failed:
+    print(f"[FAIL] {os.path.basename(path)}: {error}")
+  print(f"{len(waveforms)} waveform(s) ready")
+
+  if not args.json or not waveforms:
+    return
+
+  starts = {path: parse_archive_filename(path)[1] for path in waveforms}
+  start = datetime.strptime(args.start, '%b-%d-%Y-%H%MZ') if args.start else min(starts.values())
+  end = datetime.strptime(args.end, '%b-%d-%Y-%H%MZ') if args.end else max(starts.values()) + ARCHIVE_LENGTH
+
+  def ms(date):
+    return (date - start).total_seconds() * 1000
+
+  entries = [(ms(starts[path]), waveforms[path]) for path in sorted(waveforms, key=starts.get)]
+  mins, maxs, rms = span_across(entries, 0, ms(end), args.pixels)
+
+  def values(array):
+    return [None if np.isnan(value) else int(value) for value in array]
+
+  with open(args.json, 'w') as f:
+    json.dump({'start': start.isoformat() + 'Z', 'end': end.isoformat() + 'Z', 'pixels': args.pixels,
+               'archives': len(entries), 'min': values(mins), 'max': values(maxs), 'rms': values(rms)}, f)
+  print(f"Saved a {args.pixels}-pixel overview of {start} - {end} to {args.json}")
+
+
+def verify(args):
+  """Verify downloaded archives and optionally download broken ones again"""
+  import tempfile
+  from verify import verify_tree, bad_intervals, repair
+
+  directory = args.directory or tempfile.gettempdir()
+  print(f"Verifying archives in {directory}\n")
+
+  results = []
+  for result in verify_tree(directory, workers=args.workers, remote=args.remote):
+    results.append(result)
+    if result['status'] != 'ok':
+      print(f"[{result['status'].upper()}] {os.path.basename(result['path'])}: {result['reason']}")
+
+  failed = [result for result in results if result['status'] != 'ok']
+  print(f"\n=== Summary ===")
+  print(f"Verified: {len(results)} files")
+  print(f"Failed: {len(failed)} files")
+
+  if failed:
+    print(f"\nMissing intervals:")
+    for identifier, start, end in bad_intervals(failed):
+      print(f"  {identifier}: {start:%b-%d-%Y %H%MZ} - {end:%b-%d-%Y %H%MZ}")
+
+  if failed and args.repair:
+    print(f"\nDownloading {len(failed)} archive(s) again...")
+    repaired = repair(failed, delay=args.delay)
+    still_failed = [result for result in repaired if result['status'] != 'ok']
+    print(f"\nRepaired: {len(repaired) - len(still_failed)} files")
+    for result in still_failed:
+      print(f"  [FAIL] {os.path.basename(result['path'])}: {result['reason']}")
+    failed = still_failed
+
+  return failed
+
+
 if __name__ == '__main__':
   args = get_args()
-  print(args)
-
-  if args.command == 'stations':
-    stations(args)
-  elif args.command == 'download':
-    download(args)
-  elif args.command == 'download-range':
-    download_range(args)
+  # stderr, so commands can stream audio to stdout
+  print(args, file=sys.stderr)
+
+  with profile_session(args.profile, args.profile_memory):
+    if args.command == 'stations':
+      stations(args)
+    elif args.command == 'download':
+      download(args)
+    elif args.command == 'download-range':
+      download_range(args)
+    elif args.command == 'clip':
+      clip(args)
+    elif args.command == 'analytics':
+      analytics(args)
+    elif args.command == 'verify':
+      verify(args)
+    elif args.command == 'waveform':
+      waveform(args)
@@ -0,0 +1,356 @@
+import os
+import subprocess
+
+import numpy as np
+from pydub.utils import get_encoder_name
+
+from cache import get_cache_dir, file_hash
+from profiling import timed
+
+
+# MPEG audio frame header tables, indexed by [version][layer] / [version]
+# version: 0 = MPEG 2.5, 2 = MPEG 2, 3 = MPEG 1; layer: 1 = III, 2 = II, 3 = I
+_BITRATES = {
+  (3, 3): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+  (3, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+  (3, 1): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+  (2, 3): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+  (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+  (2, 1): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+# Decoders (ffmpeg, LAME) drop this many samples on top of the encoder delay in a LAME tag
+DECODER_DELAY = 529
+
+# Extra frames decoded (and thrown away) before a seek target: Layer III frames borrow bits
+# from up to ~511 bytes back and the synthesis filter needs a frame to settle
+PREROLL_FRAMES = 10
+
+SEEK_INDEX_VERSION = 1
+
+
+def _header_fields(data, pos):
+  """(version, layer, bitrate, sample rate, padding, channels) of the frame header at pos, or None"""
+  if pos + 4 > len(data) or data[pos] != 0xFF or data[pos + 1] & 0xE0 != 0xE0:
+    return None
+
+  version = (data[pos + 1] >> 3) & 3
+  layer = (data[pos + 1] >> 1) & 3
+  bitrate_index = data[pos + 2] >> 4
+  rate_index = (data[pos + 2] >> 2) & 3
+  if version == 1 or layer == 0 or bitrate_index in (0, 15) or rate_index == 3:
+    return None
+
+  bitrate = _BITRATES[(3 if version == 3 else 2, layer)][bitrate_index] * 1000
+  sample_rate = _SAMPLE_RATES[version][rate_index]
+  padding = (data[pos + 2] >> 1) & 1
+  channels = 1 if data[pos + 3] >> 6 == 3 else 2
+  return version, layer, bitrate, sample_rate, padding, channels
+
+
+def parse_header(data, pos):
+  """(frame size, samples per frame, sample rate, channels) of the frame header at pos, or None"""
+  fields = _header_fields(data, pos)
+  if fields is None:
+    return None
+
+  version, layer, bitrate, sample_rate, padding, channels = fields
+  if layer == 3:
+    return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate, channels
+  samples = 576 if layer == 1 and version != 3 else 1152
+  return samples // 8 * bitrate // sample_rate + padding, samples, sample_rate, channels
+
+
+def _id3v2_size(data):
+  if len(data) < 10 or data[:3] != b'ID3':
+    return 0
+  size = 0
+  for byte in data[6:10]:
+    size = (size << 7) | (byte & 0x7F)
+  footer = 10 if data[5] & 0x10 else 0
+  return 10 + size + footer
+
+
+def _info_frame(data, pos, size, channels, version_bits):
+  """Encoder delay if the frame at pos is a Xing/Info/VBRI header frame (not audio), else None"""
+  mpeg1 = version_bits == 3
+  side_info = (32 if channels == 2 else 17) if mpeg1 else (17 if channels == 2 else 9)
+  crc = 0 if data[pos + 1] & 1 else 2
+  tag = pos + 4 + crc + side_info
+
+  if data[tag:tag + 4] in (b'Xing', b'Info'):
+    flags = int.from_bytes(data[tag + 4:tag + 8], 'big')
+    lame = tag + 8 + 4 * bool(flags & 1) + 4 * bool(flags & 2) + 100 * bool(flags & 4) + 4 * bool(flags & 8)
+    if lame + 24 <= pos + size and data[lame:lame + 4] == b'LAME':
+      # 12 bit encoder delay, 21 bytes into the LAME extension
+      delay = int.from_bytes(data[lame + 21:lame + 24], 'big') >> 12
+      return delay + DECODER_DELAY
+    return 0
+  if data[pos + 36:pos + 40] == b'VBRI':
+    return 0
+  return None
+
+
+class MP3Frames:
+  """Byte offset and size of every audio frame in an MP3 file"""
+
+  def __init__(self, offsets, sizes, sample_rate, samples_per_frame, channels, skip_samples=0):
+    self.offsets = offsets
+    self.sizes = sizes
+    self.sample_rate = sample_rate
+    self.samples_per_frame = samples_per_frame
+    self.channels = channels
+    # Samples at the start of the stream that decoders drop (encoder delay)
+    self.skip_samples = skip_samples
+
+  def __len__(self):
+    return len(self.offsets)
+
+  @property
+  def frame_ms(self):
+    return self.samples_per_frame * 1000 / self.sample_rate
+
+  @property
+  def duration_seconds(self):
+    return (len(self) * self.samples_per_frame - self.skip_samples) / self.sample_rate
+
+  def frame_at(self, ms):
+    """Index of the frame holding a (decoded) time in ms"""
+    sample = ms * self.sample_rate / 1000 + self.skip_samples
+    return min(max(int(sample // self.samples_per_frame), 0), len(self))
+
+  def frame_ranges(self, ranges_ms):
+    """Merged [first, last) frame index ranges covering [start, end] ms ranges"""
+    spans = []
+    for start, end in sorted(ranges_ms):
+      first = self.frame_at(start)
+      last = min(int(np.ceil((end * self.sample_rate / 1000 + self.skip_samples) / self.samples_per_frame)), len(self))
+      if last <= first:
+        continue
+      if spans and first <= spans[-1][1]:
+        spans[-1][1] = max(spans[-1][1], last)
+      else:
+        spans.append([first, last])
+    return spans
+
+  def byte_range(self, first, last):
+    """[start, end) byte range of frames first..last-1"""
+    return int(self.offsets[first]), int(self.offsets[last - 1] + self.sizes[last - 1])
+
+
+@timed('parse_frames')
+def scan_frames(path):
+  """Walk the frame headers of an MP3 file (CBR or VBR) without decoding anything"""
+  with open(path, 'rb') as f:
+    data = f.read()
+
+  pos = _id3v2_size(data)
+  end = len(data) - 128 if data[-128:-125] == b'TAG' else len(data)
+
+  offsets, sizes = [], []
+  fmt = None
+  skip_samples = 0
+  while pos + 4 <= end:
+    header = parse_header(data, pos)
+    # Only trust a sync word that is followed by another frame (or the end of the file)
+    if header is None or (pos + header[0] < end and parse_header(data, pos + header[0]) is None):
+      pos += 1
+      continue
+
+    size, samples, sample_rate, channels = header
+    if fmt is None:
+      fmt = (samples, sample_rate, channels)
+      delay = _info_frame(data, pos, size, channels, (data[pos + 1] >> 3) & 3)
+      if delay is not None:
+        skip_samples = delay
+        pos += size
+        continue
+    elif (samples, sample_rate) != fmt[:2]:
+      # Stray data that happens to look like a header
+      pos += 1
+      continue
+
+    offsets.append(pos)
+    sizes.append(size)
+    pos += size
+
+  if fmt is None:
+    raise ValueError(f'{path} does not contain any MPEG audio frames')
+
+  return MP3Frames(np.array(offsets, dtype=np.int64), np.array(sizes, dtype=np.int32),
+                   fmt[1], fmt[0], fmt[2], skip_samples)
+
+
+def stream_info(data):
+  """Format of an MP3 from its first bytes, for estimating byte offsets of times in CBR streams
+
+  Returns a dict with the offset of the first audio frame (data_start), sample_rate,
+  samples_per_frame, channels, bitrate and skip_samples, or None if no frame is found.
+  """
+  pos = _id3v2_size(data)
+  while pos + 4 <= len(data):
+    header = parse_header(data, pos)
+    if header is None or parse_header(data, pos + header[0]) is None:
+      pos += 1
+      continue
+
+    size, samples, sample_rate, channels = header
+    version, _, bitrate, _, _, _ = _header_fields(data, pos)
+    skip_samples = _info_frame(data, pos, size, channels, version)
+    return {
+      'data_start': pos + size if skip_samples is not None else pos,
+      'sample_rate': sample_rate,
+      'samples_per_frame': samples,
+      'channels': channels,
+      'bitrate': bitrate,
+      'skip_samples': skip_samples or 0,
+    }
+  return None
+
+
+def iter_audio_bytes(chunks, probe_bytes=16384):
+  """Pass an MP3 byte stream through without its ID3 tags and Xing/Info header frame
+
+  Concatenating the output of several archives gives one continuous stream with no tags or
+  stale duration headers in the middle of it. It is not gapless: each archive's encoder
+  delay and padding (a few tens of ms of silence) stay at the joins, since trimming them
+  would mean re-encoding the frames around every join.
+  """
+  chunks = iter(chunks)
+  head = b''
+  for chunk in chunks:
+    head += chunk
+    # Enough to hold the ID3v2 tag plus the first frames
+    if len(head) >= _id3v2_size(head) + probe_bytes:
+      break
+
+  info = stream_info(head)
+  tail = head[info['data_start']:] if info else head
+
+  # Hold back the last 128 bytes until the end, in case they are an ID3v1 tag
+  for chunk in chunks:
+    tail += chunk
+    if len(tail) > 128:
+      yield tail[:-128]
+      tail = tail[-128:]
+
+  # The whole stream may still be in tail if it fit in the probe
+  if len(tail) >= 128 and tail[-128:-125] == b'TAG':
+    tail = tail[:-128]
+  if tail:
+    yield tail
+
+
+def seek_index_path(path):
+  return f'{path}.seek.npz'
+
+
+def _save_seek_index(frames, path, index_path):
+  stat = os.stat(path)
+  with open(index_path + '.part', 'wb') as f:
+    np.savez_compressed(f, version=SEEK_INDEX_VERSION, source_size=stat.st_size, source_mtime=stat.st_mtime_ns,
+                        offsets=frames.offsets, sizes=frames.sizes.astype(np.uint16),
+                        fmt=np.array([frames.sample_rate, frames.samples_per_frame, frames.channels, frames.skip_samples]))
+  os.replace(index_path + '.part', index_path)
+
+
+def _load_seek_index(path, index_path):
+  if not os.path.exists(index_path):
+    return None
+  stat = os.stat(path)
+  try:
+    with np.load(index_path) as data:
+      if (int(data['version']) != SEEK_INDEX_VERSION or int(data['source_size']) != stat.st_size
+          or int(data['source_mtime']) != stat.st_mtime_ns):
+        return None
+      sample_rate, samples_per_frame, channels, skip_samples = data['fmt'].tolist()
+      return MP3Frames(data['offsets'], data['sizes'].astype(np.int32), sample_rate, samples_per_frame,
+                       channels, skip_samples)
+  except (OSError, ValueError, KeyError):
+    return None
+
+
+def load_seek_index(path, rebuild=False):
+  """MP3Frames for a file, from the seek index next to it (built on first use)
+
+  The index is stored as <file>.seek.npz and rebuilt when the file changes. If the
+  archive's directory is read-only, it is kept in the cache directory instead.
+  """
+  index_path = seek_index_path(path)
+  if not os.access(os.path.dirname(os.path.abspath(path)), os.W_OK):
+    index_path = os.path.join(get_cache_dir('mp3_seek'), f'{file_hash(path)}.seek.npz')
+
+  frames = None if rebuild else _load_seek_index(path, index_path)
+  if frames is None:
+    frames = scan_frames(path)
+    _save_seek_index(frames, path, index_path)
+  return frames
+
+
+@timed('decode')
+def decode_samples(path, first_sample, last_sample, frames=None, preroll=PREROLL_FRAMES):
+  """(frames, channels) int16 samples first_sample..last_sample-1, decoding only the frames needed"""
+  frames = frames or load_seek_index(path)
+  total = len(frames) * frames.samples_per_frame
+  # Sample positions in the frame stream, before the encoder delay is dropped
+  first_sample = min(max(first_sample, 0) + frames.skip_samples, total)
+  last_sample = min(max(last_sample, 0) + frames.skip_samples, total)
+  if last_sample <= first_sample:
+    return np.zeros((0, frames.channels), dtype='<i2')
+
+  first = max(first_sample // frames.samples_per_frame - preroll, 0)
+  last = min(-(-last_sample // frames.samples_per_frame), len(frames))
+  start, end = frames.byte_range(first, last)
+  with open(path, 'rb') as f:
+    f.seek(start)
+    data = f.read(end - start)
+
+  command = [get_encoder_name(), '-nostdin', '-v', 'error', '-f', 'mp3', '-i', 'pipe:0',
+             '-f', 's16le', '-acodec', 'pcm_s16le', '-ar', str(frames.sample_rate), '-ac', str(frames.channels), '-']
+  process = subprocess.run(command, input=data, capture_output=True)
+  if process.returncode != 0:
+    raise RuntimeError(f'ffmpeg failed to decode {path}: {process.stderr.decode(errors="replace").strip()}')
+
+  samples = np.frombuffer(process.stdout, dtype='<i2').reshape(-1, frames.channels)
+  offset = first_sample - first * frames.samples_per_frame
+  return samples[offset:offset + last_sample - first_sample]
+
+
+def decode_range(path, start_ms=None, end_ms=None, frames=None):
+  """(frames, channels) int16 samples between two times in ms, decoding only the frames needed"""
+  frames = frames or load_seek_index(path)
+  rate = frames.sample_rate
+  first = 0 if start_ms is None else int(start_ms * rate // 1000)
+  last = len(frames) * frames.samples_per_frame if end_ms is None else int(end_ms * rate // 1000)
+  return decode_samples(path, first, last, frames)
+
+
+def is_mp3(path):
+  return isinstance(path, (str, os.PathLike)) and os.path.splitext(str(path))[1].lower() == '.mp3'
+
+
+def cut_mp3(path, ranges_ms, output_path, frames=None, block_size=1 << 20):
+  """Copy the frames covering [start, end] ms ranges of an MP3 into a new MP3 without re-encoding
+
+  Cuts land on frame boundaries (~26 ms at 44.1 kHz, ~52 ms at 22.05 kHz), rounded outwards
+  so nothing inside a range is lost. Layer III frames may borrow bits from the frame before
+  them, so the first frame after a cut can decode as a short silence.
+
+  Returns the duration written in seconds.
+  """
+  frames = frames or load_seek_index(path)
+  spans = frames.frame_ranges(ranges_ms)
+
+  with open(path, 'rb') as src, open(output_path, 'wb') as dst:
+    for first, last in spans:
+      start, end = frames.byte_range(first, last)
+      src.seek(start)
+      while start < end:
+        block = src.read(min(block_size, end - start))
+        if not block:
+          break
+        dst.write(block)
+        start += len(block)
+
+  return sum(last - first for first, last in spans) * frames.samples_per_frame / frames.sample_rate
@@ -0,0 +1,235 @@
+import json
+import os
+import subprocess
+
+import numpy as np
+from pydub import AudioSegment
+from pydub.utils import get_encoder_name, mediainfo_json
+
+from cache import get_cache_dir, file_hash
+from mp3_frames import decode_range, decode_samples, is_mp3, load_seek_index
+from profiling import timed
+from waveform import WaveformBuilder, save_waveform
+
+
+# Decoded archives are stored as 16-bit PCM; ~100 MB per 30 minutes at 22 kHz mono
+PCM_DTYPE = '<i2'
+DEFAULT_MAX_BYTES = int(os.getenv('LIVEATC_PCM_CACHE_MB', '4096')) * 1024 * 1024
+
+# Fixed .npy header size so we can stream PCM to disk before knowing its length
+NPY_HEADER_SIZE = 128
+
+
+def _npy_header(shape, descr=PCM_DTYPE):
+  header = repr({'descr': descr, 'fortran_order': False, 'shape': tuple(shape)}).encode('latin1')
+  prefix = b'\x93NUMPY\x01\x00'
+  padding = NPY_HEADER_SIZE - len(prefix) - 2 - len(header) - 1
+  if padding < 0:
+    raise ValueError(f'Shape {shape} does not fit in a {NPY_HEADER_SIZE} byte header')
+  header += b' ' * padding + b'\n'
+  return prefix + len(header).to_bytes(2, 'little') + header
+
+
+class PCMAudio:
+  """Decoded audio backed by a memory map; slicing reads only the requested samples"""
+
+  def __init__(self, samples, frame_rate, source=None):
+    self.samples = samples  # shape (frames, channels)
+    self.frame_rate = frame_rate
+    self.sample_width = samples.dtype.itemsize
+    self.source = source
+
+  @classmethod
+  def from_segment(cls, audio):
+    """Wrap an in-memory AudioSegment"""
+    samples = np.array(audio.get_array_of_samples()).reshape(-1, audio.channels)
+    return cls(samples, audio.frame_rate)
+
+  @property
+  def dtype(self):
+    return self.samples.dtype
+
+  @property
+  def channels(self):
+    return self.samples.shape[1]
+
+  @property
+  def frame_count(self):
+    return self.samples.shape[0]
+
+  @property
+  def duration_seconds(self):
+    return self.frame_count / self.frame_rate
+
+  def __len__(self):
+    # Length in milliseconds, like AudioSegment
+    return round(self.duration_seconds * 1000)
+
+  def frame_at(self, ms):
+    return min(max(int(ms * self.frame_rate // 1000), 0), self.frame_count)
+
+  def frames(self, start_ms=None, end_ms=None):
+    """View of the (frames, channels) samples between two offsets in ms"""
+    start = 0 if start_ms is None else self.frame_at(start_ms)
+    end = self.frame_count if end_ms is None else self.frame_at(end_ms)
+    return self.samples[start:end]
+
+  def interleaved(self):
+    return self.samples.reshape(-1)
+
+  def segment(self, frames):
+    """AudioSegment built from a (frames, channels) array"""
+    return AudioSegment(
+      np.ascontiguousarray(frames, dtype=self.samples.dtype).tobytes(),
+      frame_rate=self.frame_rate,
+      sample_width=self.sample_width,
+      channels=self.channels,
+    )
+
+  def __getitem__(self, millisecond):
+    if isinstance(millisecond, slice):
+      return self.segment(self.frames(millisecond.start, millisecond.stop))
+    return self.segment(self.frames(millisecond, millisecond + 1))
+
+  def to_float(self, start_ms=None, end_ms=None):
+    """(channels, frames) float32 waveform in [-1, 1], e.g. for torch/pyannote"""
+    frames = self.frames(start_ms, end_ms)
+    return (frames.T.astype(np.float32) / 32768.0)
+
+
+class PCMCache:
+  """Decode each archive once into a memory-mappable .npy file, with size-bounded LRU eviction"""
+
+  def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+    self.cache_dir = cache_dir or get_cache_dir('pcm')
+    self.max_bytes = max_bytes
+
+  def paths(self, key):
+    base = os.path.join(self.cache_dir, key)
+    return base + '.npy', base + '.json'
+
+  def contains(self, path):
+    npy_path, meta_path = self.paths(file_hash(path))
+    return os.path.exists(npy_path) and os.path.exists(meta_path)
+
+  def get(self, path):
+    npy_path, meta_path = self.paths(file_hash(path))
+
+    if not (os.path.exists(npy_path) and os.path.exists(meta_path)):
+      self._decode(path, npy_path, meta_path)
+      self.evict(keep=npy_path)
+    else:
+      # Mark as recently used for LRU eviction
+      os.utime(npy_path)
+
+    with open(meta_path) as f:
+      meta = json.load(f)
+
+    samples = np.load(npy_path, mmap_mode='r')
+    return PCMAudio(samples, meta['frame_rate'], source=path)
+
+  @timed('decode')
+  def _decode(self, path, npy_path, meta_path):
+    info = mediainfo_json(path)
+    stream = next(s for s in info['streams'] if s.get('codec_type') == 'audio')
+    frame_rate = int(stream['sample_rate'])
+    channels = int(stream['channels'])
+
+    part_path = npy_path + f'.{os.getpid()}.part'
+    command = [get_encoder_name(), '-nostdin', '-v', 'error', '-i', path,
+               '-f', 's16le', '-acodec', 'pcm_s16le', '-ar', str(frame_rate), '-ac', str(channels), '-']
+
+    # Stream ffmpeg's output straight to disk so the whole file is never held in memory,
+    # building the waveform overview of downloaded archives (see waveform.py) on the way;
+    # other inputs (speaker filter clips, user files) get no sidecar in their directory
+    from liveatc import parse_archive_filename
+    waveform = WaveformBuilder(frame_rate, channels) if parse_archive_filename(path) else None
+    size = 0
+    with open(part_path, 'wb') as f:
+      f.write(b'\0' * NPY_HEADER_SIZE)
+      process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      for block in iter(lambda: process.stdout.read(1 << 20), b''):
+        f.write(block)
+        if waveform is not None:
+          waveform.feed_bytes(block)
+        size += len(block)
+      _, stderr = process.communicate()
+      if process.returncode != 0:
+        f.close()
+        os.remove(part_path)
+        raise RuntimeError(f'ffmpeg failed to decode {path}: {stderr.decode(errors="replace").strip()}')
+
+      frame_size = 2 * channels
+      size -= size % frame_size
+      f.truncate(NPY_HEADER_SIZE + size)
+      f.seek(0)
+      f.write(_npy_header((size // frame_size, channels)))
+
+    with open(meta_path, 'w') as f:
+      json.dump({'source': os.path.basename(path), 'frame_rate': frame_rate, 'channels': channels,
+                 'sample_width': 2}, f)
+    os.replace(part_path, npy_path)
+
+    if waveform is not None:
+      try:
+        save_waveform(waveform.finish(), path)
+      except OSError:
+        pass
+
+  def evict(self, keep=None):
+    """Remove least recently used entries until the cache fits in max_bytes"""
+    entries = []
+    for name in os.listdir(self.cache_dir):
+      if not name.endswith('.npy'):
+        continue
+      path = os.path.join(self.cache_dir, name)
+      stat = os.stat(path)
+      entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      if path == keep:
+        continue
+      os.remove(path)
+      meta_path = path[:-len('.npy')] + '.json'
+      if os.path.exists(meta_path):
+        os.remove(meta_path)
+      total -= size
+
+
+_default_cache = None
+
+
+def default_cache():
+  global _default_cache
+  if _default_cache is None:
+    _default_cache = PCMCache()
+  return _default_cache
+
+
+def load_pcm(path):
+  """Memory-mapped PCM for an audio file, decoding it only the first time"""
+  return default_cache().get(path)
+
+
+def load_samples(path, first, last):
+  """(frames, channels) samples first..last-1 of a file
+
+  Read from the PCM cache when the file is already decoded; an MP3 that is not is decoded
+  only around the requested samples, through its frame seek index (see mp3_frames.py).
+  """
+  if default_cache().contains(path) or not is_mp3(path):
+    return load_pcm(path).samples[first:last]
+  return decode_samples(path, first, last)
+
+
+def load_range(path, start_ms=None, end_ms=None):
+  """PCMAudio for the part of a file between two times in ms, without decoding the rest of it"""
+  if default_cache().contains(path) or not is_mp3(path):
+    audio = load_pcm(path)
+    return PCMAudio(audio.frames(start_ms, end_ms), audio.frame_rate, source=path)
+
+  frames = load_seek_index(path)
+  return PCMAudio(decode_range(path, start_ms, end_ms, frames), frames.sample_rate, source=path)
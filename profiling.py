@@ -0,0 +1,202 @@
+import cProfile
+import functools
+import inspect
+import io
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+# Rows of the function and allocation tables in the report
+TOP_FUNCTIONS = 30
+TOP_ALLOCATIONS = 15
+
+# From Python 3.12 cProfile sits on sys.monitoring, which allows one active profiler per process
+THREAD_PROFILES = sys.version_info < (3, 12)
+
+_lock = threading.Lock()
+_session = None
+
+
+def peak_rss_mb():
+  """Peak resident set size of this process in MiB, or None where resource is unavailable"""
+  try:
+    import resource
+  except ImportError:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Bytes on macOS, kilobytes elsewhere
+  return peak / 2**20 if sys.platform == 'darwin' else peak / 1024
+
+
+class ProfileSession:
+  """cProfile, stage timers and optionally tracemalloc for one run, reported to a text file
+
+  Stage timers cost one attribute check per call while no session is active, so the
+  stages stay instrumented permanently. cProfile only sees the thread it is enabled in;
+  worker threads join the session with thread_profile() (before Python 3.12; after that
+  they are covered by the stage timers only). Peak RSS is always reported; tracemalloc
+  slows down every allocation, so allocation tracing is opt-in.
+  """
+
+  def __init__(self, path, memory=False):
+    self.path = path
+    self.memory = memory
+    self.stages = {}        # name -> [calls, wall seconds, CPU seconds]
+    self.stats = None
+    self.profiler = cProfile.Profile()
+    self.started = None
+
+  def record(self, name, wall, cpu):
+    with _lock:
+      totals = self.stages.setdefault(name, [0, 0.0, 0.0])
+      totals[0] += 1
+      totals[1] += wall
+      totals[2] += cpu
+
+  def add_profile(self, profiler):
+    with _lock:
+      if self.stats is None:
+        self.stats = pstats.Stats(profiler)
+      else:
+        self.stats.add(profiler)
+
+  def start(self):
+    self.started = (time.perf_counter(), time.process_time())
+    if self.memory:
+      tracemalloc.start()
+    self.profiler.enable()
+
+  def stop(self):
+    self.profiler.disable()
+    self.add_profile(self.profiler)
+    wall = time.perf_counter() - self.started[0]
+    cpu = time.process_time() - self.started[1]
+    snapshot = peak = None
+    if self.memory:
+      snapshot = tracemalloc.take_snapshot()
+      current, peak = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+
+    with open(self.path, 'w') as f:
+      f.write(self.report(wall, cpu, peak, snapshot))
+
+  def report(self, wall, cpu, peak, snapshot):
+    out = io.StringIO()
+    out.write(f'Total: {wall:.3f}s wall, {cpu:.3f}s CPU')
+    rss = peak_rss_mb()
+    if rss is not None:
+      out.write(f', peak RSS {rss:.1f} MiB')
+    if peak is not None:
+      out.write(f', peak traced memory {peak / 2**20:.1f} MiB')
+    out.write('\n\n')
+
+    out.write('=== Stages ===\n')
+    out.write(f'{"stage":<20} {"calls":>7} {"wall s":>10} {"CPU s":>10} {"% wall":>7}\n')
+    for name, (calls, stage_wall, stage_cpu) in sorted(self.stages.items(), key=lambda item: -item[1][1]):
+      out.write(f'{name:<20} {calls:>7} {stage_wall:>10.3f} {stage_cpu:>10.3f} {stage_wall / max(wall, 1e-9):>7.1%}\n')
+    out.write('(stages can nest or run in parallel threads, so they may add up to more than the total;\n'
+              ' CPU time is process-wide and includes other threads running at the same time)\n\n')
+
+    out.write(f'=== Top {TOP_FUNCTIONS} functions by cumulative time ===\n')
+    self.stats.stream = out
+    self.stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+
+    if snapshot is not None:
+      out.write(f'=== Top {TOP_ALLOCATIONS} allocation sites still held at exit ===\n')
+      for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+        out.write(f'{stat}\n')
+    return out.getvalue()
+
+
+def start(path, memory=False):
+  """Start profiling this process; the report is written to path by stop()"""
+  global _session
+  _session = ProfileSession(path, memory)
+  _session.start()
+  return _session
+
+
+def stop():
+  global _session
+  session, _session = _session, None
+  if session is not None:
+    session.stop()
+  return session
+
+
+@contextmanager
+def profile_session(path, memory=False):
+  """Profile the enclosed block if path is set, writing the report to it afterwards"""
+  if not path:
+    yield None
+    return
+  session = start(path, memory)
+  try:
+    yield session
+  finally:
+    stop()
+    # stderr, so commands can stream audio to stdout
+    print(f"Profile written to {path}", file=sys.stderr)
+
+
+@contextmanager
+def thread_profile():
+  """Include the calling (worker) thread in the active cProfile session
+
+  A no-op on Python 3.12+, where a second profiler can't be enabled while the session's is
+  active; the thread's stages are still timed.
+  """
+  session = _session
+  if session is None or not THREAD_PROFILES:
+    yield
+    return
+  profiler = cProfile.Profile()
+  try:
+    profiler.enable()
+  except ValueError:
+    # Another profiling tool is already active
+    yield
+    return
+  try:
+    yield
+  finally:
+    profiler.disable()
+    session.add_profile(profiler)
+
+
+@contextmanager
+def stage(name):
+  """Time a block as a pipeline stage (wall and CPU) when profiling is on"""
+  session = _session
+  if session is None:
+    yield
+    return
+  wall, cpu = time.perf_counter(), time.process_time()
+  try:
+    yield
+  finally:
+    session.record(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+
+def timed(name):
+  """Decorator form of stage(); for generators, times the whole iteration"""
+  def decorator(func):
+    if inspect.isgeneratorfunction(func):
+      @functools.wraps(func)
+      def generator_wrapper(*args, **kwargs):
+        with stage(name):
+          yield from func(*args, **kwargs)
+      return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      if _session is None:
+        return func(*args, **kwargs)
+      with stage(name):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
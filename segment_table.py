@@ -0,0 +1,197 @@
+"""
+Array-backed table of diarized speaker segments.
+
+Each segment is one row of three NumPy columns (start, end, speaker code) instead of
+two nested dicts, so per-speaker statistics and time/speaker queries are vectorized
+and a long recording's analysis stays small in memory and on disk.
+"""
+
+import json
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+Track = Tuple[float, float, str]
+
+
+class SegmentTable:
+    """
+    Speaker segments as parallel arrays, sorted by start time.
+
+    For compatibility with code written against the old analysis dict, the table also
+    answers `table['speakers']`, `table['segments']` and `table['num_speakers']`; those
+    views are built on demand and not stored.
+    """
+
+    __slots__ = ('start', 'end', 'codes', 'labels')
+
+    def __init__(self, start: np.ndarray, end: np.ndarray, codes: np.ndarray, labels: List[str]):
+        order = np.argsort(start, kind='stable')
+        self.start = np.asarray(start, dtype=np.float64)[order]
+        self.end = np.asarray(end, dtype=np.float64)[order]
+        self.codes = np.asarray(codes, dtype=np.int16)[order]
+        self.labels = list(labels)
+
+    @classmethod
+    def from_tracks(cls, tracks: List[Track]) -> 'SegmentTable':
+        """Build a table from (start, end, speaker) tracks"""
+        labels = sorted({label for _, _, label in tracks})
+        lookup = {label: i for i, label in enumerate(labels)}
+        return cls(
+            np.array([start for start, _, _ in tracks], dtype=np.float64),
+            np.array([end for _, end, _ in tracks], dtype=np.float64),
+            np.array([lookup[label] for _, _, label in tracks], dtype=np.int16),
+            labels,
+        )
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def __iter__(self) -> Iterator[Track]:
+        for start, end, code in zip(self.start.tolist(), self.end.tolist(), self.codes.tolist()):
+            yield start, end, self.labels[code]
+
+    def __repr__(self) -> str:
+        return f'SegmentTable({len(self)} segments, {self.num_speakers} speakers)'
+
+    @property
+    def durations(self) -> np.ndarray:
+        return self.end - self.start
+
+    @property
+    def num_speakers(self) -> int:
+        return len(self.labels)
+
+    def _take(self, mask: np.ndarray) -> 'SegmentTable':
+        return SegmentTable(self.start[mask], self.end[mask], self.codes[mask], self.labels)
+
+    # Queries
+
+    def for_speaker(self, speaker: str) -> 'SegmentTable':
+        """Segments of one speaker (empty if the speaker is unknown)"""
+        if speaker not in self.labels:
+            return self._take(np.zeros(len(self), dtype=bool))
+        return self._take(self.codes == self.labels.index(speaker))
+
+    def between(self, start: float, end: float) -> 'SegmentTable':
+        """Segments overlapping [start, end) seconds"""
+        # Rows are sorted by start, so only a prefix can start before `end`
+        last = np.searchsorted(self.start, end, side='left')
+        mask = np.zeros(len(self), dtype=bool)
+        mask[:last] = self.end[:last] > start
+        return self._take(mask)
+
+    def longer_than(self, seconds: float) -> 'SegmentTable':
+        return self._take(self.durations >= seconds)
+
+    def ranges_ms(self, speaker: Optional[str] = None) -> List[List[int]]:
+        """[start, end] ranges in ms, e.g. for merge_ranges/gather_frames"""
+        table = self if speaker is None else self.for_speaker(speaker)
+        return np.stack([(table.start * 1000).astype(np.int64), (table.end * 1000).astype(np.int64)], axis=1).tolist()
+
+    def stats(self) -> Dict[str, dict]:
+        """Total speaking time and segment count per speaker"""
+        n = len(self.labels)
+        total = np.bincount(self.codes, weights=self.durations, minlength=n)
+        count = np.bincount(self.codes, minlength=n)
+        return {
+            label: {'total_time': float(total[i]), 'num_segments': int(count[i])}
+            for i, label in enumerate(self.labels)
+        }
+
+    # Old analysis dict interface
+
+    def _speakers(self) -> Dict[str, dict]:
+        stats = self.stats()
+        for label, entry in stats.items():
+            entry['segments'] = [
+                {'start': start, 'end': end, 'duration': end - start}
+                for start, end, _ in self.for_speaker(label)
+            ]
+        return stats
+
+    def _segments(self) -> List[dict]:
+        return [
+            {'speaker': speaker, 'start': start, 'end': end, 'duration': end - start}
+            for start, end, speaker in self
+        ]
+
+    def __getitem__(self, key: str):
+        if key == 'speakers':
+            return self._speakers()
+        if key == 'segments':
+            return self._segments()
+        if key == 'num_speakers':
+            return self.num_speakers
+        raise KeyError(key)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self) -> List[str]:
+        return ['speakers', 'segments', 'num_speakers']
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys()
+
+    # Export
+
+    def to_dict(self) -> dict:
+        """Compact JSON-serializable form: per-speaker stats plus each segment once"""
+        return {
+            'num_speakers': self.num_speakers,
+            'speakers': self.stats(),
+            'segments': [
+                {'speaker': speaker, 'start': round(start, 3), 'end': round(end, 3)}
+                for start, end, speaker in self
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'SegmentTable':
+        """Read to_dict() output or an analysis dict from before SegmentTable (incl. saved JSON)"""
+        if 'segments' in data:
+            return cls.from_tracks([(seg['start'], seg['end'], seg['speaker']) for seg in data['segments']])
+        return cls.from_tracks([
+            (seg['start'], seg['end'], speaker)
+            for speaker, entry in data.get('speakers', {}).items()
+            for seg in entry['segments']
+        ])
+
+    @classmethod
+    def coerce(cls, analysis: Union['SegmentTable', dict]) -> 'SegmentTable':
+        """Accept a SegmentTable or an old-style analysis dict wherever an analysis is passed in"""
+        if isinstance(analysis, dict):
+            return cls.from_dict(analysis)
+        return analysis
+
+    @staticmethod
+    def _format(path: str, format: Optional[str]) -> str:
+        if format is None:
+            return 'npz' if Path(path).suffix.lower() == '.npz' else 'json'
+        if format not in ('json', 'npz'):
+            raise ValueError(f"Unknown analysis format {format!r}, expected 'json' or 'npz'")
+        return format
+
+    def save(self, path: str, format: Optional[str] = None):
+        """Write the table as 'npz' (binary columns) or 'json' (default: by the file extension)"""
+        if self._format(path, format) == 'npz':
+            # Through a file object so NumPy doesn't append .npz to other extensions
+            with open(path, 'wb') as f:
+                np.savez_compressed(f, start=self.start.astype(np.float32), end=self.end.astype(np.float32),
+                                    codes=self.codes, labels=np.array(self.labels))
+        else:
+            with open(path, 'w') as f:
+                json.dump(self.to_dict(), f, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, path: str, format: Optional[str] = None) -> 'SegmentTable':
+        if cls._format(path, format) == 'npz':
+            with np.load(path) as data:
+                return cls(data['start'], data['end'], data['codes'], data['labels'].tolist())
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
@@ -16,8 +16,13 @@ Dependencies:
 import os
 import sys
 from pathlib import Path
-from typing import List, Tuple, Optional
-import json
+from typing import List, Tuple, Optional, Union
+
+from profiling import profile_session, thread_profile, timed
+from segment_table import SegmentTable
+
+
+PIPELINE_NAME = "pyannote/speaker-diarization-3.1"
 
 
 def check_dependencies():
@@ -52,17 +57,56 @@ def check_dependencies():
     return True
 
 
+def open_audio(source):
+    """
+    Memory-mapped PCM for an audio file path.
+
+    PCMAudio and ArchiveTimeline objects (see timeline.py) are returned as-is, so every
+    SpeakerFilter method can also run directly on a multi-archive timeline.
+    """
+    from pcm_cache import load_pcm
+
+    if isinstance(source, (str, Path)):
+        return load_pcm(str(source))
+    return source
+
+
+def check_window(window: float, overlap: float):
+    """Raise ValueError unless windows of this length and overlap make progress"""
+    if window <= 0:
+        raise ValueError(f"Diarization window must be positive (got {window:g}s)")
+    if overlap < 0 or overlap >= window:
+        raise ValueError(f"Window overlap must be at least 0 and shorter than the window "
+                         f"(got {overlap:g}s overlap for a {window:g}s window)")
+
+
+def _same_tracks(indexed: Optional[List[Tuple[float, float, str]]], tracks: List[Tuple[float, float, str]]) -> bool:
+    """Whether segments read back from the speaker index are these tracks (times are stored as float32)"""
+    if indexed is None or len(indexed) != len(tracks):
+        return False
+    return all(label == other_label and abs(start - other_start) < 1e-3 and abs(end - other_end) < 1e-3
+               for (start, end, label), (other_start, other_end, other_label) in zip(indexed, tracks))
+
+
 class SpeakerFilter:
     """Identifies and filters specific speakers from audio recordings"""
 
-    def __init__(self, hf_token: Optional[str] = None):
+    def __init__(self, hf_token: Optional[str] = None, use_cache: bool = True, vad: bool = True,
+                 window: Optional[float] = None, window_overlap: float = 30.0, copy_frames: bool = True):
         """
         Initialize the speaker filter.
 
         Args:
             hf_token: HuggingFace API token (required for pyannote models)
                      Get one free at: https://huggingface.co/settings/tokens
+            use_cache: Reuse cached diarization results (see diarization_cache.py)
+            vad: Only diarize the speech islands found by an energy gate (see vad.py)
+            window: Diarize in windows of this many seconds (for multi-hour recordings)
+            window_overlap: Overlap between consecutive windows in seconds
+            copy_frames: Cut MP3 output from MP3 input by copying frames instead of re-encoding
         """
+        if window is not None:
+            check_window(window, window_overlap)
         if not check_dependencies():
             raise RuntimeError("Missing required dependencies")
 
@@ -86,7 +130,7 @@ class SpeakerFilter:
         # Load the speaker diarization pipeline
         try:
             self.pipeline = Pipeline.from_pretrained(
-                "pyannote/speaker-diarization-3.1",
+                PIPELINE_NAME,
                 use_auth_token=self.hf_token
             )
             self.pipeline.to(self.device)
@@ -97,179 +141,566 @@ class SpeakerFilter:
             print("   2. Accepted the model terms at: https://huggingface.co/pyannote/speaker-diarization-3.1")
             raise
 
-    def analyze_speakers(self, audio_path: str) -> dict:
+        from diarization_cache import DiarizationCache
+        from speaker_index import EnrolledVoices, SpeakerEmbeddingIndex
+        self.cache = DiarizationCache() if use_cache else None
+        self.vad = vad
+        self.window = window
+        self.window_overlap = window_overlap
+        self.copy_frames = copy_frames
+        self.voices = EnrolledVoices()
+        self.index = SpeakerEmbeddingIndex()
+        self._embedding_inference = None
+
+    def _cache_key(self, audio_path) -> Optional[str]:
+        import pyannote.audio
+        from diarization_cache import cache_key
+
+        try:
+            params = self.pipeline.parameters(instantiated=True)
+        except Exception:
+            params = {}
+        params = {'pipeline': params, 'vad': self.vad, 'window': self.window, 'overlap': self.window_overlap}
+        return cache_key(audio_path, PIPELINE_NAME, pyannote.audio.__version__, params)
+
+    def _diarize_audio(self, audio, return_embeddings: bool = False):
+        """
+        Run the pipeline on an opened audio source.
+
+        Returns:
+            (tracks, labels, embeddings) where embeddings has one row per label
+            (None unless return_embeddings is set)
+        """
+        import numpy as np
+        import torch
+        from vad import pack_speech
+
+        # Most of an ATC archive is silence: diarize only the speech islands packed
+        # together, then map the timestamps back onto the original timeline
+        packed = pack_speech(audio) if self.vad else None
+        if packed is not None:
+            print(f"Diarizing {packed.duration_seconds:.0f}s of speech out of {audio.duration_seconds:.0f}s")
+            if not len(packed.islands):
+                return [], [], np.zeros((0, 0), dtype=np.float32)
+
+        waveform = packed.to_float() if packed is not None else audio.to_float()
+        result = self.pipeline({'waveform': torch.from_numpy(waveform), 'sample_rate': audio.frame_rate},
+                               return_embeddings=return_embeddings)
+        diarization, embeddings = result if return_embeddings else (result, None)
+
+        tracks = [
+            (turn.start, turn.end, speaker)
+            for turn, _, speaker in diarization.itertracks(yield_label=True)
+        ]
+        if packed is not None:
+            tracks = packed.map_tracks(tracks)
+        return tracks, diarization.labels(), embeddings
+
+    def iter_diarize(self, audio_path: str, window: Optional[float] = None, overlap: Optional[float] = None):
+        """
+        Diarize a long recording in overlapping windows, yielding tracks as they are found.
+
+        Only one window of audio is held in memory at a time. Speaker labels are made
+        consistent across windows by matching each window's speaker embeddings against
+        the speakers seen so far.
+
+        Args:
+            audio_path: Path to audio file or an ArchiveTimeline
+            window: Window length in seconds (default: self.window or 600)
+            overlap: Overlap between windows in seconds (default: self.window_overlap)
+
+        Yields:
+            (start, end, speaker) tracks in seconds, in window order
+
+        Raises:
+            ValueError: if the window is not positive or the overlap is not shorter than it
+        """
+        from pcm_cache import PCMAudio
+        from speaker_index import LabelLinker
+
+        if window is None:
+            window = self.window or 600
+        overlap = self.window_overlap if overlap is None else overlap
+        check_window(window, overlap)
+
+        audio = open_audio(audio_path)
+        window_ms = int(window * 1000)
+        overlap_ms = int(overlap * 1000)
+        step_ms = max(window_ms - overlap_ms, 1)
+        length = len(audio)
+        linker = LabelLinker()
+
+        start_ms = 0
+        while start_ms < length:
+            end_ms = min(start_ms + window_ms, length)
+            chunk = PCMAudio(audio.frames(start_ms, end_ms), audio.frame_rate)
+            tracks, labels, embeddings = self._diarize_audio(chunk, return_embeddings=True)
+            mapping = linker.link(labels, embeddings) if labels else {}
+
+            # Each window owns the middle of its overlaps, so tracks are emitted once
+            own_start = 0 if start_ms == 0 else start_ms + overlap_ms / 2
+            own_end = length if end_ms >= length else end_ms - overlap_ms / 2
+            for start, end, label in tracks:
+                start = max(start * 1000 + start_ms, own_start)
+                end = min(end * 1000 + start_ms, own_end)
+                if end > start:
+                    yield start / 1000, end / 1000, mapping[label]
+
+            if end_ms >= length:
+                break
+            start_ms += step_ms
+
+    def diarize(self, audio_path: str) -> List[Tuple[float, float, str]]:
+        """
+        Run speaker diarization, reusing a cached result for the same audio content.
+
+        Args:
+            audio_path: Path to audio file or an ArchiveTimeline
+
+        Returns:
+            List of (start, end, speaker) tracks in seconds
+        """
+        key = self._cache_key(audio_path) if self.cache else None
+        if key:
+            tracks = self.cache.get(key)
+            if tracks is not None:
+                print("Using cached diarization")
+                return tracks
+
+        if self.window:
+            tracks = []
+            for track in self.iter_diarize(audio_path):
+                print(f"  {track[0]:.1f}s - {track[1]:.1f}s  {track[2]}")
+                tracks.append(track)
+        else:
+            # Run diarization on the cached PCM instead of decoding the file again
+            tracks, _, _ = self._diarize_audio(open_audio(audio_path))
+
+        if key:
+            self.cache.put(key, tracks)
+        return tracks
+
+    @timed('analyze_speakers')
+    def analyze_speakers(self, audio_path: str) -> SegmentTable:
         """
         Analyze an audio file and identify different speakers.
 
         Args:
-            audio_path: Path to audio file (MP3, WAV, etc.)
+            audio_path: Path to audio file (MP3, WAV, etc.) or an ArchiveTimeline
 
         Returns:
-            Dictionary with speaker segments and statistics
+            SegmentTable of speaker segments (also readable like the old analysis dict)
         """
         print(f"\nAnalyzing: {audio_path}")
 
-        # Run diarization
-        diarization = self.pipeline(audio_path)
-
-        # Collect speaker statistics
-        speakers = {}
-        segments = []
-
-        for turn, _, speaker in diarization.itertracks(yield_label=True):
-            speaker_id = speaker
-            duration = turn.end - turn.start
-
-            # Track statistics per speaker
-            if speaker_id not in speakers:
-                speakers[speaker_id] = {
-                    'total_time': 0,
-                    'num_segments': 0,
-                    'segments': []
-                }
-
-            speakers[speaker_id]['total_time'] += duration
-            speakers[speaker_id]['num_segments'] += 1
-            speakers[speaker_id]['segments'].append({
-                'start': turn.start,
-                'end': turn.end,
-                'duration': duration
-            })
-
-            segments.append({
-                'speaker': speaker_id,
-                'start': turn.start,
-                'end': turn.end,
-                'duration': duration
-            })
-
-        return {
-            'speakers': speakers,
-            'segments': segments,
-            'num_speakers': len(speakers)
-        }
-
-    def print_analysis(self, analysis: dict):
+        return SegmentTable.from_tracks(self.diarize(audio_path))
+
+    def _embedding_model(self):
+        """Speaker embedding model, loaded on first use"""
+        if self._embedding_inference is None:
+            from pyannote.audio import Inference, Model
+            from speaker_index import EMBEDDING_MODEL
+
+            model = Model.from_pretrained(EMBEDDING_MODEL, use_auth_token=self.hf_token)
+            self._embedding_inference = Inference(model, window="whole")
+            self._embedding_inference.to(self.device)
+        return self._embedding_inference
+
+    def embed(self, audio, start_ms: Optional[int] = None, end_ms: Optional[int] = None):
+        """Speaker embedding of (part of) an opened audio source"""
+        import numpy as np
+        import torch
+
+        waveform = torch.from_numpy(audio.to_float(start_ms, end_ms))
+        embedding = self._embedding_model()({'waveform': waveform, 'sample_rate': audio.frame_rate})
+        return np.asarray(embedding, dtype=np.float32).reshape(-1)
+
+    def enroll(self, name: str, clips: List[str]):
+        """
+        Enroll a named voice from reference clips that contain only that speaker.
+
+        Args:
+            name: Name to enroll the voice under (e.g., "alice")
+            clips: Audio files with the speaker talking
+        """
+        import numpy as np
+
+        embeddings = np.stack([self.embed(open_audio(clip)) for clip in clips])
+        self.voices.enroll(name, embeddings)
+        print(f"✅ Enrolled '{name}' from {len(clips)} clip(s)")
+
+    def speaker_embeddings(self, audio_path: str, analysis: Union[SegmentTable, dict]) -> dict:
+        """
+        Per-speaker segment embeddings for a file, read from the cross-file index when the
+        file was seen before, otherwise computed and added to the index.
+
+        Index entries are keyed like the diarization cache (content, pipeline and
+        parameters), since speaker labels are only meaningful for one diarization. Indexed
+        segments that don't match this analysis (e.g. one loaded from an older JSON
+        export) are not used; the embeddings are computed from the analysis instead.
+        """
+        import numpy as np
+        from speaker_index import MIN_SEGMENT_SECONDS
+
+        tracks = list(SegmentTable.coerce(analysis).longer_than(MIN_SEGMENT_SECONDS))
+        key = self._cache_key(audio_path)
+        if key is not None and _same_tracks(self.index.file_tracks(key), tracks):
+            return self.index.file_embeddings(key)
+
+        audio = open_audio(audio_path)
+        embeddings = [self.embed(audio, int(start * 1000), int(end * 1000)) for start, end, _ in tracks]
+
+        result = {label: [] for _, _, label in tracks}
+        for (_, _, label), embedding in zip(tracks, embeddings):
+            result[label].append(embedding)
+
+        if key is not None and tracks and key not in self.index:
+            self.index.add(key, str(audio_path), tracks, np.stack(embeddings))
+        return {label: np.stack(vectors) for label, vectors in result.items()}
+
+    def resolve_speaker(self, audio_path: str, speaker: str, analysis: Union[SegmentTable, dict]) -> Optional[str]:
+        """
+        Map a speaker argument to a local speaker ID.
+
+        Local IDs (SPEAKER_00, ...) are returned unchanged. Enrolled names are matched
+        against the file's speakers by embedding similarity.
+        """
+        from speaker_index import match_speaker
+
+        analysis = SegmentTable.coerce(analysis)
+        if speaker in analysis.labels or speaker not in self.voices:
+            return speaker
+
+        label, score = match_speaker(self.voices.voices[speaker], self.speaker_embeddings(audio_path, analysis))
+        if label is None:
+            print(f"❌ '{speaker}' does not appear to be speaking in this file (best match {score:.2f})")
+        else:
+            print(f"Resolved '{speaker}' to {label} (similarity {score:.2f})")
+        return label
+
+    def find(self, name: str, top: int = 20) -> List[dict]:
+        """Indexed segments most similar to an enrolled voice, across all processed files"""
+        if name not in self.voices:
+            raise ValueError(f"'{name}' is not enrolled (enrolled: {', '.join(self.voices.names()) or 'none'})")
+        return self.index.search(self.voices.voices[name], k=top)
+
+    def print_analysis(self, analysis: Union[SegmentTable, dict]):
         """Print a summary of the speaker analysis"""
+        analysis = SegmentTable.coerce(analysis)
         print(f"\n{'='*60}")
-        print(f"Found {analysis['num_speakers']} different speaker(s)")
+        print(f"Found {analysis.num_speakers} different speaker(s)")
         print(f"{'='*60}\n")
 
-        for speaker_id, stats in sorted(analysis['speakers'].items()):
+        for speaker_id, stats in sorted(analysis.stats().items()):
             print(f"Speaker {speaker_id}:")
             print(f"  Total speaking time: {stats['total_time']:.1f} seconds")
             print(f"  Number of segments: {stats['num_segments']}")
             print(f"  Average segment length: {stats['total_time']/stats['num_segments']:.1f}s")
             print()
 
+    @timed('export')
+    def export_ranges(self, audio_path, audio, ranges: List[List[int]], output_path: str,
+                      output_format: Optional[str] = None) -> float:
+        """
+        Write [start, end] ms ranges of a recording to one output file.
+
+        MP3 to MP3 is cut by copying the source frames (frame-accurate, no re-encoding);
+        anything else is gathered from the decoded PCM and encoded.
+
+        Returns:
+            Duration written in seconds
+        """
+        from audio_utils import gather_frames
+        from mp3_frames import cut_mp3, is_mp3
+
+        output_format = output_format or Path(output_path).suffix[1:]
+        if self.copy_frames and output_format.lower() == 'mp3' and is_mp3(audio_path):
+            return cut_mp3(audio_path, ranges, output_path)
+
+        result = audio.segment(gather_frames(audio, ranges))
+        result.export(output_path, format=output_format)
+        return result.duration_seconds
+
     def extract_speaker_segments(
         self,
         audio_path: str,
         speaker_id: str,
         output_path: str,
-        analysis: Optional[dict] = None
+        analysis: Optional[Union[SegmentTable, dict]] = None
     ):
         """
         Extract only segments where a specific speaker is talking.
 
         Args:
-            audio_path: Input audio file
-            speaker_id: Speaker to extract (e.g., "SPEAKER_00")
+            audio_path: Input audio file or ArchiveTimeline
+            speaker_id: Speaker to extract (e.g., "SPEAKER_00") or an enrolled name
             output_path: Output file path
-            analysis: Pre-computed analysis (optional, will compute if not provided)
+            analysis: Pre-computed SegmentTable or analysis dict (optional, will compute if not provided)
         """
-        from pydub import AudioSegment
+        from audio_utils import merge_ranges
 
         if analysis is None:
             analysis = self.analyze_speakers(audio_path)
+        analysis = SegmentTable.coerce(analysis)
 
-        if speaker_id not in analysis['speakers']:
+        speaker_id = self.resolve_speaker(audio_path, speaker_id, analysis)
+        if speaker_id is None:
+            return
+
+        if speaker_id not in analysis.labels:
             print(f"❌ Speaker '{speaker_id}' not found in audio!")
-            print(f"   Available speakers: {', '.join(analysis['speakers'].keys())}")
+            print(f"   Available speakers: {', '.join(analysis.labels)}")
             return
 
         print(f"\nExtracting segments for {speaker_id}...")
 
-        # Load audio
-        audio = AudioSegment.from_file(audio_path)
-
-        # Combine all segments for this speaker
-        result = AudioSegment.empty()
-        segments = analysis['speakers'][speaker_id]['segments']
+        # Memory-mapped PCM from the decode cache; slices read only what they need
+        audio = open_audio(audio_path)
 
-        for i, seg in enumerate(segments, 1):
-            start_ms = int(seg['start'] * 1000)
-            end_ms = int(seg['end'] * 1000)
-            result += audio[start_ms:end_ms]
-            print(f"  [{i}/{len(segments)}] Added segment: {seg['start']:.1f}s - {seg['end']:.1f}s")
+        # Gather all segments for this speaker in one pass (overlaps merged)
+        segments = analysis.ranges_ms(speaker_id)
+        ranges = merge_ranges(segments)
+        print(f"  {len(segments)} segment(s) merged into {len(ranges)} range(s)")
 
         # Export
         print(f"\nExporting to: {output_path}")
-        result.export(output_path, format=Path(output_path).suffix[1:])
-        print(f"✅ Extracted {len(segments)} segments ({result.duration_seconds:.1f}s total)")
+        duration = self.export_ranges(audio_path, audio, ranges, output_path)
+        print(f"✅ Extracted {len(segments)} segments ({duration:.1f}s total)")
 
     def remove_speaker_segments(
         self,
         audio_path: str,
         speaker_id: str,
         output_path: str,
-        analysis: Optional[dict] = None
+        analysis: Optional[Union[SegmentTable, dict]] = None
     ):
         """
         Remove segments where a specific speaker is talking (keep everyone else).
 
         Args:
-            audio_path: Input audio file
-            speaker_id: Speaker to remove (e.g., "SPEAKER_00")
+            audio_path: Input audio file or ArchiveTimeline
+            speaker_id: Speaker to remove (e.g., "SPEAKER_00") or an enrolled name
             output_path: Output file path
-            analysis: Pre-computed analysis (optional, will compute if not provided)
+            analysis: Pre-computed SegmentTable or analysis dict (optional, will compute if not provided)
         """
-        from pydub import AudioSegment
+        from audio_utils import merge_ranges, silent_ranges
 
         if analysis is None:
             analysis = self.analyze_speakers(audio_path)
+        analysis = SegmentTable.coerce(analysis)
+
+        speaker_id = self.resolve_speaker(audio_path, speaker_id, analysis)
+        if speaker_id is None:
+            return
 
-        if speaker_id not in analysis['speakers']:
+        if speaker_id not in analysis.labels:
             print(f"❌ Speaker '{speaker_id}' not found in audio!")
-            print(f"   Available speakers: {', '.join(analysis['speakers'].keys())}")
+            print(f"   Available speakers: {', '.join(analysis.labels)}")
             return
 
         print(f"\nRemoving segments for {speaker_id}...")
 
-        # Load audio
-        audio = AudioSegment.from_file(audio_path)
+        # Memory-mapped PCM from the decode cache; slices read only what they need
+        audio = open_audio(audio_path)
+
+        # Keep the complement of the (merged) target speaker segments, so audio where
+        # the target overlaps someone else is removed as well
+        removed = merge_ranges(analysis.ranges_ms(speaker_id))
+        kept = silent_ranges(removed, len(audio))
 
-        # Get all segments sorted by time
-        all_segments = sorted(analysis['segments'], key=lambda x: x['start'])
+        # Export
+        print(f"\nExporting to: {output_path}")
+        duration = self.export_ranges(audio_path, audio, kept, output_path)
+        print(f"✅ Removed {speaker_id} segments ({duration:.1f}s remaining)")
+
+    def extract_all_speakers(
+        self,
+        audio_path: str,
+        output_dir: str,
+        output_format: Optional[str] = None,
+        others: bool = False,
+        jobs: int = 4,
+        analysis: Optional[Union[SegmentTable, dict]] = None,
+        name: Optional[str] = None
+    ) -> List[str]:
+        """
+        Write one file per speaker (and optionally one per "everyone else") in a single pass.
+
+        The audio is decoded once and every output is gathered from the same memory-mapped
+        PCM; encoding the outputs (the slow part for MP3) runs in a thread pool.
+
+        Args:
+            audio_path: Input audio file or ArchiveTimeline
+            output_dir: Directory for the output files
+            output_format: Output format/extension (default: same as the input, or mp3)
+            others: Also write each speaker's complement (everyone but that speaker)
+            jobs: Number of outputs encoded in parallel
+            analysis: Pre-computed SegmentTable or analysis dict (optional, will compute if not provided)
+            name: Output file name prefix (default: the input file name, or the timeline's name)
+
+        Returns:
+            Paths of the files written
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from audio_utils import merge_ranges, silent_ranges
+
+        if analysis is None:
+            analysis = self.analyze_speakers(audio_path)
+        analysis = SegmentTable.coerce(analysis)
+
+        audio = open_audio(audio_path)
+        if isinstance(audio_path, (str, Path)):
+            name = name or Path(audio_path).stem
+            output_format = output_format or Path(audio_path).suffix[1:]
+        else:
+            name = name or getattr(audio_path, 'name', 'recording')
+        output_format = output_format or 'mp3'
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+        outputs = []
+        for speaker_id in analysis.labels:
+            ranges = merge_ranges(analysis.ranges_ms(speaker_id))
+            outputs.append((output_dir / f"{name}_{speaker_id}.{output_format}", ranges))
+            if others:
+                outputs.append((output_dir / f"{name}_without_{speaker_id}.{output_format}",
+                                silent_ranges(ranges, len(audio))))
+
+        def export(output_path, ranges):
+            with thread_profile():
+                return output_path, self.export_ranges(audio_path, audio, ranges, str(output_path), output_format)
 
-        # Build result by keeping everything except target speaker
-        result = AudioSegment.empty()
-        last_end = 0
+        print(f"\nWriting {len(outputs)} file(s) to: {output_dir}")
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            # pydub hands encoding to an ffmpeg subprocess (and frame copies are plain I/O),
+            # so threads write in parallel
+            for output_path, duration in executor.map(lambda job: export(*job), outputs):
+                print(f"  {output_path.name} ({duration:.1f}s)")
 
-        for seg in all_segments:
-            start_ms = int(seg['start'] * 1000)
-            end_ms = int(seg['end'] * 1000)
+        print(f"✅ Wrote {len(outputs)} file(s) for {analysis.num_speakers} speaker(s)")
+        return [str(output_path) for output_path, _ in outputs]
 
-            if seg['speaker'] == speaker_id:
-                # Add everything before this speaker segment
-                if last_end < start_ms:
-                    result += audio[last_end:start_ms]
-                last_end = end_ms
+
+def process_file(speaker_filter: SpeakerFilter, audio_file: str, speaker_id: str, output_file: str, mode: str):
+    """Extract or remove one speaker from one file (the unit of work for batch mode)"""
+    if mode == 'extract':
+        speaker_filter.extract_speaker_segments(audio_file, speaker_id, output_file)
+    else:
+        speaker_filter.remove_speaker_segments(audio_file, speaker_id, output_file)
+
+
+# Per-process state for parallel batch mode: each worker loads the pipeline once
+_worker_filter = None
+
+
+def _init_worker(num_threads: int, filter_options: dict):
+    global _worker_filter
+    import torch
+
+    # Split the cores between workers instead of every worker using all of them
+    torch.set_num_threads(num_threads)
+    _worker_filter = SpeakerFilter(**filter_options)
+
+
+def _run_worker_job(audio_file: str, speaker_id: str, output_file: str, mode: str) -> Tuple[str, Optional[str]]:
+    try:
+        process_file(_worker_filter, audio_file, speaker_id, output_file, mode)
+        return audio_file, None
+    except Exception as e:
+        return audio_file, str(e)
+
+
+def run_parallel_batch(jobs: List[Tuple[str, str, str, str]], num_workers: int, **filter_options):
+    """
+    Process batch jobs in a pool of worker processes.
+
+    Args:
+        jobs: (audio_file, speaker_id, output_file, mode) tuples
+        num_workers: Number of worker processes, each with its own pipeline
+        filter_options: SpeakerFilter arguments (use_cache, vad, ...) for every worker
+
+    Returns:
+        List of (audio_file, error) for the files that failed
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    print(f"Starting {num_workers} worker(s) with {num_threads} torch thread(s) each")
+
+    failed = []
+    # spawn, not fork: torch and CUDA state must not be shared with the parent
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=context,
+                             initializer=_init_worker, initargs=(num_threads, filter_options)) as executor:
+        futures = [executor.submit(_run_worker_job, *job) for job in jobs]
+
+        # Report results in completion order
+        for i, future in enumerate(as_completed(futures), 1):
+            audio_file, error = future.result()
+            name = Path(audio_file).name
+            if error:
+                failed.append((audio_file, error))
+                print(f"[{i}/{len(jobs)}] ❌ {name}: {error}")
             else:
-                # Keep non-target speaker segments
-                if last_end < start_ms:
-                    result += audio[last_end:start_ms]
-                result += audio[start_ms:end_ms]
-                last_end = end_ms
+                print(f"[{i}/{len(jobs)}] ✅ {name}")
 
-        # Add any remaining audio
-        if last_end < len(audio):
-            result += audio[last_end:]
+    return failed
 
-        # Export
-        print(f"\nExporting to: {output_path}")
-        result.export(output_path, format=Path(output_path).suffix[1:])
-        print(f"✅ Removed {speaker_id} segments ({result.duration_seconds:.1f}s remaining)")
+
+def find_audio_files(directory: Path) -> List[Path]:
+    """All audio files directly inside a directory"""
+    audio_files = []
+    for ext in ['*.mp3', '*.wav', '*.m4a', '*.flac']:
+        audio_files.extend(directory.glob(ext))
+    return audio_files
+
+
+def filter_options(args) -> dict:
+    """SpeakerFilter arguments from the top-level command-line options"""
+    return {
+        'use_cache': not args.no_cache,
+        'vad': not args.no_vad,
+        'window': args.window,
+        'window_overlap': args.window_overlap,
+        'copy_frames': not args.reencode,
+    }
+
+
+def run_batch(args, speaker_filter: Optional[SpeakerFilter]):
+    """Batch command: process every audio file in a directory"""
+    directory = Path(args.directory)
+    output_dir = Path(args.output_dir) if args.output_dir else directory / 'filtered'
+    output_dir.mkdir(exist_ok=True)
+
+    audio_files = find_audio_files(directory)
+
+    print(f"\nFound {len(audio_files)} audio file(s)")
+
+    mode = 'extract' if args.extract else 'remove'
+    jobs = [
+        (str(audio_file), args.speaker_id,
+         str(output_dir / f"{audio_file.stem}_{mode}_{args.speaker_id}{audio_file.suffix}"), mode)
+        for audio_file in audio_files
+    ]
+
+    if args.workers > 1:
+        failed = run_parallel_batch(jobs, args.workers, **filter_options(args))
+        if failed:
+            print(f"\n❌ {len(failed)} file(s) failed")
+    else:
+        for i, (audio_file, speaker_id, output_file, mode) in enumerate(jobs, 1):
+            print(f"\n{'='*60}")
+            print(f"Processing [{i}/{len(jobs)}]: {Path(audio_file).name}")
+            print(f"{'='*60}")
+
+            try:
+                process_file(speaker_filter, audio_file, speaker_id, output_file, mode)
+            except Exception as e:
+                print(f"❌ Error processing {Path(audio_file).name}: {e}")
+                continue
+
+    print(f"\n✅ Batch processing complete! Output in: {output_dir}")
 
 
 def main():
@@ -290,9 +721,22 @@ Examples:
   # Remove your friend's voice (keep everyone else)
   python speaker_filter.py remove recording.mp3 SPEAKER_00 others_only.mp3
 
+  # Split a recording into one file per speaker
+  python speaker_filter.py extract-all recording.mp3 --others
+
   # Batch process multiple files
   python speaker_filter.py batch /path/to/recordings/ SPEAKER_00 --remove
 
+  # Enroll your friend's voice once, then use the name instead of a speaker ID
+  python speaker_filter.py enroll alice alice_clip1.mp3 alice_clip2.mp3
+  python speaker_filter.py batch /path/to/recordings/ alice --extract
+
+  # Find where an enrolled voice appears across everything processed so far
+  python speaker_filter.py find alice
+
+  # Batch process with 4 worker processes
+  python speaker_filter.py batch /path/to/recordings/ SPEAKER_00 --remove --workers 4
+
 Setup:
   1. Install dependencies: pip install pyannote.audio pydub torch torchaudio
   2. Get HuggingFace token: https://huggingface.co/settings/tokens
@@ -301,42 +745,101 @@ Setup:
         """
     )
 
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Ignore cached diarization results and diarize again')
+    parser.add_argument('--no-vad', action='store_true',
+                        help='Diarize the whole recording instead of only the detected speech')
+    parser.add_argument('--reencode', action='store_true',
+                        help='Re-encode MP3 output instead of copying frames from the MP3 input')
+    parser.add_argument('--window', type=float,
+                        help='Diarize in windows of this many seconds, for multi-hour recordings')
+    parser.add_argument('--window-overlap', type=float, default=30.0,
+                        help='Overlap between diarization windows in seconds (default: 30)')
+    parser.add_argument('--profile', metavar='REPORT',
+                        help='Write a profile (stage timings, top functions) to this file; '
+                             'batch --workers > 1 only profiles the parent process')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='With --profile, also trace memory allocations (slows the run down)')
+
     subparsers = parser.add_subparsers(dest='command', help='Command to run')
 
     # Analyze command
     analyze_parser = subparsers.add_parser('analyze', help='Analyze speakers in audio file')
     analyze_parser.add_argument('audio_file', help='Path to audio file')
     analyze_parser.add_argument('--save-json', help='Save analysis to JSON file')
+    analyze_parser.add_argument('--save-npz', help='Save analysis segments to a compact NumPy .npz file')
 
     # Extract command
     extract_parser = subparsers.add_parser('extract', help='Extract specific speaker segments')
     extract_parser.add_argument('audio_file', help='Path to audio file')
-    extract_parser.add_argument('speaker_id', help='Speaker ID to extract (e.g., SPEAKER_00)')
+    extract_parser.add_argument('speaker_id', help='Speaker ID to extract (e.g., SPEAKER_00) or enrolled name')
     extract_parser.add_argument('output_file', help='Output file path')
 
     # Remove command
     remove_parser = subparsers.add_parser('remove', help='Remove specific speaker segments')
     remove_parser.add_argument('audio_file', help='Path to audio file')
-    remove_parser.add_argument('speaker_id', help='Speaker ID to remove (e.g., SPEAKER_00)')
+    remove_parser.add_argument('speaker_id', help='Speaker ID to remove (e.g., SPEAKER_00) or enrolled name')
     remove_parser.add_argument('output_file', help='Output file path')
 
+    # Extract-all command
+    extract_all_parser = subparsers.add_parser('extract-all', help='Write one file per speaker in a single pass')
+    extract_all_parser.add_argument('audio_file', help='Path to audio file')
+    extract_all_parser.add_argument('--output-dir', help='Output directory (default: a speakers/ directory next to the input)')
+    extract_all_parser.add_argument('--format', help='Output format (default: same as input)')
+    extract_all_parser.add_argument('--others', action='store_true',
+                                    help='Also write an "everyone else" file for each speaker')
+    extract_all_parser.add_argument('--jobs', type=int, default=4,
+                                    help='Number of files encoded in parallel (default: 4)')
+
     # Batch command
     batch_parser = subparsers.add_parser('batch', help='Batch process directory')
     batch_parser.add_argument('directory', help='Directory containing audio files')
-    batch_parser.add_argument('speaker_id', help='Speaker ID to process')
+    batch_parser.add_argument('speaker_id', help='Speaker ID or enrolled name to process')
     batch_parser.add_argument('--extract', action='store_true', help='Extract speaker (default: remove)')
     batch_parser.add_argument('--remove', action='store_true', help='Remove speaker')
     batch_parser.add_argument('--output-dir', help='Output directory (default: same as input)')
+    batch_parser.add_argument('--workers', type=int, default=1,
+                              help='Number of parallel worker processes (default: 1)')
+
+    # Enroll command
+    enroll_parser = subparsers.add_parser('enroll', help='Enroll a named voice from reference clips')
+    enroll_parser.add_argument('name', help='Name for the voice (e.g., alice)')
+    enroll_parser.add_argument('clips', nargs='+', help='Audio clips containing only that speaker')
+
+    # Find command
+    find_parser = subparsers.add_parser('find', help='Find an enrolled voice across all processed files')
+    find_parser.add_argument('name', help='Enrolled name')
+    find_parser.add_argument('--top', type=int, default=20, help='Number of results (default: 20)')
+
+    # Index command
+    index_parser = subparsers.add_parser('index', help='Add every audio file in a directory to the speaker index')
+    index_parser.add_argument('directory', help='Directory containing audio files')
 
     args = parser.parse_args()
 
+    if args.window is not None:
+        try:
+            check_window(args.window, args.window_overlap)
+        except ValueError as e:
+            parser.error(str(e))
+
     if not args.command:
         parser.print_help()
         return
 
+    with profile_session(args.profile, args.profile_memory):
+        return run_command(args)
+
+
+def run_command(args):
+    """Run the parsed command line"""
+    if args.command == 'batch' and args.workers > 1:
+        # Workers load their own pipeline, the parent process doesn't need one
+        return run_batch(args, None)
+
     # Initialize filter
     try:
-        speaker_filter = SpeakerFilter()
+        speaker_filter = SpeakerFilter(**filter_options(args))
     except Exception as e:
         print(f"❌ Failed to initialize: {e}")
         return 1
@@ -347,9 +850,11 @@ Setup:
         speaker_filter.print_analysis(analysis)
 
         if args.save_json:
-            with open(args.save_json, 'w') as f:
-                json.dump(analysis, f, indent=2)
+            analysis.save(args.save_json, format='json')
             print(f"\n💾 Analysis saved to: {args.save_json}")
+        if args.save_npz:
+            analysis.save(args.save_npz, format='npz')
+            print(f"\n💾 Analysis saved to: {args.save_npz}")
 
     elif args.command == 'extract':
         speaker_filter.extract_speaker_segments(
@@ -365,45 +870,42 @@ Setup:
             args.output_file
         )
 
-    elif args.command == 'batch':
-        directory = Path(args.directory)
-        output_dir = Path(args.output_dir) if args.output_dir else directory / 'filtered'
-        output_dir.mkdir(exist_ok=True)
-
-        # Find all audio files
-        audio_files = []
-        for ext in ['*.mp3', '*.wav', '*.m4a', '*.flac']:
-            audio_files.extend(directory.glob(ext))
+    elif args.command == 'extract-all':
+        speaker_filter.extract_all_speakers(
+            args.audio_file,
+            args.output_dir or str(Path(args.audio_file).parent / 'speakers'),
+            output_format=args.format,
+            others=args.others,
+            jobs=args.jobs
+        )
 
-        print(f"\nFound {len(audio_files)} audio file(s)")
+    elif args.command == 'batch':
+        return run_batch(args, speaker_filter)
 
-        mode = 'extract' if args.extract else 'remove'
+    elif args.command == 'enroll':
+        speaker_filter.enroll(args.name, args.clips)
 
+    elif args.command == 'find':
+        try:
+            results = speaker_filter.find(args.name, args.top)
+        except ValueError as e:
+            print(f"❌ {e}")
+            return 1
+        for result in results:
+            print(f"{result['score']:.2f}  {result['path']}  {result['speaker']}  "
+                  f"{result['start']:.1f}s - {result['end']:.1f}s")
+
+    elif args.command == 'index':
+        audio_files = find_audio_files(Path(args.directory))
         for i, audio_file in enumerate(audio_files, 1):
-            print(f"\n{'='*60}")
-            print(f"Processing [{i}/{len(audio_files)}]: {audio_file.name}")
-            print(f"{'='*60}")
-
-            output_file = output_dir / f"{audio_file.stem}_{mode}_{args.speaker_id}{audio_file.suffix}"
-
+            print(f"[{i}/{len(audio_files)}] {audio_file.name}")
             try:
-                if mode == 'extract':
-                    speaker_filter.extract_speaker_segments(
-                        str(audio_file),
-                        args.speaker_id,
-                        str(output_file)
-                    )
-                else:
-                    speaker_filter.remove_speaker_segments(
-                        str(audio_file),
-                        args.speaker_id,
-                        str(output_file)
-                    )
+                analysis = speaker_filter.analyze_speakers(str(audio_file))
+                speaker_filter.speaker_embeddings(str(audio_file), analysis)
             except Exception as e:
                 print(f"❌ Error processing {audio_file.name}: {e}")
-                continue
-
-        print(f"\n✅ Batch processing complete! Output in: {output_dir}")
+        print(f"\n✅ Index holds {len(speaker_filter.index)} segment(s) "
+              f"from {len(speaker_filter.index.files)} file(s)")
 
 
 if __name__ == '__main__':
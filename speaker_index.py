@@ -0,0 +1,359 @@
+"""
+Enrolled voice fingerprints and a cross-file speaker embedding index.
+
+Speaker labels from diarization (SPEAKER_00, ...) are local to one file. Enrolling a
+voice stores its embedding under a name; every processed archive contributes
+per-segment embeddings to an append-only index, so an enrolled name can be resolved
+to the right local label in any file and searched across all indexed archives.
+"""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from cache import get_cache_dir
+
+EMBEDDING_MODEL = "pyannote/wespeaker-voxceleb-resnet34-LM"
+
+# Segments shorter than this give unreliable embeddings
+MIN_SEGMENT_SECONDS = 0.5
+
+# Cosine similarity above which a local speaker is taken to be the enrolled voice
+MATCH_THRESHOLD = 0.5
+
+# Build an IVF partitioning once the index holds this many vectors
+IVF_MIN_SIZE = 50000
+
+# Rebuild it once the vectors appended since the last build exceed this fraction of it
+IVF_REBUILD_FRACTION = 0.25
+
+SEGMENT_DTYPE = np.dtype([('file', '<i4'), ('start', '<f4'), ('end', '<f4'), ('label', '<i2')])
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize rows so dot products are cosine similarities"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-8)
+
+
+@contextmanager
+def _locked(path: str, stale_after: float = 60.0):
+    """Cross-process lock (lock file) so parallel batch workers can append safely"""
+    lock_path = path + '.lock'
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > stale_after:
+                    os.remove(lock_path)
+            except OSError:
+                pass
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+
+class EnrolledVoices:
+    """Named reference embeddings, stored as one small npz file"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.path.join(get_cache_dir('speakers'), 'enrolled.npz')
+        self.voices: Dict[str, np.ndarray] = {}
+        if os.path.exists(self.path):
+            with np.load(self.path) as data:
+                self.voices = dict(zip(data['names'].tolist(), data['embeddings']))
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.voices
+
+    def names(self) -> List[str]:
+        return sorted(self.voices)
+
+    def enroll(self, name: str, embeddings: np.ndarray):
+        """Store the mean of one or more reference embeddings under a name"""
+        self.voices[name] = normalize(normalize(embeddings).mean(axis=0))
+        self.save()
+
+    def save(self):
+        names = self.names()
+        np.savez(self.path, names=np.array(names),
+                 embeddings=np.stack([self.voices[n] for n in names]) if names else np.zeros((0, 0)))
+
+
+class SpeakerEmbeddingIndex:
+    """
+    Append-only index of per-segment speaker embeddings across archives.
+
+    Vectors live in a raw float16 file read through a memory map, segment metadata in a
+    parallel structured array file. Search is a brute-force cosine scan, or an IVF
+    (k-means partitioned) scan once the index is large.
+
+    files.json is the commit record: it is replaced atomically after both data files are
+    appended and holds the number of committed rows. Readers only look at that many rows,
+    and the next writer truncates anything past it (left by a crash mid-append).
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory or get_cache_dir('speakers', 'index')
+        self.files_path = os.path.join(self.directory, 'files.json')
+        self.vectors_path = os.path.join(self.directory, 'vectors.f16')
+        self.segments_path = os.path.join(self.directory, 'segments.bin')
+        self.ivf_path = os.path.join(self.directory, 'ivf.npz')
+
+        self._load()
+
+    def _load(self):
+        self.files: List[dict] = []
+        self.dim: Optional[int] = None
+        self.rows = 0
+        if os.path.exists(self.files_path):
+            with open(self.files_path) as f:
+                meta = json.load(f)
+            self.files = meta['files']
+            self.dim = meta['dim']
+            self.rows = meta.get('rows', self._file_rows())
+        self._keys = {entry['key']: i for i, entry in enumerate(self.files)}
+
+    def _file_rows(self) -> int:
+        """Rows present in both data files (index written before row counts were recorded)"""
+        if not (self.dim and os.path.exists(self.segments_path) and os.path.exists(self.vectors_path)):
+            return 0
+        return min(os.path.getsize(self.segments_path) // SEGMENT_DTYPE.itemsize,
+                   os.path.getsize(self.vectors_path) // (2 * self.dim))
+
+    def _truncate(self):
+        """Drop rows past the committed count (call with the lock held)"""
+        for path, row_size in ((self.vectors_path, 2 * (self.dim or 0)), (self.segments_path, SEGMENT_DTYPE.itemsize)):
+            if os.path.exists(path) and os.path.getsize(path) > self.rows * row_size:
+                with open(path, 'r+b') as f:
+                    f.truncate(self.rows * row_size)
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._keys
+
+    def vectors(self) -> np.ndarray:
+        if not len(self):
+            return np.zeros((0, self.dim or 0), dtype=np.float16)
+        return np.memmap(self.vectors_path, dtype=np.float16, mode='r', shape=(self.rows, self.dim))
+
+    def segments(self) -> np.ndarray:
+        if not len(self):
+            return np.zeros(0, dtype=SEGMENT_DTYPE)
+        return np.memmap(self.segments_path, dtype=SEGMENT_DTYPE, mode='r', shape=(self.rows,))
+
+    def add(self, key: str, path: str, tracks: List[Tuple[float, float, str]], embeddings: np.ndarray):
+        """Append the embeddings of one file's segments (tracks) to the index"""
+        if not len(tracks):
+            return
+
+        with _locked(self.files_path):
+            # Another process may have appended since we loaded, or crashed mid-append
+            self._load()
+            if key in self._keys:
+                return
+            self._truncate()
+
+            embeddings = normalize(embeddings)
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+
+            labels = sorted({label for _, _, label in tracks})
+            records = np.zeros(len(tracks), dtype=SEGMENT_DTYPE)
+            records['file'] = len(self.files)
+            records['start'] = [start for start, _, _ in tracks]
+            records['end'] = [end for _, end, _ in tracks]
+            records['label'] = [labels.index(label) for _, _, label in tracks]
+
+            with open(self.vectors_path, 'ab') as f:
+                f.write(embeddings.astype(np.float16).tobytes())
+            with open(self.segments_path, 'ab') as f:
+                f.write(records.tobytes())
+
+            # Commit: the new rows only count once files.json says so
+            self._keys[key] = len(self.files)
+            self.files.append({'key': key, 'path': path, 'labels': labels})
+            self.rows += len(records)
+            with open(self.files_path + '.part', 'w') as f:
+                json.dump({'dim': self.dim, 'rows': self.rows, 'files': self.files}, f)
+            os.replace(self.files_path + '.part', self.files_path)
+
+    def file_tracks(self, key: str) -> Optional[List[Tuple[float, float, str]]]:
+        """(start, end, speaker) of every indexed segment of a file, in the order they were added"""
+        if key not in self._keys:
+            return None
+        file_id = self._keys[key]
+        labels = self.files[file_id]['labels']
+        segments = self.segments()
+        rows = segments[segments['file'] == file_id]
+        return [(float(row['start']), float(row['end']), labels[row['label']]) for row in rows]
+
+    def file_embeddings(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        """Per-label segment embeddings of an indexed file, without recomputing anything"""
+        if key not in self._keys:
+            return None
+        file_id = self._keys[key]
+        labels = self.files[file_id]['labels']
+        rows = np.nonzero(self.segments()['file'] == file_id)[0]
+        local = self.segments()['label'][rows]
+        vectors = self.vectors()
+        return {label: np.asarray(vectors[rows[local == i]], dtype=np.float32) for i, label in enumerate(labels)}
+
+    def build_ivf(self, n_lists: Optional[int] = None, iterations: int = 10):
+        """Partition the vectors with k-means so searches only scan a few partitions"""
+        vectors = self.vectors()
+        n_lists = n_lists or max(1, int(np.sqrt(len(vectors))))
+        rng = np.random.default_rng(0)
+
+        sample = np.asarray(vectors[rng.choice(len(vectors), min(len(vectors), n_lists * 64), replace=False)],
+                            dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for i in range(n_lists):
+                members = sample[assignment == i]
+                if len(members):
+                    centroids[i] = members.mean(axis=0)
+            centroids = normalize(centroids)
+
+        # Assign every vector in blocks to keep memory bounded
+        assignment = np.concatenate([
+            np.argmax(np.asarray(vectors[i:i + 65536], dtype=np.float32) @ centroids.T, axis=1)
+            for i in range(0, len(vectors), 65536)
+        ])
+        order = np.argsort(assignment, kind='stable')
+        offsets = np.searchsorted(assignment[order], np.arange(n_lists + 1))
+        with open(self.ivf_path + f'.{os.getpid()}.part', 'wb') as f:
+            np.savez(f, centroids=centroids, order=order, offsets=offsets, size=len(vectors))
+        os.replace(self.ivf_path + f'.{os.getpid()}.part', self.ivf_path)
+
+    def _load_ivf(self):
+        if not os.path.exists(self.ivf_path):
+            return None
+        with np.load(self.ivf_path) as data:
+            # Vectors appended after the last build are scanned separately
+            return {key: data[key] for key in data.files}
+
+    def search(self, query: np.ndarray, k: int = 20, n_probe: int = 8) -> List[dict]:
+        """Most similar indexed segments to a query embedding"""
+        # Pick up files committed by other processes; files.json is replaced atomically
+        self._load()
+        if not len(self):
+            return []
+
+        query = normalize(query)
+        vectors = self.vectors()
+
+        ivf = self._load_ivf()
+        if len(vectors) >= IVF_MIN_SIZE and (
+                ivf is None or len(vectors) - int(ivf['size']) > IVF_REBUILD_FRACTION * int(ivf['size'])):
+            self.build_ivf()
+            ivf = self._load_ivf()
+
+        if ivf is not None:
+            nearest = np.argsort(ivf['centroids'] @ query)[::-1][:n_probe]
+            candidates = [ivf['order'][ivf['offsets'][i]:ivf['offsets'][i + 1]] for i in nearest]
+            candidates.append(np.arange(int(ivf['size']), len(vectors)))
+            candidates = np.sort(np.concatenate(candidates))
+            # A partitioning built by another process may already cover rows we don't see yet
+            candidates = candidates[candidates < len(vectors)]
+            scores = np.asarray(vectors[candidates], dtype=np.float32) @ query
+        else:
+            candidates = np.arange(len(vectors))
+            scores = np.concatenate([
+                np.asarray(vectors[i:i + 65536], dtype=np.float32) @ query
+                for i in range(0, len(vectors), 65536)
+            ])
+
+        top = np.argsort(scores)[::-1][:k]
+        segments = self.segments()
+        results = []
+        for i in top:
+            row = segments[candidates[i]]
+            entry = self.files[row['file']]
+            results.append({
+                'path': entry['path'],
+                'speaker': entry['labels'][row['label']],
+                'start': float(row['start']),
+                'end': float(row['end']),
+                'score': float(scores[i]),
+            })
+        return results
+
+
+class LabelLinker:
+    """
+    Links window-local speaker labels to global labels by embedding similarity.
+
+    Used by windowed diarization: each window labels its speakers independently, and
+    each local speaker is mapped to the most similar global speaker seen so far (or a
+    new one), keeping a running centroid per global speaker.
+    """
+
+    def __init__(self, threshold: float = MATCH_THRESHOLD, prefix: str = 'SPEAKER_'):
+        self.threshold = threshold
+        self.prefix = prefix
+        self.centroids: List[np.ndarray] = []
+        self.counts: List[int] = []
+
+    def _new_label(self, embedding: Optional[np.ndarray]) -> int:
+        self.centroids.append(embedding)
+        self.counts.append(0 if embedding is None else 1)
+        return len(self.centroids) - 1
+
+    def link(self, labels: List[str], embeddings: np.ndarray) -> Dict[str, str]:
+        """Map this window's local labels to global labels"""
+        valid = [i for i, e in enumerate(embeddings) if np.all(np.isfinite(e))]
+        known = [i for i, c in enumerate(self.centroids) if c is not None]
+
+        mapping: Dict[str, int] = {}
+        if valid and known:
+            scores = normalize(embeddings[valid]) @ normalize(np.stack([self.centroids[i] for i in known])).T
+            # Greedy one-to-one assignment, best pairs first
+            for flat in np.argsort(scores, axis=None)[::-1]:
+                row, col = np.unravel_index(flat, scores.shape)
+                if scores[row, col] < self.threshold:
+                    break
+                local = labels[valid[row]]
+                if local in mapping or known[col] in mapping.values():
+                    continue
+                mapping[local] = known[col]
+
+        for i, label in enumerate(labels):
+            embedding = normalize(embeddings[i]) if i in valid else None
+            if label not in mapping:
+                mapping[label] = self._new_label(embedding)
+            elif embedding is not None:
+                # Running mean of the linked global speaker
+                g = mapping[label]
+                self.counts[g] += 1
+                self.centroids[g] = self.centroids[g] + (embedding - self.centroids[g]) / self.counts[g]
+
+        return {label: f'{self.prefix}{g:02d}' for label, g in mapping.items()}
+
+
+def match_speaker(enrolled: np.ndarray, speaker_embeddings: Dict[str, np.ndarray],
+                  threshold: float = MATCH_THRESHOLD) -> Tuple[Optional[str], float]:
+    """Local speaker label whose centroid is closest to an enrolled voice"""
+    best, best_score = None, -1.0
+    for label, vectors in speaker_embeddings.items():
+        if not len(vectors):
+            continue
+        score = float(normalize(normalize(vectors).mean(axis=0)) @ normalize(enrolled))
+        if score > best_score:
+            best, best_score = label, score
+    if best_score < threshold:
+        return None, best_score
+    return best, best_score
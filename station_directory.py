@@ -0,0 +1,208 @@
+import bisect
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+from cache import get_cache_dir
+
+
+# Most results a search returns
+MAX_RESULTS = 50
+
+
+def directory_path():
+  return os.path.join(get_cache_dir('stations'), 'stations.json')
+
+
+def _words(text):
+  return [word for word in re.split(r'[^a-z0-9.]+', text.lower()) if word]
+
+
+def _frequency_forms(frequency):
+  """'118.700' -> ['118.700', '118.7'] so typing either form matches"""
+  forms = [frequency]
+  if '.' in frequency:
+    trimmed = frequency.rstrip('0').rstrip('.')
+    if trimmed != frequency:
+      forms.append(trimmed)
+  return forms
+
+
+def _trigrams(text):
+  return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class StationIndex:
+  """In-memory prefix and trigram index over stations
+
+  Every station is searchable by ICAO code, identifier, title, frequency titles and
+  frequencies. A query term matches a station when some token starts with it (sorted token
+  list + bisect), or, failing that, for terms of 3+ characters, when it occurs anywhere in
+  the station's text (trigram posting lists, then a substring check). All terms of a query
+  must match. Exact ICAO matches rank first, then ICAO/identifier prefixes, then online
+  stations, then by identifier.
+  """
+
+  def __init__(self, stations):
+    self.stations = list(stations)
+    self.texts = []
+    tokens = []
+    names = []
+    self.trigrams = {}
+    for i, station in enumerate(self.stations):
+      names.extend((name, i) for name in {station.get('icao', '').lower(), station['identifier'].lower()} if name)
+
+      words = set()
+      words.update(_words(station.get('icao', '')))
+      words.update(_words(station['identifier'].replace('_', ' ')))
+      words.add(station['identifier'].lower())
+      words.update(_words(station['title']))
+      for freq in station['frequencies']:
+        words.update(_words(freq['title']))
+        words.update(_frequency_forms(freq['frequency'].strip()))
+      tokens.extend((word, i) for word in words)
+
+      text = ' '.join(sorted(words))
+      self.texts.append(text)
+      for trigram in _trigrams(text):
+        self.trigrams.setdefault(trigram, set()).add(i)
+
+    tokens.sort()
+    self.tokens = [token for token, _ in tokens]
+    self.token_stations = [i for _, i in tokens]
+
+    # ICAO codes and identifiers alone, for ranking
+    names.sort()
+    self.names = [name for name, _ in names]
+    self.name_stations = [i for _, i in names]
+    self.icao_stations = {}
+    for i, station in enumerate(self.stations):
+      self.icao_stations.setdefault(station.get('icao', '').lower(), []).append(i)
+
+    order = sorted(range(len(self.stations)),
+                   key=lambda i: (not self.stations[i].get('up', True), self.stations[i]['identifier'].lower()))
+    self.rank = np.empty(len(self.stations), dtype=np.int64)
+    self.rank[order] = np.arange(len(self.stations))
+
+  def __len__(self):
+    return len(self.stations)
+
+  @staticmethod
+  def _prefix(tokens, stations, term):
+    first = bisect.bisect_left(tokens, term)
+    last = bisect.bisect_left(tokens, term + '\uffff')
+    return set(stations[first:last])
+
+  def _substring(self, term):
+    postings = [self.trigrams.get(trigram) for trigram in _trigrams(term)]
+    if not postings or any(p is None for p in postings):
+      return set()
+    candidates = set.intersection(*postings)
+    return {i for i in candidates if term in self.texts[i]}
+
+  def _rank(self, matches, terms, limit):
+    n = len(self.stations)
+    keys = self.rank.copy()
+    for term in terms:
+      keys[list(self._prefix(self.names, self.name_stations, term))] -= 2 * n
+      keys[self.icao_stations.get(term, [])] -= 2 * n
+
+    matches = np.fromiter(matches, dtype=np.int64, count=len(matches))
+    match_keys = keys[matches]
+    if len(matches) > limit:
+      best = np.argpartition(match_keys, limit)[:limit]
+      matches, match_keys = matches[best], match_keys[best]
+    return matches[np.argsort(match_keys, kind='stable')]
+
+  def search(self, query, limit=MAX_RESULTS):
+    """Stations matching every term of a query, best matches first"""
+    terms = _words(query)
+    if not terms:
+      return []
+
+    matches = None
+    for term in terms:
+      found = self._prefix(self.tokens, self.token_stations, term)
+      if not found and len(term) >= 3:
+        found = self._substring(term)
+      matches = found if matches is None else matches & found
+      if not matches:
+        return []
+
+    return [self.stations[i] for i in self._rank(matches, terms, limit)]
+
+
+class StationDirectory:
+  """Stations seen in searches, kept on disk so they can be searched offline
+
+  Fill it with update() from live searches (the CLI and GUI do this on every search);
+  search() then answers instantly from the in-memory index.
+  """
+
+  def __init__(self, path=None):
+    self.path = path or directory_path()
+    self.stations = {}
+    if os.path.exists(self.path):
+      try:
+        with open(self.path) as f:
+          for station in json.load(f).get('stations', []):
+            self.stations[station['identifier']] = station
+      except (OSError, ValueError, KeyError, AttributeError):
+        # Unreadable or corrupt: start over, it only caches lookups (rewritten on save)
+        self.stations = {}
+    self._index = None
+
+  def __len__(self):
+    return len(self.stations)
+
+  @property
+  def index(self):
+    if self._index is None:
+      self._index = StationIndex(self.stations.values())
+    return self._index
+
+  def update(self, icao, stations):
+    """Replace what is known about an airport with fresh search results"""
+    icao = icao.upper()
+    for identifier in [key for key, station in self.stations.items() if station.get('icao') == icao]:
+      del self.stations[identifier]
+    now = time.time()
+    for station in stations:
+      self.stations[station['identifier']] = {**station, 'icao': icao, 'updated': now}
+    self._index = None
+
+  def save(self):
+    part_path = self.path + '.part'
+    with open(part_path, 'w') as f:
+      json.dump({'stations': sorted(self.stations.values(), key=lambda station: station['identifier'])}, f)
+    os.replace(part_path, self.path)
+
+  def search(self, query, limit=MAX_RESULTS):
+    return self.index.search(query, limit)
+
+
+def refresh(icaos, directory=None, delay=2.0, log=print, on_result=None):
+  """Look up airports on LiveATC and record their stations in the directory
+
+  on_result(icao, stations) is called with every airport's stations as they come in.
+  """
+  from liveatc import get_stations
+
+  if directory is None:
+    directory = StationDirectory()
+  for i, icao in enumerate(icaos):
+    try:
+      stations = list(get_stations(icao.upper()))
+      directory.update(icao, stations)
+      if on_result is not None:
+        on_result(icao.upper(), stations)
+      log(f"[OK] {icao.upper()}: {len(stations)} station(s)")
+    except Exception as e:
+      log(f"[FAIL] {icao.upper()}: {e}")
+    if delay > 0 and i < len(icaos) - 1:
+      time.sleep(delay)
+  directory.save()
+  return directory
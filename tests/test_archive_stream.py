@@ -0,0 +1,58 @@
+import pytest
+
+import liveatc
+from liveatc import ArchiveStream, IncompleteDownload
+
+
+class FakeResponse:
+  def __init__(self, chunks, headers):
+    self.chunks = chunks
+    self.headers = headers
+
+  def raise_for_status(self):
+    pass
+
+  def iter_content(self, chunk_size):
+    return iter(self.chunks)
+
+
+def stream(monkeypatch, chunks, headers):
+  monkeypatch.setattr(liveatc.requests, 'get', lambda *args, **kwargs: FakeResponse(chunks, headers))
+  archive = ArchiveStream('https://example.com/archive.mp3')
+  archive.download()
+  return archive
+
+
+def test_complete_stream(monkeypatch):
+  archive = stream(monkeypatch, [b'abc', b'de'], {'Content-Type': 'audio/mpeg', 'Content-Length': '5'})
+  assert b''.join(archive) == b'abcde'
+
+
+def test_short_stream_raises(monkeypatch):
+  archive = stream(monkeypatch, [b'abc'], {'Content-Type': 'audio/mpeg', 'Content-Length': '5'})
+  with pytest.raises(IncompleteDownload, match='3 of 5'):
+    b''.join(archive)
+
+
+@pytest.mark.parametrize('headers', [
+  {'Content-Type': 'audio/mpeg'},
+  # Content-Length counts the encoded bytes, iter_content yields decoded ones
+  {'Content-Type': 'audio/mpeg', 'Content-Length': '2', 'Content-Encoding': 'gzip'},
+])
+def test_length_check_is_skipped_without_a_comparable_length(monkeypatch, headers):
+  assert b''.join(stream(monkeypatch, [b'abc'], headers)) == b'abc'
+
+
+def test_cancelled_stream_is_not_an_error(monkeypatch):
+  monkeypatch.setattr(liveatc.requests, 'get', lambda *args, **kwargs: FakeResponse(
+    [b'abc', b'de'], {'Content-Type': 'audio/mpeg', 'Content-Length': '5'}))
+  archive = ArchiveStream('https://example.com/archive.mp3')
+
+  def cancel_after_first(chunk):
+    archive.cancelled.set()
+    put(chunk)
+
+  put = archive.chunks.put
+  archive.chunks.put = cancel_after_first
+  archive.download()
+  assert b''.join(archive) == b'abc'
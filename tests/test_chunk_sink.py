@@ -0,0 +1,90 @@
+import json
+import wave
+
+import numpy as np
+import pytest
+
+from chunk_sink import ArchiveSink, BackgroundWriter, ChunkStore, WavFilesSink
+
+
+RATE = 8000
+
+
+def chunks(count=5, channels=2, seed=0):
+  """(index, kind, start ms, end ms, frames) for both kinds of every chunk"""
+  rng = np.random.default_rng(seed)
+  out = []
+  for i in range(count):
+    frames = rng.integers(-30000, 30000, (int(rng.integers(100, 2000)), channels)).astype('<i2')
+    out.append((i, 'orig', i * 1000, i * 1000 + 500, frames))
+    out.append((i, 'nr', i * 1000, i * 1000 + 500, frames // 2))
+  return out
+
+
+def run(sink, items):
+  writer = BackgroundWriter(sink, max_pending=2)
+  writer.open(RATE, 2, '<i2')
+  for item in items:
+    writer.write(*item)
+  writer.close()
+
+
+def test_chunk_store_round_trip(tmp_path):
+  items = chunks()
+  run(ChunkStore(str(tmp_path / 'out.chunks')), items)
+
+  store = ChunkStore.open_store(str(tmp_path / 'out.chunks'))
+  assert len(store) == 5
+  for index, kind, _, _, frames in items:
+    chunk = store.chunk(index, kind)
+    assert chunk.frame_rate == RATE
+    np.testing.assert_array_equal(chunk.samples, frames)
+  with pytest.raises(KeyError):
+    store.chunk(5)
+
+
+def test_archive_sink_writes_one_file_per_kind_and_an_index(tmp_path):
+  items = chunks()
+  run(ArchiveSink(str(tmp_path), 'rec'), items)
+
+  with open(tmp_path / 'rec.segments.json') as f:
+    index = json.load(f)
+  with wave.open(str(tmp_path / 'rec-nr.wav')) as f:
+    assert (f.getframerate(), f.getnchannels(), f.getsampwidth()) == (RATE, 2, 2)
+    nr = np.frombuffer(f.readframes(f.getnframes()), dtype='<i2').reshape(-1, 2)
+
+  for (chunk, start_ms, end_ms, first, count), (expected, _, start, end, frames) in zip(index['segments'], items[1::2]):
+    assert (chunk, start_ms, end_ms) == (expected, start, end)
+    np.testing.assert_array_equal(nr[first:first + count], frames)
+
+
+def test_wav_files_sink(tmp_path):
+  items = chunks(count=2)
+  run(WavFilesSink(str(tmp_path)), items)
+  assert sorted(p.name for p in tmp_path.iterdir()) == [
+    'chunk-0-nr.wav', 'chunk-0-orig.wav', 'chunk-1-nr.wav', 'chunk-1-orig.wav']
+
+
+@pytest.mark.parametrize('make_sink', [
+  lambda path: ArchiveSink(str(path), 'rec'),
+  lambda path: ChunkStore(str(path / 'out.chunks')),
+])
+def test_abort_leaves_no_output(tmp_path, make_sink):
+  writer = BackgroundWriter(make_sink(tmp_path))
+  writer.open(RATE, 2, '<i2')
+  for item in chunks()[:3]:
+    writer.write(*item)
+  writer.abort()
+  assert list(tmp_path.iterdir()) == []
+
+
+def test_writer_error_aborts_the_sink(tmp_path):
+  sink = ChunkStore(str(tmp_path / 'out.chunks'))
+  writer = BackgroundWriter(sink)
+  writer.open(RATE, 2, '<i2')
+  writer.write(0, 'orig', 0, 500, np.zeros((10, 2), dtype='<i2'))
+  # Not a kind the store knows
+  writer.write(0, 'other', 0, 500, np.zeros((10, 2), dtype='<i2'))
+  with pytest.raises(ValueError):
+    writer.close()
+  assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,195 @@
+import threading
+from datetime import timedelta
+
+import pytest
+
+from job_queue import RETENTION, JobQueue, expires_at, utc_now
+
+
+@pytest.fixture
+def queue(tmp_path):
+  queue = JobQueue(str(tmp_path / 'jobs.sqlite'))
+  yield queue
+  queue.close()
+
+
+# Fixed once so that task times compare equal across calls
+NOW = utc_now().replace(second=0, microsecond=0)
+
+
+def recent(hours=0):
+  """A 30-minute boundary well inside LiveATC's retention"""
+  return NOW.replace(minute=0) - timedelta(days=1) + timedelta(hours=hours)
+
+
+def expiring(hours):
+  """Start of an archive LiveATC deletes in about this many hours"""
+  return NOW - RETENTION + timedelta(hours=hours)
+
+
+def run_out_leases(queue):
+  """As if every worker holding a lease had died"""
+  with queue.lock:
+    queue.db.execute("UPDATE tasks SET lease_expires = 0 WHERE status = 'leased'")
+
+
+def test_add_queues_each_interval_once(queue):
+  assert queue.add('kjfk_twr', recent(), recent(2)) == 5
+  assert queue.add('kjfk_twr', recent(1), recent(3)) == 2
+  assert queue.counts() == {'pending': 7}
+
+
+def test_lease_complete(queue):
+  queue.add('kjfk_twr', recent(), recent())
+  task = queue.lease('a')
+  assert (task['station'], task['start'], task['attempts']) == ('kjfk_twr', recent(), 1)
+  assert queue.lease('b') is None
+  assert queue.remaining() == 1
+
+  queue.complete(task['id'], 'a', '/tmp/archive.mp3')
+  assert queue.counts() == {'done': 1}
+  assert queue.remaining() == 0
+
+
+def test_heartbeat_only_for_the_lease_holder(queue):
+  queue.add('kjfk_twr', recent(), recent())
+  task = queue.lease('a')
+  assert queue.heartbeat(task['id'], 'a')
+  assert not queue.heartbeat(task['id'], 'b')
+
+
+def test_expired_lease_goes_to_another_worker(queue):
+  queue.add('kjfk_twr', recent(), recent())
+  task = queue.lease('a')
+  run_out_leases(queue)
+
+  again = queue.lease('b')
+  assert again['id'] == task['id'] and again['attempts'] == 2
+  # The first worker lost it
+  assert not queue.heartbeat(task['id'], 'a')
+
+
+def test_fail_retries_until_max_attempts(queue):
+  queue.add('kjfk_twr', recent(), recent())
+  for attempt in range(1, queue.max_attempts + 1):
+    task = queue.lease('a')
+    assert task['attempts'] == attempt
+    queue.fail(task['id'], 'a', 'timed out')
+  assert queue.lease('a') is None
+  assert queue.counts() == {'failed': 1}
+
+
+def test_fail_without_retry(queue):
+  queue.add('kjfk_twr', recent(), recent())
+  task = queue.lease('a')
+  queue.fail(task['id'], 'a', '404 Not Found', retry=False)
+  assert queue.counts() == {'failed': 1}
+
+
+def test_task_that_keeps_killing_its_worker_is_abandoned(queue):
+  queue.add('kjfk_twr', recent(), recent())
+  for _ in range(queue.max_attempts):
+    assert queue.lease('a') is not None
+    run_out_leases(queue)
+
+  assert queue.lease('a') is None
+  assert queue.counts() == {'failed': 1}
+  assert queue.remaining() == 0
+
+
+def test_concurrent_workers_never_share_a_task(tmp_path):
+  path = str(tmp_path / 'jobs.sqlite')
+  setup = JobQueue(path)
+  setup.add('kjfk_twr', recent(), recent(24))
+  setup.close()
+
+  leased = []
+
+  def worker(name):
+    queue = JobQueue(path)
+    while (task := queue.lease(name)) is not None:
+      leased.append(task['id'])
+      queue.complete(task['id'], name, 'path')
+    queue.close()
+
+  threads = [threading.Thread(target=worker, args=(f'w{i}',)) for i in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  assert sorted(leased) == list(range(1, 50))
+
+
+def test_lease_oldest_archive_first_across_stations(queue):
+  queue.add('kjfk_twr', recent(10), recent(11))
+  queue.add('kpdx_app', recent(), recent(1))
+  queue.add('kjfk_twr', recent(5), recent(5))
+
+  order = []
+  while (task := queue.lease('a')) is not None:
+    order.append((task['start'], task['station']))
+    queue.complete(task['id'], 'a', 'path')
+  assert order == sorted(order)
+  assert order[0] == (recent(), 'kpdx_app')
+
+
+def test_tasks_past_retention_are_expired(queue):
+  queue.add('kjfk_twr', expiring(-1), expiring(-1))
+  queue.add('kjfk_twr', recent(), recent())
+  assert queue.lease('a')['start'] == recent()
+  assert queue.counts() == {'expired': 1, 'leased': 1}
+
+
+def test_expire_margin(queue):
+  queue.add('kjfk_twr', expiring(1), expiring(1))
+  assert queue.expire() == 0
+  assert queue.expire(margin=2 * 3600) == 1
+  assert queue.counts() == {'expired': 1}
+
+
+def test_expire_leaves_live_leases_alone(queue):
+  queue.add('kjfk_twr', expiring(1), expiring(1))
+  queue.lease('a')
+  assert queue.expire(margin=2 * 3600) == 0
+  run_out_leases(queue)
+  assert queue.expire(margin=2 * 3600) == 1
+
+
+def test_task_seconds_shares_throughput_between_busy_workers(queue):
+  assert queue.task_seconds() is None
+  assert queue.task_seconds(throughput=0.5) == 2
+  queue.add('kjfk_twr', recent(), recent(1))
+  queue.lease('a')
+  queue.lease('b')
+  assert queue.task_seconds(throughput=0.5) == 6
+
+
+def test_lease_skips_tasks_that_expire_before_they_could_finish(queue):
+  queue.add('kjfk_twr', recent(), recent())
+  # One task finished in the last hour: about an hour per task
+  done = queue.lease('a')
+  queue.complete(done['id'], 'a', 'path')
+  with queue.lock:
+    queue.db.execute('UPDATE tasks SET updated = updated - 3500 WHERE id = ?', (done['id'],))
+
+  queue.add('kjfk_twr', expiring(0.5), expiring(0.5))
+  assert queue.lease('a') is None
+  assert queue.counts() == {'done': 1, 'expired': 1}
+
+
+def test_at_risk(queue):
+  queue.add('kjfk_twr', expiring(0.25), expiring(2.25))
+  queue.add('kjfk_twr', recent(), recent())
+
+  # At one task every 40 minutes, the tasks expiring in 0.25 to 2.25 hours are reached
+  # after 0, 0.67, 1.33, 2 and 2.67 hours
+  throughput, tasks = queue.at_risk(throughput=1 / 2400)
+  assert throughput == 1 / 2400
+  assert [task['start'] for task in tasks] == [expiring(1.25), expiring(1.75), expiring(2.25)]
+  assert all(task['expires'] == expires_at(task['start']) < task['eta'] for task in tasks)
+
+  # Nothing measured: anything expiring within the throughput window
+  throughput, tasks = queue.at_risk()
+  assert throughput is None
+  assert [task['start'] for task in tasks] == [expiring(0.25), expiring(0.75)]
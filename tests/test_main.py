@@ -0,0 +1,19 @@
+from argparse import Namespace
+
+import analytics
+import liveatc
+import main
+
+
+def test_analytics_with_no_readable_archives(tmp_path, monkeypatch, capsys):
+  path = str(tmp_path / 'KPDX3-Twr-123775-Oct-01-2021-2000Z.mp3')
+  monkeypatch.setattr(liveatc, 'find_archives', lambda directory: [path])
+  monkeypatch.setattr(analytics, 'analyze_archives',
+                      lambda paths, **kwargs: (analytics.build_report([]), [(path, 'truncated')]))
+
+  main.analytics(Namespace(directory=str(tmp_path), station=None, workers=None, csv=None, npz=None,
+                           silence_thresh=-48))
+
+  out = capsys.readouterr().out
+  assert '[FAIL] KPDX3-Twr-123775-Oct-01-2021-2000Z.mp3: truncated' in out
+  assert 'No archives could be analyzed' in out
@@ -0,0 +1,162 @@
+import numpy as np
+import pytest
+
+from mp3_frames import (DECODER_DELAY, MP3Frames, cut_mp3, iter_audio_bytes, load_seek_index, parse_header,
+                        scan_frames, seek_index_path, stream_info)
+
+
+# MPEG 1 Layer III, 128 kbps, 44.1 kHz, mono
+MPEG1_L3 = bytes([0xFF, 0xFB, 0x90, 0xC0])
+MPEG1_L3_SIZE = 417
+
+
+def frame(header=MPEG1_L3, size=MPEG1_L3_SIZE, fill=0):
+  return header + bytes([fill]) * (size - len(header))
+
+
+def info_frame(delay):
+  """Xing 'Info' header frame with a LAME extension holding an encoder delay"""
+  data = bytearray(frame())
+  tag = 4 + 17
+  data[tag:tag + 8] = b'Info' + bytes(4)
+  lame = tag + 8
+  data[lame:lame + 4] = b'LAME'
+  data[lame + 21:lame + 24] = (delay << 12).to_bytes(3, 'big')
+  return bytes(data)
+
+
+def id3v2(size=30):
+  return b'ID3\x04\x00\x00' + bytes([0, 0, 0, size]) + bytes(size)
+
+
+def id3v1():
+  return b'TAG' + bytes(125)
+
+
+@pytest.mark.parametrize('header, expected', [
+  # MPEG 1 Layer III, 128 kbps, 44.1 kHz, mono
+  (MPEG1_L3, (417, 1152, 44100, 1)),
+  # ...with the padding bit set
+  (bytes([0xFF, 0xFB, 0x92, 0xC0]), (418, 1152, 44100, 1)),
+  # ...joint stereo
+  (bytes([0xFF, 0xFB, 0x90, 0x40]), (417, 1152, 44100, 2)),
+  # MPEG 2 Layer III, 64 kbps, 22.05 kHz: half as many samples per frame
+  (bytes([0xFF, 0xF3, 0x80, 0xC0]), (208, 576, 22050, 1)),
+  # MPEG 2.5 Layer III, 32 kbps, 11.025 kHz
+  (bytes([0xFF, 0xE3, 0x40, 0xC0]), (208, 576, 11025, 1)),
+  # MPEG 1 Layer II, 192 kbps, 48 kHz
+  (bytes([0xFF, 0xFD, 0xA4, 0x00]), (576, 1152, 48000, 2)),
+  # MPEG 1 Layer I, 384 kbps, 44.1 kHz: sizes count 4 byte slots
+  (bytes([0xFF, 0xFF, 0xC0, 0xC0]), (416, 384, 44100, 1)),
+])
+def test_parse_header(header, expected):
+  assert parse_header(b'\x00\x00' + header, 2) == expected
+
+
+@pytest.mark.parametrize('header', [
+  bytes([0xFE, 0xFB, 0x90, 0xC0]),  # no sync word
+  bytes([0xFF, 0xEB, 0x90, 0xC0]),  # reserved version
+  bytes([0xFF, 0xF9, 0x90, 0xC0]),  # reserved layer
+  bytes([0xFF, 0xFB, 0x00, 0xC0]),  # free format bitrate
+  bytes([0xFF, 0xFB, 0xF0, 0xC0]),  # bad bitrate
+  bytes([0xFF, 0xFB, 0x9C, 0xC0]),  # reserved sample rate
+  bytes([0xFF, 0xFB, 0x90]),  # truncated
+])
+def test_parse_header_rejects_invalid(header):
+  assert parse_header(header, 0) is None
+
+
+def test_scan_frames_skips_tags_and_info_frame(tmp_path):
+  path = tmp_path / 'test.mp3'
+  path.write_bytes(id3v2() + info_frame(576) + frame() * 5 + id3v1())
+
+  frames = scan_frames(str(path))
+  start = len(id3v2()) + MPEG1_L3_SIZE
+  assert frames.offsets.tolist() == [start + i * MPEG1_L3_SIZE for i in range(5)]
+  assert frames.sizes.tolist() == [MPEG1_L3_SIZE] * 5
+  assert (frames.sample_rate, frames.samples_per_frame, frames.channels) == (44100, 1152, 1)
+  assert frames.skip_samples == 576 + DECODER_DELAY
+
+
+def test_scan_frames_resyncs_past_garbage(tmp_path):
+  path = tmp_path / 'test.mp3'
+  # A lone sync word that is not followed by a frame is not trusted
+  path.write_bytes(frame() * 2 + b'\xff\xfb\x90\xc0junk' + frame() * 2)
+
+  frames = scan_frames(str(path))
+  assert frames.offsets.tolist() == [0, MPEG1_L3_SIZE, 2 * MPEG1_L3_SIZE + 8, 3 * MPEG1_L3_SIZE + 8]
+  assert frames.skip_samples == 0
+
+
+def test_scan_frames_rejects_non_mp3(tmp_path):
+  path = tmp_path / 'test.mp3'
+  path.write_bytes(bytes(1000))
+  with pytest.raises(ValueError):
+    scan_frames(str(path))
+
+
+def test_stream_info():
+  info = stream_info(id3v2() + info_frame(576) + frame() * 2)
+  assert info == {
+    'data_start': len(id3v2()) + MPEG1_L3_SIZE,
+    'sample_rate': 44100,
+    'samples_per_frame': 1152,
+    'channels': 1,
+    'bitrate': 128000,
+    'skip_samples': 576 + DECODER_DELAY,
+  }
+  assert stream_info(bytes(1000)) is None
+
+
+@pytest.mark.parametrize('chunk_size', [1, 100, 4096, 1 << 20])
+def test_iter_audio_bytes_strips_tags(chunk_size):
+  audio = b''.join(frame(fill=i) for i in range(1, 6))
+  data = id3v2() + info_frame(576) + audio + id3v1()
+  chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+  assert b''.join(iter_audio_bytes(chunks, probe_bytes=2048)) == audio
+
+
+def test_frame_ranges_round_outwards_and_merge():
+  frames = MP3Frames(np.arange(10) * 100, np.full(10, 100), 1000, 100, 1)
+  # 100 ms frames
+  assert frames.frame_at(0) == 0
+  assert frames.frame_at(250) == 2
+  assert frames.frame_at(5000) == 10
+  assert frames.frame_ranges([(250, 320), (310, 420), (700, 700), (800, 2000)]) == [[2, 5], [8, 10]]
+  assert frames.byte_range(2, 5) == (200, 500)
+
+
+def test_frame_ranges_account_for_encoder_delay():
+  frames = MP3Frames(np.arange(10) * 100, np.full(10, 100), 1000, 100, 1, skip_samples=50)
+  assert frames.frame_at(0) == 0
+  assert frames.frame_at(60) == 1
+  assert frames.frame_ranges([(0, 100)]) == [[0, 2]]
+  assert frames.duration_seconds == 0.95
+
+
+def test_cut_mp3_copies_whole_frames(tmp_path):
+  path = tmp_path / 'test.mp3'
+  audio = [frame(fill=i) for i in range(1, 11)]
+  path.write_bytes(id3v2() + b''.join(audio))
+  output = tmp_path / 'cut.mp3'
+
+  frame_ms = 1152 * 1000 / 44100
+  seconds = cut_mp3(str(path), [(frame_ms * 2.5, frame_ms * 3.5), (frame_ms * 8.2, frame_ms * 20)], str(output))
+
+  assert output.read_bytes() == b''.join(audio[2:4] + audio[8:])
+  assert seconds == pytest.approx(4 * 1152 / 44100)
+
+
+def test_seek_index_is_reused_until_the_file_changes(tmp_path):
+  path = tmp_path / 'test.mp3'
+  path.write_bytes(frame() * 3)
+
+  assert len(load_seek_index(str(path))) == 3
+  index_path = seek_index_path(str(path))
+  first_build = (tmp_path / index_path).stat().st_mtime_ns
+
+  assert len(load_seek_index(str(path))) == 3
+  assert (tmp_path / index_path).stat().st_mtime_ns == first_build
+
+  path.write_bytes(frame() * 4)
+  assert len(load_seek_index(str(path))) == 4
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from audio_utils import (_from_float, _to_float, estimate_noise_profile, istft, reduce_noise_batch,
+                         spectral_gate, stft)
+
+
+SR = 22050
+
+
+def tone_over_noise(seed=1):
+  """One second of hiss, then two seconds of hiss plus an 800 Hz tone"""
+  rng = np.random.default_rng(seed)
+  noise = rng.standard_normal(SR * 5) * 300
+  t = np.arange(SR * 3) / SR
+  signal = rng.standard_normal(SR * 3) * 300 + 4000 * np.sin(2 * np.pi * 800 * t) * (t > 1)
+  return noise, signal
+
+
+@pytest.mark.parametrize('length', [SR, SR + 1, 1000, 1024 + 255])
+def test_istft_inverts_stft(length):
+  x = np.random.default_rng(0).standard_normal(length)
+  np.testing.assert_allclose(istft(stft(x), length), x, atol=1e-9)
+
+
+def test_gate_attenuates_noise_and_keeps_tone():
+  noise, signal = tone_over_noise()
+  reduced = spectral_gate(signal, estimate_noise_profile([noise], SR), prop_decrease=0.5)
+
+  # Noise-only second: roughly halved
+  assert 0.4 < reduced[:SR].std() / signal[:SR].std() < 0.6
+  # Tone: nearly untouched
+  tone = slice(int(1.5 * SR), int(2.5 * SR))
+  assert np.corrcoef(reduced[tone], signal[tone])[0, 1] > 0.99
+
+
+def test_batch_matches_separate_chunks():
+  noise, signal = tone_over_noise()
+  profile = estimate_noise_profile([noise], SR)
+  chunks = [signal[:SR], signal[SR:2 * SR + 123], signal[2 * SR + 123:]]
+  for batched, chunk in zip(reduce_noise_batch(chunks, profile), chunks):
+    separate = spectral_gate(chunk, profile)
+    # Identical away from the edges, where mask smoothing sees the neighbouring gap
+    np.testing.assert_allclose(batched[1024:-1024], separate[1024:-1024], atol=1e-6)
+    assert np.linalg.norm(batched - separate) / np.linalg.norm(separate) < 0.05
+
+
+def test_matches_noisereduce():
+  nr = pytest.importorskip('noisereduce')
+  noise, signal = tone_over_noise()
+  expected = nr.reduce_noise(y=signal, sr=SR, y_noise=noise, stationary=True, prop_decrease=0.5)
+  reduced = spectral_gate(signal, estimate_noise_profile([noise], SR), prop_decrease=0.5)
+
+  assert np.corrcoef(reduced, expected)[0, 1] > 0.99
+  assert np.linalg.norm(reduced - expected) / np.linalg.norm(expected) < 0.2
+  assert reduced[:SR].std() == pytest.approx(expected[:SR].std(), rel=0.05)
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.int8, np.int16, np.int32])
+def test_float_conversion_round_trips(dtype):
+  info = np.iinfo(dtype)
+  samples = np.array([info.min, info.min + 1, (int(info.min) + int(info.max)) // 2, info.max], dtype=dtype)
+  floats = _to_float(samples)
+  assert floats.min() < 0 < floats.max()
+  np.testing.assert_array_equal(_from_float(floats, dtype), samples)
+
+
+def test_uint8_silence_is_zero():
+  assert not _to_float(np.full(10, 128, dtype=np.uint8)).any()
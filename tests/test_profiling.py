@@ -0,0 +1,24 @@
+import profiling
+
+
+def test_report_has_peak_rss_without_memory_tracing(tmp_path):
+  path = tmp_path / 'profile.txt'
+  with profiling.profile_session(str(path)):
+    with profiling.stage('work'):
+      sum(range(1000))
+
+  report = path.read_text()
+  assert 'peak RSS' in report
+  assert 'peak traced memory' not in report
+  assert 'allocation sites' not in report
+  assert '\nwork ' in report
+
+
+def test_memory_tracing_adds_allocation_sites(tmp_path):
+  path = tmp_path / 'profile.txt'
+  with profiling.profile_session(str(path), memory=True):
+    data = [bytearray(1000) for _ in range(100)]
+
+  report = path.read_text()
+  assert 'peak RSS' in report and 'peak traced memory' in report
+  assert 'allocation sites still held at exit' in report
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from pydub import AudioSegment
+from pydub.silence import detect_nonsilent, split_on_silence
+
+from audio_utils import detect_nonsilent_ranges, gather_frames, merge_ranges, pad_ranges, silent_ranges
+from pcm_cache import PCMAudio
+
+
+SR = 8000
+
+
+def bursts(spans_ms, length_ms, channels=1, seed=0):
+  """int16 noise bursts at [start, end] ms over near-silence"""
+  rng = np.random.default_rng(seed)
+  samples = rng.integers(-3, 4, (length_ms * SR // 1000, channels))
+  for start, end in spans_ms:
+    samples[start * SR // 1000:end * SR // 1000] = rng.integers(-8000, 8000, ((end - start) * SR // 1000, channels))
+  return samples.astype(np.int16)
+
+
+def segment(samples):
+  return AudioSegment(samples.tobytes(), frame_rate=SR, sample_width=2, channels=samples.shape[1])
+
+
+@pytest.mark.parametrize('spans, length, channels', [
+  ([(300, 800), (1500, 1600), (1700, 2500)], 3000, 1),
+  ([(0, 400), (2800, 3000)], 3000, 2),
+  ([], 1000, 1),
+  ([(0, 1000)], 1000, 1),
+  ([(10, 50)], 150, 1),
+])
+def test_detect_nonsilent_matches_pydub(spans, length, channels):
+  samples = bursts(spans, length, channels)
+  expected = detect_nonsilent(segment(samples), min_silence_len=200, silence_thresh=-48, seek_step=2)
+  assert detect_nonsilent_ranges(samples.reshape(-1), SR, channels) == expected
+
+
+@pytest.mark.parametrize('keep_silence', [0, 50, 300, 2000])
+def test_pad_ranges_matches_split_on_silence(keep_silence):
+  samples = bursts([(300, 800), (1100, 1600), (1700, 2500)], 3000)
+  audio = segment(samples)
+  ranges = detect_nonsilent_ranges(samples.reshape(-1), SR)
+
+  chunks = split_on_silence(audio, min_silence_len=200, silence_thresh=-48, keep_silence=keep_silence, seek_step=2)
+  padded = pad_ranges(ranges, len(audio), keep_silence)
+  assert [audio[start:end].raw_data for start, end in padded] == [chunk.raw_data for chunk in chunks]
+
+
+def test_pad_ranges_splits_overlap_evenly():
+  assert pad_ranges([[100, 200], [230, 400]], 420, 50) == [[50, 215], [215, 420]]
+  assert pad_ranges([[10, 20]], 100, 50) == [[0, 70]]
+  assert pad_ranges([], 100, 50) == []
+
+
+def test_silent_ranges_is_the_complement():
+  assert silent_ranges([[100, 200], [300, 400]], 500) == [[0, 100], [200, 300], [400, 500]]
+  assert silent_ranges([[0, 200], [150, 500]], 500) == []
+  assert silent_ranges([], 500) == [[0, 500]]
+
+
+@pytest.mark.parametrize('ranges, expected', [
+  ([], []),
+  ([[300, 400], [100, 200]], [[100, 200], [300, 400]]),
+  # Overlapping and touching ranges merge
+  ([[100, 200], [150, 250], [250, 300]], [[100, 300]]),
+  # A range inside another disappears
+  ([[100, 500], [200, 300]], [[100, 500]]),
+  # Empty ranges are dropped unless they fall inside another one
+  ([[100, 100], [200, 150], [300, 400], [350, 350]], [[300, 400]]),
+])
+def test_merge_ranges(ranges, expected):
+  assert merge_ranges(ranges) == expected
+
+
+def test_gather_frames_matches_concatenated_slices():
+  samples = bursts([(100, 900)], 1000, channels=2)
+  audio = PCMAudio(samples, SR)
+  ranges = [[0, 50], [120, 340], [340, 341], [990, 1200]]
+
+  gathered = gather_frames(audio, ranges)
+  audio_segment = segment(samples)
+  assert gathered.dtype == samples.dtype
+  assert gathered.tobytes() == b''.join(audio_segment[start:end].raw_data for start, end in ranges)
@@ -0,0 +1,109 @@
+import json
+
+import numpy as np
+import pytest
+
+from segment_table import SegmentTable
+
+
+TRACKS = [
+    (12.5, 14.0, 'SPEAKER_01'),
+    (0.0, 3.25, 'SPEAKER_00'),
+    (3.5, 9.0, 'SPEAKER_01'),
+    (9.0, 12.0, 'SPEAKER_00'),
+    (20.0, 21.5, 'SPEAKER_02'),
+]
+
+
+@pytest.fixture
+def table():
+    return SegmentTable.from_tracks(TRACKS)
+
+
+def assert_same(a, b):
+    assert a.labels == b.labels
+    np.testing.assert_allclose(a.start, b.start, atol=1e-3)
+    np.testing.assert_allclose(a.end, b.end, atol=1e-3)
+    np.testing.assert_array_equal(a.codes, b.codes)
+
+
+def test_rows_are_sorted_by_start(table):
+    assert list(table) == sorted(TRACKS)
+    assert table.labels == ['SPEAKER_00', 'SPEAKER_01', 'SPEAKER_02']
+    assert table.num_speakers == 3
+
+
+@pytest.mark.parametrize('name', ['analysis.json', 'analysis.npz'])
+def test_save_load_round_trip(table, tmp_path, name):
+    path = str(tmp_path / name)
+    table.save(path)
+    assert_same(SegmentTable.load(path), table)
+
+
+@pytest.mark.parametrize('format', ['json', 'npz'])
+def test_forced_format_ignores_the_extension(table, tmp_path, format):
+    path = str(tmp_path / 'analysis.out')
+    table.save(path, format=format)
+    # NumPy must not have added its own extension
+    assert [p.name for p in tmp_path.iterdir()] == ['analysis.out']
+    assert_same(SegmentTable.load(path, format=format), table)
+
+
+def test_unknown_format_is_rejected(table, tmp_path):
+    with pytest.raises(ValueError):
+        table.save(str(tmp_path / 'analysis.json'), format='csv')
+
+
+def test_empty_table_round_trip(tmp_path):
+    empty = SegmentTable.from_tracks([])
+    for name in ('empty.json', 'empty.npz'):
+        path = str(tmp_path / name)
+        empty.save(path)
+        loaded = SegmentTable.load(path)
+        assert len(loaded) == 0 and loaded.num_speakers == 0
+
+
+def test_dict_round_trip(table):
+    data = json.loads(json.dumps(table.to_dict()))
+    assert_same(SegmentTable.from_dict(data), table)
+
+
+def test_old_analysis_dict_is_accepted(table):
+    # The nested dict speaker_filter produced before SegmentTable
+    old = {
+        'num_speakers': 3,
+        'speakers': {
+            label: {
+                'total_time': entry['total_time'],
+                'num_segments': entry['num_segments'],
+                'segments': [{'start': s, 'end': e, 'duration': e - s} for s, e, l in TRACKS if l == label],
+            }
+            for label, entry in table.stats().items()
+        },
+    }
+    assert_same(SegmentTable.coerce(old), table)
+    assert SegmentTable.coerce(table) is table
+
+
+def test_dict_views_match_the_old_layout(table):
+    assert table['num_speakers'] == 3
+    assert table['speakers']['SPEAKER_00'] == {
+        'total_time': 6.25,
+        'num_segments': 2,
+        'segments': [
+            {'start': 0.0, 'end': 3.25, 'duration': 3.25},
+            {'start': 9.0, 'end': 12.0, 'duration': 3.0},
+        ],
+    }
+    assert table['segments'][0] == {'speaker': 'SPEAKER_00', 'start': 0.0, 'end': 3.25, 'duration': 3.25}
+    assert 'speakers' in table and table.get('missing') is None
+    with pytest.raises(KeyError):
+        table['missing']
+
+
+def test_queries(table):
+    assert list(table.for_speaker('SPEAKER_02')) == [(20.0, 21.5, 'SPEAKER_02')]
+    assert len(table.for_speaker('nobody')) == 0
+    assert [start for start, _, _ in table.between(3.25, 12.5)] == [3.5, 9.0]
+    assert len(table.longer_than(3.0)) == 3
+    assert table.ranges_ms('SPEAKER_01') == [[3500, 9000], [12500, 14000]]
@@ -0,0 +1,168 @@
+import os
+
+import numpy as np
+
+import speaker_filter
+import speaker_index
+from segment_table import SegmentTable
+from speaker_filter import SpeakerFilter
+from speaker_index import SpeakerEmbeddingIndex, normalize
+
+
+DIM = 16
+
+
+def speakers(seed, count=2):
+    return normalize(np.random.default_rng(seed).standard_normal((count, DIM)))
+
+
+def add_file(index, key, voices, segments=4, seed=0):
+    """Index a file whose segments alternate between the given voices, with a little noise"""
+    rng = np.random.default_rng(seed)
+    tracks = [(i * 2.0, i * 2.0 + 1.5, f'SPEAKER_{i % len(voices):02d}') for i in range(segments)]
+    embeddings = np.stack([voices[i % len(voices)] for i in range(segments)])
+    index.add(key, f'/archives/{key}.mp3', tracks, embeddings + rng.standard_normal(embeddings.shape) * 0.01)
+    return tracks
+
+
+def test_add_and_search(tmp_path):
+    index = SpeakerEmbeddingIndex(str(tmp_path))
+    voices = speakers(0)
+    add_file(index, 'a', voices)
+    add_file(index, 'b', speakers(1), seed=1)
+
+    assert len(index) == 8 and 'a' in index and 'c' not in index
+    results = index.search(voices[1], k=2)
+    assert [(r['path'], r['speaker'], r['start']) for r in results] == [
+        ('/archives/a.mp3', 'SPEAKER_01', 2.0), ('/archives/a.mp3', 'SPEAKER_01', 6.0)]
+    assert results[0]['score'] > 0.99
+
+
+def test_adding_a_file_twice_is_ignored(tmp_path):
+    index = SpeakerEmbeddingIndex(str(tmp_path))
+    add_file(index, 'a', speakers(0))
+    add_file(index, 'a', speakers(1))
+    assert len(index) == 4
+
+
+def test_file_embeddings(tmp_path):
+    index = SpeakerEmbeddingIndex(str(tmp_path))
+    voices = speakers(0)
+    add_file(index, 'a', voices, segments=5)
+
+    embeddings = index.file_embeddings('a')
+    assert sorted(embeddings) == ['SPEAKER_00', 'SPEAKER_01']
+    assert embeddings['SPEAKER_00'].shape == (3, DIM)
+    assert (embeddings['SPEAKER_01'] @ voices[1] > 0.99).all()
+    assert index.file_embeddings('missing') is None
+
+
+def test_other_processes_see_committed_files_only(tmp_path):
+    writer = SpeakerEmbeddingIndex(str(tmp_path))
+    reader = SpeakerEmbeddingIndex(str(tmp_path))
+    add_file(writer, 'a', speakers(0))
+
+    # A writer that crashed between appending the data and committing files.json
+    with open(writer.vectors_path, 'ab') as f:
+        f.write(np.ones((3, DIM), dtype=np.float16).tobytes())
+    with open(writer.segments_path, 'ab') as f:
+        f.write(np.zeros(2, dtype=speaker_index.SEGMENT_DTYPE).tobytes())
+
+    # search() reloads, and only looks at the committed rows
+    assert len(reader.search(speakers(0)[0], k=100)) == 4
+    assert len(SpeakerEmbeddingIndex(str(tmp_path))) == 4
+
+    # The next writer drops the torn tail before appending
+    add_file(reader, 'b', speakers(1))
+    assert os.path.getsize(writer.vectors_path) == 8 * DIM * 2
+    assert os.path.getsize(writer.segments_path) == 8 * speaker_index.SEGMENT_DTYPE.itemsize
+    assert [r['path'] for r in SpeakerEmbeddingIndex(str(tmp_path)).search(speakers(1)[0], k=2)] == [
+        '/archives/b.mp3'] * 2
+
+
+def test_ivf_is_built_and_rebuilt_when_stale(tmp_path, monkeypatch):
+    monkeypatch.setattr(speaker_index, 'IVF_MIN_SIZE', 40)
+    index = SpeakerEmbeddingIndex(str(tmp_path))
+    voices = speakers(0, count=10)
+    for i in range(5):
+        add_file(index, f'file{i}', voices, segments=10, seed=i)
+
+    assert index.search(voices[3], k=1)[0]['speaker'] == 'SPEAKER_03'
+    with np.load(index.ivf_path) as data:
+        assert int(data['size']) == 50
+
+    # A few new rows are scanned alongside the partitions...
+    add_file(index, 'new', speakers(5, count=1), segments=10)
+    results = index.search(speakers(5, count=1)[0], k=10)
+    assert {r['path'] for r in results} == {'/archives/new.mp3'}
+    with np.load(index.ivf_path) as data:
+        assert int(data['size']) == 50
+
+    # ...until they are more than IVF_REBUILD_FRACTION of the partitioned ones
+    add_file(index, 'newer', speakers(6, count=1), segments=10)
+    index.search(voices[0], k=1)
+    with np.load(index.ivf_path) as data:
+        assert int(data['size']) == 70
+
+
+def test_empty_index(tmp_path):
+    index = SpeakerEmbeddingIndex(str(tmp_path))
+    assert len(index) == 0
+    assert index.search(speakers(0)[0]) == []
+    assert index.vectors().shape == (0, 0)
+
+
+def test_adding_no_segments_writes_nothing(tmp_path):
+    index = SpeakerEmbeddingIndex(str(tmp_path))
+    index.add('a', '/archives/a.mp3', [], np.zeros((0, DIM)))
+    assert os.listdir(tmp_path) == []
+
+
+def test_file_tracks(tmp_path):
+    index = SpeakerEmbeddingIndex(str(tmp_path))
+    tracks = add_file(index, 'a', speakers(0), segments=3)
+    assert index.file_tracks('a') == tracks
+    assert index.file_tracks('missing') is None
+
+
+class FakeFilter(SpeakerFilter):
+    """SpeakerFilter without models: embeddings encode the segment start, keys are set by the test"""
+
+    def __init__(self, directory):
+        self.index = SpeakerEmbeddingIndex(directory)
+        self.key = 'settings-1'
+        self.embedded = 0
+
+    def _cache_key(self, audio_path):
+        return self.key
+
+    def embed(self, audio, start_ms=None, end_ms=None):
+        self.embedded += 1
+        return np.full(DIM, start_ms, dtype=np.float32)
+
+
+def test_speaker_embeddings_follow_the_diarization(tmp_path, monkeypatch):
+    monkeypatch.setattr(speaker_filter, 'open_audio', lambda path: None)
+    filt = FakeFilter(str(tmp_path))
+    first = SegmentTable.from_tracks([(0.0, 2.0, 'SPEAKER_00'), (3.0, 5.0, 'SPEAKER_01')])
+    # The same file diarized with other settings: the labels mean other voices
+    swapped = SegmentTable.from_tracks([(0.0, 2.0, 'SPEAKER_01'), (3.0, 5.0, 'SPEAKER_00')])
+
+    filt.speaker_embeddings('a.mp3', first)
+    assert filt.embedded == 2
+    # Same diarization: read back from the index
+    assert sorted(filt.speaker_embeddings('a.mp3', first)) == ['SPEAKER_00', 'SPEAKER_01']
+    assert filt.embedded == 2
+
+    # Same key but an analysis that doesn't match what was indexed: recomputed, not indexed
+    embeddings = filt.speaker_embeddings('a.mp3', swapped)
+    assert filt.embedded == 4 and len(filt.index.files) == 1
+    assert embeddings['SPEAKER_01'][0, 0] == 0
+
+    # Other settings: indexed separately
+    filt.key = 'settings-2'
+    filt.speaker_embeddings('a.mp3', swapped)
+    assert len(filt.index.files) == 2
+    assert filt.embedded == 6
+    assert sorted(filt.speaker_embeddings('a.mp3', swapped)) == ['SPEAKER_00', 'SPEAKER_01']
+    assert filt.embedded == 6
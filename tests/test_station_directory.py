@@ -0,0 +1,113 @@
+import liveatc
+from station_directory import StationDirectory, StationIndex, refresh
+
+
+def station(identifier, title, frequencies=(), icao=None, up=True):
+  return {
+    'identifier': identifier,
+    'title': title,
+    'frequencies': [{'title': name, 'frequency': freq} for name, freq in frequencies],
+    'icao': icao or identifier.split('_')[0].upper(),
+    'up': up,
+  }
+
+
+STATIONS = [
+  station('kjfk_twr', 'New York Kennedy Tower', [('JFK Tower', '119.100'), ('JFK Tower', '123.900')]),
+  station('kjfk_gnd', 'New York Kennedy Ground', [('JFK Ground', '121.900')]),
+  station('kjfk_app', 'New York Approach', [('Kennedy Final', '128.125')], up=False),
+  station('kpdx_app', 'Portland Approach', [('Portland Approach', '118.100')]),
+  station('kpdx_twr', 'Portland Tower', [('PDX Tower', '118.700')]),
+  station('kpde_ctaf', 'Pardee CTAF', [('CTAF', '122.800')]),
+  station('kjfk2_atis', 'Some JFK ATIS', [('ATIS', '128.725')], icao='KABC'),
+]
+
+
+def identifiers(stations):
+  return [s['identifier'] for s in stations]
+
+
+def test_search_by_icao_ranks_exact_matches_first():
+  index = StationIndex(STATIONS)
+  # kjfk2_atis only has 'kjfk' as a prefix of its identifier; otherwise online stations first
+  assert identifiers(index.search('KJFK')) == ['kjfk_gnd', 'kjfk_twr', 'kjfk_app', 'kjfk2_atis']
+
+
+def test_search_by_prefix():
+  index = StationIndex(STATIONS)
+  assert identifiers(index.search('kpd')) == ['kpde_ctaf', 'kpdx_app', 'kpdx_twr']
+  assert identifiers(index.search('port')) == ['kpdx_app', 'kpdx_twr']
+
+
+def test_all_terms_must_match():
+  index = StationIndex(STATIONS)
+  assert identifiers(index.search('portland tower')) == ['kpdx_twr']
+  assert identifiers(index.search('kennedy ground')) == ['kjfk_gnd']
+  assert index.search('portland kennedy') == []
+
+
+def test_search_by_frequency_in_either_form():
+  index = StationIndex(STATIONS)
+  assert identifiers(index.search('118.700')) == ['kpdx_twr']
+  assert identifiers(index.search('118.7')) == ['kpdx_twr']
+  assert identifiers(index.search('118.')) == ['kpdx_app', 'kpdx_twr']
+
+
+def test_search_by_substring():
+  index = StationIndex(STATIONS)
+  # 'nedy' starts no token, but occurs in 'kennedy'
+  assert identifiers(index.search('nedy')) == ['kjfk_gnd', 'kjfk_twr', 'kjfk_app']
+  # Too short for a substring search
+  assert index.search('dy') == []
+  assert index.search('zzz') == []
+
+
+def test_search_limit_and_empty_query():
+  index = StationIndex(STATIONS)
+  assert identifiers(index.search('k', limit=2)) == ['kjfk2_atis', 'kjfk_gnd']
+  assert index.search('') == []
+  assert index.search('  --  ') == []
+
+
+def test_directory_update_replaces_an_airport(tmp_path):
+  directory = StationDirectory(str(tmp_path / 'stations.json'))
+  directory.update('kjfk', STATIONS[:3])
+  directory.update('kpdx', STATIONS[3:5])
+  directory.update('kjfk', [STATIONS[0]])
+
+  assert sorted(directory.stations) == ['kjfk_twr', 'kpdx_app', 'kpdx_twr']
+  assert identifiers(directory.search('tower')) == ['kjfk_twr', 'kpdx_twr']
+
+
+def test_directory_save_and_reload(tmp_path):
+  path = str(tmp_path / 'stations.json')
+  directory = StationDirectory(path)
+  directory.update('kpdx', STATIONS[3:5])
+  directory.save()
+
+  reloaded = StationDirectory(path)
+  assert len(reloaded) == 2
+  assert identifiers(reloaded.search('kpdx')) == ['kpdx_app', 'kpdx_twr']
+
+
+def test_corrupt_directory_starts_empty(tmp_path):
+  path = tmp_path / 'stations.json'
+  path.write_text('{"stations": [{"title": ')
+  assert len(StationDirectory(str(path))) == 0
+
+
+def test_refresh_records_stations_and_reports_failures(tmp_path, monkeypatch):
+  def get_stations(icao):
+    if icao == 'KPDX':
+      return iter(STATIONS[3:5])
+    raise ValueError('no stations')
+
+  monkeypatch.setattr(liveatc, 'get_stations', get_stations)
+  directory = StationDirectory(str(tmp_path / 'stations.json'))
+  results, messages = [], []
+  refresh(['kpdx', 'zzzz'], directory, delay=0, log=messages.append,
+          on_result=lambda icao, stations: results.append((icao, len(stations))))
+
+  assert results == [('KPDX', 2)]
+  assert messages == ['[OK] KPDX: 2 station(s)', '[FAIL] ZZZZ: no stations']
+  assert len(StationDirectory(directory.path)) == 2
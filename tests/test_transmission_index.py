@@ -0,0 +1,57 @@
+import numpy as np
+
+import transmission_index
+from audio_utils import detect_nonsilent_ranges
+from transmission_index import TransmissionIndex, cut_transmissions, index_from_samples, index_path, load_index
+
+
+SR = 8000
+
+# MPEG 1 Layer III, 128 kbps, 44.1 kHz, mono
+MPEG1_L3 = bytes([0xFF, 0xFB, 0x90, 0xC0])
+MPEG1_L3_SIZE = 417
+
+
+def frame(fill):
+  return MPEG1_L3 + bytes([fill]) * (MPEG1_L3_SIZE - len(MPEG1_L3))
+
+
+def bursts(spans_ms, length_ms, channels=1, seed=0):
+  """int16 noise bursts at [start, end] ms over near-silence"""
+  rng = np.random.default_rng(seed)
+  samples = rng.integers(-3, 4, (length_ms * SR // 1000, channels))
+  for start, end in spans_ms:
+    samples[start * SR // 1000:end * SR // 1000] = rng.integers(-8000, 8000, ((end - start) * SR // 1000, channels))
+  return samples.astype(np.int16)
+
+
+def test_index_matches_detect_nonsilent():
+  samples = bursts([(300, 800), (1500, 1600), (1700, 2500)], 3000, channels=2)
+  index = index_from_samples(samples.ravel(), SR, channels=2)
+
+  assert index.ranges() == detect_nonsilent_ranges(samples.ravel(), SR, channels=2)
+  assert index.duration_ms == 3000
+  assert (index.rms_dbfs <= index.peak_dbfs).all()
+  assert len(index.query(start=1.55, min_duration=0.2)) == 1
+
+
+def test_cut_transmissions_copies_frames_from_a_cached_index(tmp_path, monkeypatch):
+  monkeypatch.setenv('LIVEATC_CACHE_DIR', str(tmp_path / 'cache'))
+  path = tmp_path / 'archive.mp3'
+  audio = [frame(i) for i in range(1, 21)]
+  path.write_bytes(b''.join(audio))
+
+  # The index is already cached, so nothing may be decoded
+  frame_ms = 1152 * 1000 / 44100
+  TransmissionIndex([int(frame_ms * 2.5), int(frame_ms * 12.5)], [int(frame_ms * 3.5), int(frame_ms * 14.5)],
+                    [-20, -40], [-10, -30], int(frame_ms * 20)).save(
+    index_path(str(path), min_silence_len=200, silence_thresh=-48, seek_step=2))
+  monkeypatch.setattr(transmission_index, 'open_audio', None)
+
+  output = tmp_path / 'loud.mp3'
+  index = cut_transmissions(str(path), str(output), keep_silence=0, min_rms_dbfs=-30)
+
+  assert len(index) == 1
+  assert output.read_bytes() == b''.join(audio[2:4])
+  assert load_index(str(path)).ranges() == [[int(frame_ms * 2.5), int(frame_ms * 3.5)],
+                                            [int(frame_ms * 12.5), int(frame_ms * 14.5)]]
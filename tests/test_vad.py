@@ -0,0 +1,28 @@
+import numpy as np
+
+from pcm_cache import PCMAudio
+from vad import PackedSpeech
+
+
+# A rate where most ms offsets don't land on a whole frame
+SR = 22050
+
+
+def test_packed_offsets_match_the_gathered_frames():
+  audio = PCMAudio(np.arange(SR * 3, dtype=np.int16).reshape(-1, 1), SR)
+  islands = [[100, 433], [1000, 1001], [1500, 2999], [2999, 4000]]
+  packed = PackedSpeech(audio, islands)
+
+  for (start, end), packed_start, packed_end in zip(islands, packed.packed_starts, packed.packed_ends):
+    first = int(round(packed_start * SR / 1000))
+    last = int(round(packed_end * SR / 1000))
+    assert (packed.frames[first:last] == audio.frames(start, end)).all()
+  assert packed.packed_ends[-1] * SR / 1000 == len(packed.frames)
+
+
+def test_map_tracks_splits_at_island_joins():
+  audio = PCMAudio(np.zeros((SR * 10, 1), dtype=np.int16), SR)
+  packed = PackedSpeech(audio, [[1000, 2000], [5000, 7000]])
+
+  assert packed.map_tracks([(0.5, 1.5, 'A'), (2.5, 3.0, 'B')]) == [
+    (1.5, 2.0, 'A'), (5.0, 5.5, 'A'), (6.5, 7.0, 'B')]
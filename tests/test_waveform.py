@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+from waveform import BASE_BIN, LEVEL_FACTOR, Waveform, WaveformBuilder, cached_waveform, save_waveform, span_across
+
+
+RATE = 8000
+
+
+@pytest.fixture(scope='module')
+def samples():
+  """Two minutes of stereo noise whose loudness changes every second"""
+  rng = np.random.default_rng(0)
+  frames = RATE * 120
+  loudness = np.repeat(rng.integers(100, 20000, frames // RATE), RATE)
+  return (rng.standard_normal((frames, 2)) * loudness[:, None] / 4).clip(-32768, 32767).astype('<i2')
+
+
+@pytest.fixture(scope='module')
+def waveform(samples):
+  builder = WaveformBuilder(RATE, 2)
+  builder.feed(samples)
+  return builder.finish()
+
+
+def test_levels(samples, waveform):
+  assert len(waveform) == 120000
+  assert len(waveform.levels[-1][0]) <= 64
+  mins, maxs, rms = waveform.levels[0]
+  bins = samples[:len(samples) // BASE_BIN * BASE_BIN].reshape(-1, BASE_BIN * 2)
+  np.testing.assert_array_equal(mins[:len(bins)], bins.min(axis=1))
+  np.testing.assert_array_equal(maxs[:len(bins)], bins.max(axis=1))
+  np.testing.assert_allclose(rms[:len(bins)], np.sqrt((bins.astype(np.float64) ** 2).mean(axis=1)), atol=0.5)
+
+  # Each level groups LEVEL_FACTOR bins of the one below (the last group may be short)
+  for (fine_min, fine_max, _), (mins, maxs, _) in zip(waveform.levels, waveform.levels[1:]):
+    pad = (0, -len(fine_min) % LEVEL_FACTOR)
+    np.testing.assert_array_equal(mins, np.pad(fine_min, pad, mode='edge').reshape(-1, LEVEL_FACTOR).min(axis=1))
+    np.testing.assert_array_equal(maxs, np.pad(fine_max, pad, mode='edge').reshape(-1, LEVEL_FACTOR).max(axis=1))
+
+
+def test_pieces_of_any_size_give_the_same_waveform(samples, waveform):
+  builder = WaveformBuilder(RATE, 2)
+  data = samples.tobytes()
+  position = 0
+  for size in np.random.default_rng(1).integers(1, 50000, 1000):
+    builder.feed_bytes(data[position:position + size])
+    position += size
+  builder.feed_bytes(data[position:])
+  pieces = builder.finish()
+
+  assert pieces.frame_count == waveform.frame_count
+  for level, expected in zip(pieces.levels, waveform.levels):
+    for values, expected_values in zip(level, expected):
+      np.testing.assert_array_equal(values, expected_values)
+
+
+@pytest.mark.parametrize('frames_per_pixel', [BASE_BIN, 4096, 16384 * 3])
+def test_span_matches_the_samples(samples, waveform, frames_per_pixel):
+  pixels = 10
+  start = 2 * frames_per_pixel
+  mins, maxs, rms = waveform.span(start * 1000 / RATE, (start + pixels * frames_per_pixel) * 1000 / RATE, pixels)
+
+  pixel_samples = samples[start:start + pixels * frames_per_pixel].reshape(pixels, -1).astype(np.float64)
+  np.testing.assert_array_equal(mins, pixel_samples.min(axis=1))
+  np.testing.assert_array_equal(maxs, pixel_samples.max(axis=1))
+  np.testing.assert_allclose(rms, np.sqrt((pixel_samples ** 2).mean(axis=1)), rtol=1e-3, atol=0.5)
+
+
+def test_span_zoomed_in_past_the_finest_level(waveform):
+  # 16 pixels over one bin all show that bin
+  mins, maxs, rms = waveform.span(0, BASE_BIN * 1000 / RATE, 16)
+  assert (mins == waveform.levels[0][0][0]).all()
+  assert (maxs == waveform.levels[0][1][0]).all()
+  assert (rms == waveform.levels[0][2][0]).all()
+
+
+def test_span_outside_the_recording_is_nan(waveform):
+  mins, maxs, rms = waveform.span(-1000, 1000, 10)
+  assert np.isnan(mins[:5]).all() and not np.isnan(mins[5:]).any()
+  assert np.isnan(waveform.span(200000, 300000, 10)[1]).all()
+
+
+def test_span_across_recordings(waveform):
+  short = Waveform(waveform.frame_rate, RATE * 10, waveform.levels)
+  # Two recordings with a gap from 10 to 20 s
+  mins, _, _ = span_across([(0, short), (20000, short), (40000, None)], 0, 50000, 50)
+  assert not np.isnan(mins[:10]).any()
+  assert np.isnan(mins[10:20]).all()
+  assert not np.isnan(mins[20:30]).any()
+  assert np.isnan(mins[30:]).all()
+
+
+def test_cached_waveform_follows_the_source_file(tmp_path, waveform):
+  path = str(tmp_path / 'archive.mp3')
+  with open(path, 'wb') as f:
+    f.write(b'audio')
+  assert cached_waveform(path) is None
+
+  save_waveform(waveform, path)
+  cached = cached_waveform(path)
+  assert (cached.frame_rate, cached.frame_count) == (waveform.frame_rate, waveform.frame_count)
+  np.testing.assert_array_equal(cached.levels[1][2], waveform.levels[1][2])
+
+  with open(path, 'ab') as f:
+    f.write(b'more audio')
+  assert cached_waveform(path) is None
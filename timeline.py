@@ -0,0 +1,173 @@
+import os
+from datetime import timedelta
+
+import numpy as np
+from pydub import AudioSegment
+
+from liveatc import parse_archive_filename
+from mp3_frames import is_mp3, load_seek_index
+from pcm_cache import PCM_DTYPE, default_cache, load_pcm, load_samples
+
+
+# LiveATC splits recordings at :00 and :30 Zulu
+ARCHIVE_LENGTH = timedelta(minutes=30)
+
+# Reads covering less than this fraction of an archive that isn't decoded yet seek into the
+# MP3 instead of decoding (and caching) the whole archive
+SEEK_MAX_FRACTION = 0.25
+
+
+class ArchiveTimeline:
+  """Consecutive archives of one station read as a single continuous recording
+
+  Absolute UTC times are mapped to archive files and sample offsets on demand; only the
+  requested samples are read (from the PCM cache, or straight from the MP3 for short reads
+  of archives that aren't decoded yet) and missing archives read as silence.
+  """
+
+  def __init__(self, archives, start, end, loader=load_pcm):
+    self.start = start
+    self.end = end
+    self.loader = loader
+    self._opened = {}
+
+    # (archive start, path) for every archive overlapping [start, end)
+    self.archives = []
+    for path in archives:
+      parsed = parse_archive_filename(path)
+      if parsed and parsed[1] < end and parsed[1] + ARCHIVE_LENGTH > start:
+        self.archives.append((parsed[1], path))
+    self.archives.sort()
+
+    if not self.archives:
+      raise ValueError(f'No archives between {start} and {end}')
+
+    self.frame_rate, self.channels, self.dtype = self._format(self.archives[0][1])
+    self.sample_width = self.dtype.itemsize
+
+  @classmethod
+  def from_directory(cls, directory, identifier, start, end, **kwargs):
+    """Timeline over the archives of one station (archive identifier, e.g. KPDX3-Twr-123775) in a directory"""
+    paths = []
+    for name in os.listdir(directory):
+      parsed = parse_archive_filename(name)
+      if parsed and parsed[0].lower() == identifier.lower():
+        paths.append(os.path.join(directory, name))
+    return cls(paths, start, end, **kwargs)
+
+  @property
+  def name(self):
+    """File-name friendly description, e.g. KPDX3-Twr-123775-Oct-01-2021-1800Z-Oct-02-2021-0000Z"""
+    identifier = parse_archive_filename(self.archives[0][1])[0]
+    return f'{identifier}-{self.start:%b-%d-%Y-%H%MZ}-{self.end:%b-%d-%Y-%H%MZ}'
+
+  def __repr__(self):
+    return f'ArchiveTimeline({self.start:%b-%d-%Y %H%M:%SZ} - {self.end:%b-%d-%Y %H%M:%SZ}, {len(self.archives)} archives)'
+
+  def _seekable(self, path):
+    """Whether an archive can be read partially without decoding all of it"""
+    return (self.loader is load_pcm and path not in self._opened and is_mp3(path)
+            and not default_cache().contains(path))
+
+  def _format(self, path):
+    """(frame rate, channels, dtype) of an archive, from its seek index when possible"""
+    if self._seekable(path):
+      frames = load_seek_index(path)
+      return frames.sample_rate, frames.channels, np.dtype(PCM_DTYPE)
+    audio = self._open(path)
+    return audio.frame_rate, audio.channels, audio.samples.dtype
+
+  def _open(self, path):
+    if path not in self._opened:
+      audio = self.loader(path)
+      if hasattr(self, 'frame_rate') and (audio.frame_rate, audio.channels) != (self.frame_rate, self.channels):
+        raise ValueError(f'{path} has a different sample format than the rest of the timeline')
+      self._opened[path] = audio
+    return self._opened[path]
+
+  @property
+  def frame_count(self):
+    return int((self.end - self.start).total_seconds() * self.frame_rate)
+
+  @property
+  def duration_seconds(self):
+    return self.frame_count / self.frame_rate
+
+  def __len__(self):
+    return round(self.duration_seconds * 1000)
+
+  def frame_at(self, ms):
+    return min(max(int(ms * self.frame_rate // 1000), 0), self.frame_count)
+
+  def time_at(self, ms):
+    """Absolute UTC time of an offset (ms) into the timeline"""
+    return self.start + timedelta(milliseconds=ms)
+
+  def offset_of(self, date):
+    """Offset (ms) into the timeline of an absolute UTC time"""
+    return (date - self.start).total_seconds() * 1000
+
+  def locate(self, date):
+    """Archive path and frame offset within it holding an absolute UTC time"""
+    for archive_start, path in self.archives:
+      if archive_start <= date < archive_start + ARCHIVE_LENGTH:
+        return path, int((date - archive_start).total_seconds() * self.frame_rate)
+    return None, None
+
+  def _read_frames(self, first, last):
+    out = np.zeros((last - first, self.channels), dtype=self.dtype)
+    archive_frames = int(ARCHIVE_LENGTH.total_seconds() * self.frame_rate)
+
+    for archive_start, path in self.archives:
+      offset = int((archive_start - self.start).total_seconds() * self.frame_rate)
+      if offset >= last or offset + archive_frames <= first:
+        continue
+
+      # Never let an archive run over into the next one
+      lo = max(first, offset)
+      hi = min(last, offset + archive_frames)
+      if hi <= lo:
+        continue
+
+      if hi - lo < SEEK_MAX_FRACTION * archive_frames and self._seekable(path):
+        samples = load_samples(path, lo - offset, hi - offset)
+      else:
+        samples = self._open(path).samples[lo - offset:hi - offset]
+      # Short archives leave the rest as silence
+      out[lo - first:lo - first + len(samples)] = samples
+
+    return out
+
+  def frames(self, start_ms=None, end_ms=None):
+    """(frames, channels) samples between two offsets in ms, stitched across archives"""
+    first = 0 if start_ms is None else self.frame_at(start_ms)
+    last = self.frame_count if end_ms is None else self.frame_at(end_ms)
+    return self._read_frames(first, max(first, last))
+
+  def read(self, start, end):
+    """Samples between two absolute UTC times"""
+    return self.frames(self.offset_of(start), self.offset_of(end))
+
+  def iter_blocks(self, block_seconds=60):
+    """Yield (offset ms, frames) in fixed-size blocks across the whole timeline"""
+    block_ms = block_seconds * 1000
+    for start_ms in range(0, len(self), block_ms):
+      yield start_ms, self.frames(start_ms, min(start_ms + block_ms, len(self)))
+
+  def segment(self, frames):
+    """AudioSegment built from a (frames, channels) array"""
+    return AudioSegment(
+      np.ascontiguousarray(frames, dtype=self.dtype).tobytes(),
+      frame_rate=self.frame_rate,
+      sample_width=self.sample_width,
+      channels=self.channels,
+    )
+
+  def __getitem__(self, millisecond):
+    if isinstance(millisecond, slice):
+      return self.segment(self.frames(millisecond.start, millisecond.stop))
+    return self.segment(self.frames(millisecond, millisecond + 1))
+
+  def to_float(self, start_ms=None, end_ms=None):
+    """(channels, frames) float32 waveform in [-1, 1], e.g. for torch/pyannote"""
+    return self.frames(start_ms, end_ms).T.astype(np.float32) / float(2 ** (8 * self.sample_width - 1))
@@ -0,0 +1,202 @@
+import os
+from datetime import datetime
+
+import numpy as np
+
+from audio_utils import gather_frames, get_samples, ms_energy, nonsilent_from_energy, open_audio, pad_ranges
+from cache import get_cache_dir, file_hash, params_key
+from liveatc import parse_archive_filename
+
+
+INDEX_VERSION = 1
+
+
+def _to_dbfs(values, sample_width):
+  max_amplitude = float(2 ** (8 * sample_width - 1))
+  return (20 * np.log10(np.maximum(values, 1e-10) / max_amplitude)).astype(np.float32)
+
+
+class TransmissionIndex:
+  """Per-archive transmission boundaries and levels, stored as parallel arrays"""
+
+  def __init__(self, start_ms, end_ms, rms_dbfs, peak_dbfs, duration_ms, archive_start=None):
+    self.start_ms = np.asarray(start_ms, dtype=np.int32)
+    self.end_ms = np.asarray(end_ms, dtype=np.int32)
+    self.rms_dbfs = np.asarray(rms_dbfs, dtype=np.float32)
+    self.peak_dbfs = np.asarray(peak_dbfs, dtype=np.float32)
+    self.duration_ms = int(duration_ms)
+    self.archive_start = archive_start
+
+  def __len__(self):
+    return len(self.start_ms)
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield {
+        'start': int(self.start_ms[i]) / 1000,
+        'end': int(self.end_ms[i]) / 1000,
+        'duration': int(self.end_ms[i] - self.start_ms[i]) / 1000,
+        'rms_dbfs': float(self.rms_dbfs[i]),
+        'peak_dbfs': float(self.peak_dbfs[i]),
+      }
+
+  @property
+  def durations_ms(self):
+    return self.end_ms - self.start_ms
+
+  def ranges(self):
+    """Segments as [start, end] ms pairs, the format chunk_audio works with"""
+    return np.stack([self.start_ms, self.end_ms], axis=1).tolist()
+
+  def _offset_ms(self, value):
+    # Accept absolute UTC datetimes or seconds from the start of the archive
+    if isinstance(value, datetime):
+      if self.archive_start is None:
+        raise ValueError('Archive start time unknown, query with seconds instead')
+      return (value - self.archive_start).total_seconds() * 1000
+    return value * 1000
+
+  def query(self, start=None, end=None, min_rms_dbfs=None, min_peak_dbfs=None, min_duration=None):
+    """Segments overlapping [start, end] that are louder/longer than the given limits"""
+    mask = np.ones(len(self), dtype=bool)
+    if start is not None:
+      mask &= self.end_ms > self._offset_ms(start)
+    if end is not None:
+      mask &= self.start_ms < self._offset_ms(end)
+    if min_rms_dbfs is not None:
+      mask &= self.rms_dbfs >= min_rms_dbfs
+    if min_peak_dbfs is not None:
+      mask &= self.peak_dbfs >= min_peak_dbfs
+    if min_duration is not None:
+      mask &= self.durations_ms >= min_duration * 1000
+
+    return TransmissionIndex(self.start_ms[mask], self.end_ms[mask], self.rms_dbfs[mask],
+                             self.peak_dbfs[mask], self.duration_ms, self.archive_start)
+
+  def save(self, path):
+    np.savez(
+      path,
+      version=INDEX_VERSION,
+      start_ms=self.start_ms,
+      end_ms=self.end_ms,
+      rms_dbfs=self.rms_dbfs,
+      peak_dbfs=self.peak_dbfs,
+      duration_ms=self.duration_ms,
+      archive_start=self.archive_start.isoformat() if self.archive_start else '',
+    )
+
+  @classmethod
+  def load(cls, path):
+    with np.load(path) as data:
+      if data['version'].item() != INDEX_VERSION:
+        return None
+      archive_start = data['archive_start'].item()
+      return cls(
+        data['start_ms'],
+        data['end_ms'],
+        data['rms_dbfs'],
+        data['peak_dbfs'],
+        data['duration_ms'].item(),
+        datetime.fromisoformat(archive_start) if archive_start else None,
+      )
+
+
+def index_from_samples(samples, frame_rate, channels=1, sample_width=2,
+                       min_silence_len=200, silence_thresh=-48, seek_step=2, archive_start=None):
+  """Build a TransmissionIndex from interleaved samples"""
+  sums, counts = ms_energy(samples, frame_rate, channels)
+  ranges = nonsilent_from_energy(sums, counts, sample_width, min_silence_len, silence_thresh, seek_step)
+  duration_ms = len(sums)
+
+  if not ranges:
+    return TransmissionIndex([], [], [], [], duration_ms, archive_start)
+
+  bounds = np.asarray(ranges, dtype=np.int64)
+  cum_sums = np.concatenate(([0.0], np.cumsum(sums)))
+  cum_counts = np.concatenate(([0], np.cumsum(counts)))
+  rms = np.sqrt((cum_sums[bounds[:, 1]] - cum_sums[bounds[:, 0]]) /
+                np.maximum(cum_counts[bounds[:, 1]] - cum_counts[bounds[:, 0]], 1))
+
+  sample_bounds = (bounds * frame_rate // 1000) * channels
+  peak = np.array([np.abs(np.asarray(samples[start:end], dtype=np.int64)).max(initial=0)
+                   for start, end in sample_bounds])
+
+  return TransmissionIndex(bounds[:, 0], bounds[:, 1], _to_dbfs(rms, sample_width),
+                           _to_dbfs(peak, sample_width), duration_ms, archive_start)
+
+
+def index_path(path, **params):
+  return os.path.join(get_cache_dir('transmission_index'), f'{file_hash(path)}-{params_key(**params)}.npz')
+
+
+def build_index(path, min_silence_len=200, silence_thresh=-48, seek_step=2):
+  """Decode an archive and detect its transmissions"""
+  audio = open_audio(path)
+  parsed = parse_archive_filename(path)
+  return index_from_samples(
+    get_samples(audio),
+    audio.frame_rate,
+    channels=audio.channels,
+    sample_width=audio.sample_width,
+    min_silence_len=min_silence_len,
+    silence_thresh=silence_thresh,
+    seek_step=seek_step,
+    archive_start=parsed[1] if parsed else None,
+  )
+
+
+def load_index(path, min_silence_len=200, silence_thresh=-48, seek_step=2, rebuild=False):
+  """Transmission index for an archive, built once and then read from the sidecar cache"""
+  params = dict(min_silence_len=min_silence_len, silence_thresh=silence_thresh, seek_step=seek_step)
+  cached_path = index_path(path, **params)
+
+  if not rebuild and os.path.exists(cached_path):
+    index = TransmissionIndex.load(cached_path)
+    if index is not None:
+      return index
+
+  index = build_index(path, **params)
+  index.save(cached_path)
+  return index
+
+
+def cut_transmissions(path, output_path, keep_silence=500, start=None, end=None,
+                      min_rms_dbfs=None, min_peak_dbfs=None, min_duration=None):
+  """Write the transmissions of an archive matching a query to one file, back to back
+
+  With a cached index and an MP3 archive nothing is decoded: the frames covering each
+  transmission (padded by keep_silence ms) are copied as they are. Returns the index
+  of the transmissions written.
+  """
+  from mp3_frames import cut_mp3, is_mp3
+
+  index = load_index(path).query(start, end, min_rms_dbfs, min_peak_dbfs, min_duration)
+  ranges = pad_ranges(index.ranges(), index.duration_ms, keep_silence)
+
+  if is_mp3(path) and os.path.splitext(output_path)[1].lower() == '.mp3':
+    cut_mp3(path, ranges, output_path)
+  else:
+    audio = open_audio(path)
+    audio.segment(gather_frames(audio, ranges)).export(output_path, format=os.path.splitext(output_path)[1][1:] or 'wav')
+  return index
+
+
+if __name__ == '__main__':
+  import argparse
+
+  parser = argparse.ArgumentParser(description='List the transmissions of an archive, optionally cutting them out')
+  parser.add_argument('filename')
+  parser.add_argument('-o', '--output', help='Write the matching transmissions to this file, back to back')
+  parser.add_argument('--start', type=float, help='Seconds from the start of the archive')
+  parser.add_argument('--end', type=float, help='Seconds from the start of the archive')
+  parser.add_argument('--min-rms', type=float, help='Only transmissions at least this loud (dBFS)')
+  parser.add_argument('--min-duration', type=float, help='Only transmissions at least this long (seconds)')
+  args = parser.parse_args()
+
+  query = dict(start=args.start, end=args.end, min_rms_dbfs=args.min_rms, min_duration=args.min_duration)
+  if args.output:
+    index = cut_transmissions(args.filename, args.output, **query)
+  else:
+    index = load_index(args.filename).query(**query)
+  for segment in index:
+    print(f"{segment['start']:9.3f} {segment['duration']:7.3f}s {segment['rms_dbfs']:6.1f} dBFS")
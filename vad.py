@@ -0,0 +1,68 @@
+import numpy as np
+
+from audio_utils import audio_energy, nonsilent_from_energy, merge_ranges, gather_frames
+
+
+# Energy gate tuned for ATC feeds: long squelched silences, short transmissions
+VAD_SILENCE_THRESH = -48
+VAD_MIN_SILENCE_LEN = 300
+VAD_SEEK_STEP = 10
+VAD_PADDING_MS = 250
+
+
+def speech_islands(audio, silence_thresh=VAD_SILENCE_THRESH, min_silence_len=VAD_MIN_SILENCE_LEN,
+                   seek_step=VAD_SEEK_STEP, padding_ms=VAD_PADDING_MS):
+  """Padded [start, end] ms ranges that contain (possible) speech"""
+  sums, counts = audio_energy(audio)
+  nonsilent = nonsilent_from_energy(sums, counts, audio.sample_width, min_silence_len, silence_thresh, seek_step)
+  length = len(sums)
+  return merge_ranges([[max(0, start - padding_ms), min(length, end + padding_ms)] for start, end in nonsilent])
+
+
+class PackedSpeech:
+  """Speech islands packed back to back, with the offsets to map times back to the original"""
+
+  def __init__(self, audio, islands):
+    self.audio = audio
+    self.islands = np.asarray(islands, dtype=np.int64).reshape(-1, 2)
+    self.frames = gather_frames(audio, islands)
+
+    # Start of every island in packed time (ms), from the same frame rounding audio.frames uses
+    lengths = [max(audio.frame_at(end) - audio.frame_at(start), 0) for start, end in islands]
+    self.packed_starts = np.concatenate(([0], np.cumsum(lengths)))[:-1] * 1000 / audio.frame_rate
+    self.packed_ends = self.packed_starts + np.asarray(lengths) * 1000 / audio.frame_rate
+
+  @property
+  def duration_seconds(self):
+    return len(self.frames) / self.audio.frame_rate
+
+  def to_float(self):
+    """(channels, frames) float32 waveform in [-1, 1]"""
+    return self.frames.T.astype(np.float32) / float(2 ** (8 * self.audio.sample_width - 1))
+
+  def map_tracks(self, tracks):
+    """Map (start, end, label) tracks in packed seconds onto the original timeline
+
+    A track that spans the join between two islands is split in two, so no output
+    segment covers audio that was skipped.
+    """
+    mapped = []
+    for start, end, label in tracks:
+      start_ms, end_ms = start * 1000, end * 1000
+      first = np.searchsorted(self.packed_ends, start_ms, side='right')
+      last = np.searchsorted(self.packed_starts, end_ms, side='left')
+      for i in range(first, min(last, len(self.islands))):
+        lo = max(start_ms, self.packed_starts[i])
+        hi = min(end_ms, self.packed_ends[i])
+        if hi > lo:
+          offset = self.islands[i, 0] - self.packed_starts[i]
+          mapped.append((float(lo + offset) / 1000, float(hi + offset) / 1000, label))
+    return mapped
+
+
+def pack_speech(audio, max_ratio=0.9, **kwargs):
+  """PackedSpeech for an audio source, or None when gating would not save enough to be worth it"""
+  islands = speech_islands(audio, **kwargs)
+  if sum(end - start for start, end in islands) > max_ratio * len(audio):
+    return None
+  return PackedSpeech(audio, islands)
@@ -0,0 +1,134 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import requests
+
+from liveatc import USER_AGENT, archive_file_url, fetch_archive, find_archives, parse_archive_filename
+from mp3_frames import scan_frames
+from timeline import ARCHIVE_LENGTH
+
+
+# Archives shorter than this fraction of 30 minutes are reported as truncated
+MIN_DURATION_FRACTION = 0.95
+
+# More than this fraction of bytes between the first and last frame that aren't frames means lost sync
+MAX_JUNK_FRACTION = 0.02
+
+# What error pages and API responses served as .mp3 start with
+NON_AUDIO_PREFIXES = (b'<!doctype', b'<html', b'<?xml', b'<head', b'{')
+
+
+def remote_size(url):
+  """Content-Length the archive server reports for a URL, or None"""
+  import urllib3
+  urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+  response = requests.head(url, timeout=10, verify=False, allow_redirects=True, headers={'User-Agent': USER_AGENT})
+  if response.status_code != 200 or 'Content-Length' not in response.headers:
+    return None
+  return int(response.headers['Content-Length'])
+
+
+def verify_archive(path, expected_seconds=ARCHIVE_LENGTH.total_seconds(), remote=False):
+  """Check that a downloaded archive is a complete MP3
+
+  Returns a dict with the path, a status ('ok', 'empty', 'not_audio', 'corrupt' or
+  'truncated'), the reason, and the size and duration found.
+  """
+  size = os.path.getsize(path)
+  result = {'path': path, 'status': 'ok', 'reason': '', 'size': size, 'duration': 0.0}
+
+  def fail(status, reason):
+    result.update(status=status, reason=reason)
+    return result
+
+  if size == 0:
+    return fail('empty', 'file is empty')
+
+  with open(path, 'rb') as f:
+    head = f.read(512).lstrip().lower()
+  if head.startswith(NON_AUDIO_PREFIXES):
+    return fail('not_audio', 'file is a text/HTML page, not audio')
+
+  try:
+    frames = scan_frames(path)
+  except ValueError:
+    return fail('not_audio', 'no MPEG audio frames found')
+  if not len(frames):
+    return fail('not_audio', 'no MPEG audio frames found')
+
+  result['duration'] = frames.duration_seconds
+
+  if remote:
+    try:
+      expected_size = remote_size(archive_file_url(path))
+    except (requests.exceptions.RequestException, ValueError):
+      expected_size = None
+    if expected_size is not None and expected_size != size:
+      return fail('truncated', f'{size} bytes on disk, server has {expected_size}')
+
+  audio_end = int(frames.offsets[-1] + frames.sizes[-1])
+  if audio_end > size:
+    return fail('truncated', 'last frame is cut off')
+
+  span = audio_end - int(frames.offsets[0])
+  junk = 1 - int(frames.sizes.sum()) / span
+  if junk > MAX_JUNK_FRACTION:
+    return fail('corrupt', f'{junk:.1%} of the audio data is not valid MPEG frames')
+
+  if frames.duration_seconds < MIN_DURATION_FRACTION * expected_seconds:
+    return fail('truncated', f'{frames.duration_seconds / 60:.1f} of {expected_seconds / 60:.0f} minutes')
+
+  return result
+
+
+def _verify_job(job):
+  path, remote = job
+  try:
+    return verify_archive(path, remote=remote)
+  except OSError as e:
+    return {'path': path, 'status': 'corrupt', 'reason': str(e), 'size': 0, 'duration': 0.0}
+
+
+def verify_tree(root, workers=None, remote=False):
+  """Verify every archive under a directory in parallel, yielding results in path order"""
+  paths = list(find_archives(root))
+  with ProcessPoolExecutor(max_workers=workers) as executor:
+    yield from executor.map(_verify_job, [(path, remote) for path in paths], chunksize=8)
+
+
+def bad_intervals(results):
+  """(archive identifier, start, end) UTC intervals covered by failed archives, merged when consecutive"""
+  spans = []
+  for result in results:
+    parsed = parse_archive_filename(result['path'])
+    if result['status'] != 'ok' and parsed:
+      spans.append((parsed[0], parsed[1], parsed[1] + ARCHIVE_LENGTH))
+
+  merged = []
+  for identifier, start, end in sorted(spans):
+    if merged and merged[-1][0] == identifier and merged[-1][2] >= start:
+      merged[-1] = (identifier, merged[-1][1], max(merged[-1][2], end))
+    else:
+      merged.append((identifier, start, end))
+  return merged
+
+
+def repair(results, delay=10.0):
+  """Download failed archives again in place and re-verify them
+
+  Returns the results of the re-verification (or of the failed download).
+  """
+  bad = [result for result in results if result['status'] != 'ok']
+  repaired = []
+  for i, result in enumerate(bad):
+    path = result['path']
+    try:
+      fetch_archive(archive_file_url(path), path)
+      repaired.append(verify_archive(path))
+    except Exception as e:
+      repaired.append({**result, 'reason': f'download failed: {e}'})
+
+    if delay > 0 and i < len(bad) - 1:
+      time.sleep(delay)
+  return repaired
@@ -0,0 +1,266 @@
+import os
+
+import numpy as np
+
+from cache import get_cache_dir, file_hash
+
+
+WAVEFORM_VERSION = 1
+
+# Samples per bin of the finest level (~11.6 ms at 22.05 kHz)
+BASE_BIN = 256
+
+# Each level has this many times fewer bins than the one below it
+LEVEL_FACTOR = 4
+
+# Stop adding levels once one has no more than this many bins
+MIN_LEVEL_BINS = 64
+
+
+class Waveform:
+  """Min/max/RMS pyramid of a recording, for drawing any span at any zoom in O(pixels)
+
+  levels[k] holds (min, max, rms) int16 arrays with one value per BASE_BIN * LEVEL_FACTOR**k
+  samples, all channels mixed together.
+  """
+
+  def __init__(self, frame_rate, frame_count, levels):
+    self.frame_rate = frame_rate
+    self.frame_count = frame_count
+    self.levels = levels
+
+  def __len__(self):
+    # Length in milliseconds, like AudioSegment
+    return round(self.frame_count / self.frame_rate * 1000)
+
+  def bin_frames(self, level):
+    return BASE_BIN * LEVEL_FACTOR ** level
+
+  def span(self, start_ms, end_ms, pixels):
+    """(min, max, rms) arrays of one value per pixel between two times in ms
+
+    Reads from the coarsest level with at least LEVEL_FACTOR bins per pixel (so pixel edges
+    are off by at most a quarter pixel), which means at most LEVEL_FACTOR**2 bins per pixel
+    whatever the span. Pixels outside the recording are NaN.
+    """
+    first = start_ms * self.frame_rate / 1000
+    last = end_ms * self.frame_rate / 1000
+    frames_per_pixel = (last - first) / pixels
+
+    level = 0
+    while level + 1 < len(self.levels) and self.bin_frames(level + 1) * LEVEL_FACTOR <= frames_per_pixel:
+      level += 1
+    mins, maxs, rms = self.levels[level]
+    size = self.bin_frames(level)
+
+    # First bin of every pixel, plus the end of the last one
+    edges = np.floor((first + np.arange(pixels + 1) * frames_per_pixel) / size).astype(np.int64)
+    starts = edges[:-1]
+    ends = np.maximum(edges[1:], starts + 1)
+    valid = (starts >= 0) & (starts < len(mins))
+    starts = np.clip(starts, 0, len(mins) - 1)
+    ends = np.clip(ends, 1, len(mins))
+
+    out_min = np.full(pixels, np.nan, dtype=np.float32)
+    out_max = np.full(pixels, np.nan, dtype=np.float32)
+    out_rms = np.full(pixels, np.nan, dtype=np.float32)
+    if not valid.any():
+      return out_min, out_max, out_rms
+
+    if frames_per_pixel < size:
+      # Zoomed in past the finest level: pixels share bins
+      out_min[valid] = mins[starts[valid]]
+      out_max[valid] = maxs[starts[valid]]
+      out_rms[valid] = rms[starts[valid]]
+      return out_min, out_max, out_rms
+
+    # reduceat over the bins of each pixel (runs are contiguous and in order)
+    lo, hi = starts[valid], ends[valid]
+    window = slice(lo[0], hi[-1])
+    offsets = lo - lo[0]
+    counts = hi - lo
+    power = rms[window].astype(np.float64) ** 2
+    out_min[valid] = np.minimum.reduceat(mins[window], offsets)
+    out_max[valid] = np.maximum.reduceat(maxs[window], offsets)
+    out_rms[valid] = np.sqrt(np.add.reduceat(power, offsets) / counts)
+    return out_min, out_max, out_rms
+
+  def save(self, path, source_size=0, source_mtime=0):
+    arrays = {}
+    for k, (mins, maxs, rms) in enumerate(self.levels):
+      arrays[f'min{k}'], arrays[f'max{k}'], arrays[f'rms{k}'] = mins, maxs, rms
+    with open(path + '.part', 'wb') as f:
+      np.savez_compressed(f, version=WAVEFORM_VERSION, source_size=source_size, source_mtime=source_mtime,
+                          fmt=np.array([self.frame_rate, self.frame_count, len(self.levels), BASE_BIN, LEVEL_FACTOR]),
+                          **arrays)
+    os.replace(path + '.part', path)
+
+  @classmethod
+  def load(cls, path):
+    with np.load(path) as data:
+      frame_rate, frame_count, n_levels, base_bin, factor = data['fmt'].tolist()
+      if int(data['version']) != WAVEFORM_VERSION or (base_bin, factor) != (BASE_BIN, LEVEL_FACTOR):
+        raise ValueError(f'{path} was built with different settings')
+      levels = [(data[f'min{k}'], data[f'max{k}'], data[f'rms{k}']) for k in range(n_levels)]
+    return cls(frame_rate, frame_count, levels)
+
+
+class WaveformBuilder:
+  """Builds a Waveform from audio fed in pieces of any size, e.g. while it is being decoded"""
+
+  def __init__(self, frame_rate, channels, dtype='<i2'):
+    self.frame_rate = frame_rate
+    self.channels = channels
+    self.dtype = np.dtype(dtype)
+    self.frame_count = 0
+    self._pending_bytes = b''
+    self._pending = np.zeros((0, channels), dtype=self.dtype)
+    self._mins, self._maxs, self._power = [], [], []
+
+  def feed_bytes(self, data):
+    """Raw interleaved PCM, split anywhere"""
+    data = self._pending_bytes + data
+    usable = len(data) - len(data) % (self.dtype.itemsize * self.channels)
+    self._pending_bytes = data[usable:]
+    self.feed(np.frombuffer(data[:usable], dtype=self.dtype).reshape(-1, self.channels))
+
+  def feed(self, samples):
+    """(frames, channels) samples"""
+    self.frame_count += len(samples)
+    if len(self._pending):
+      samples = np.concatenate([self._pending, samples])
+    whole = len(samples) - len(samples) % BASE_BIN
+    self._pending = samples[whole:].copy()
+    if whole:
+      self._add_bins(samples[:whole].reshape(-1, BASE_BIN * self.channels))
+
+  def _add_bins(self, bins):
+    self._mins.append(bins.min(axis=1))
+    self._maxs.append(bins.max(axis=1))
+    values = bins.astype(np.float64)
+    self._power.append(np.einsum('ij,ij->i', values, values) / bins.shape[1])
+
+  def finish(self):
+    if len(self._pending):
+      self._add_bins(self._pending.reshape(1, -1))
+      self._pending = self._pending[:0]
+
+    mins = np.concatenate(self._mins) if self._mins else np.zeros(0, dtype=self.dtype)
+    maxs = np.concatenate(self._maxs) if self._maxs else np.zeros(0, dtype=self.dtype)
+    power = np.concatenate(self._power) if self._power else np.zeros(0)
+
+    levels = []
+    while True:
+      levels.append((mins.astype('<i2'), maxs.astype('<i2'), np.sqrt(power).round().astype('<i2')))
+      if len(mins) <= MIN_LEVEL_BINS:
+        break
+      # Next level: groups of LEVEL_FACTOR bins (the last group may be short)
+      offsets = np.arange(0, len(mins), LEVEL_FACTOR)
+      counts = np.diff(np.append(offsets, len(mins)))
+      mins = np.minimum.reduceat(mins, offsets)
+      maxs = np.maximum.reduceat(maxs, offsets)
+      power = np.add.reduceat(power, offsets) / counts
+
+    return Waveform(self.frame_rate, self.frame_count, levels)
+
+
+def waveform_path(path):
+  """Where an audio file's waveform is kept: next to it, or in the cache if that's read-only"""
+  if os.access(os.path.dirname(os.path.abspath(path)), os.W_OK):
+    return f'{path}.wave.npz'
+  return os.path.join(get_cache_dir('waveform'), f'{file_hash(path)}.wave.npz')
+
+
+def save_waveform(waveform, path):
+  stat = os.stat(path)
+  waveform.save(waveform_path(path), stat.st_size, stat.st_mtime_ns)
+
+
+def cached_waveform(path):
+  """Waveform of an audio file if one was built for its current contents, else None"""
+  wave_path = waveform_path(path)
+  if not os.path.exists(wave_path):
+    return None
+  stat = os.stat(path)
+  try:
+    with np.load(wave_path) as data:
+      if int(data['source_size']) != stat.st_size or int(data['source_mtime']) != stat.st_mtime_ns:
+        return None
+    return Waveform.load(wave_path)
+  except (OSError, ValueError, KeyError):
+    return None
+
+
+def load_waveform(path, rebuild=False):
+  """Waveform of an audio file, built from its decoded PCM the first time
+
+  Downloaded archives decoded through the PCM cache get their waveform built during
+  decoding, so this usually just reads the file.
+  """
+  waveform = None if rebuild else cached_waveform(path)
+  if waveform is None:
+    from pcm_cache import load_pcm
+
+    audio = load_pcm(path)
+    waveform = cached_waveform(path)
+    if waveform is None or rebuild:
+      builder = WaveformBuilder(audio.frame_rate, audio.channels, audio.dtype)
+      for start in range(0, audio.frame_count, 60 * audio.frame_rate):
+        builder.feed(audio.samples[start:start + 60 * audio.frame_rate])
+      waveform = builder.finish()
+      save_waveform(waveform, path)
+  return waveform
+
+
+def _waveform_job(path):
+  try:
+    return path, load_waveform(path), None
+  except Exception as e:
+    return path, None, str(e)
+
+
+def load_waveforms(paths, workers=None, log=print):
+  """Waveforms of many files, building the missing ones in parallel; returns (waveforms, failed)"""
+  from concurrent.futures import ProcessPoolExecutor
+
+  waveforms = {}
+  pending = []
+  for path in paths:
+    waveform = cached_waveform(path)
+    if waveform is None:
+      pending.append(path)
+    else:
+      waveforms[path] = waveform
+
+  failed = []
+  if pending:
+    log(f"Building {len(pending)} waveform(s), {len(waveforms)} cached")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      for path, waveform, error in executor.map(_waveform_job, pending):
+        if error:
+          failed.append((path, error))
+        else:
+          waveforms[path] = waveform
+  return waveforms, failed
+
+
+def span_across(entries, start_ms, end_ms, pixels):
+  """(min, max, rms) per pixel over consecutive recordings, e.g. a day of archives
+
+  entries are (offset in ms, Waveform or None) on a shared time axis; pixels not covered
+  by a waveform are NaN.
+  """
+  out = [np.full(pixels, np.nan, dtype=np.float32) for _ in range(3)]
+  ms_per_pixel = (end_ms - start_ms) / pixels
+  for offset, waveform in entries:
+    if waveform is None:
+      continue
+    first = max(int(np.ceil((offset - start_ms) / ms_per_pixel)), 0)
+    last = min(int(np.ceil((offset + len(waveform) - start_ms) / ms_per_pixel)), pixels)
+    if last <= first:
+      continue
+    local_start = start_ms + first * ms_per_pixel - offset
+    values = waveform.span(local_start, local_start + (last - first) * ms_per_pixel, last - first)
+    for target, value in zip(out, values):
+      target[first:last] = value
+  return tuple(out)